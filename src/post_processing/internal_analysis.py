@@ -1,10 +1,11 @@
 import pandas as pd
 import numpy as np
 import os
-import re
-import seaborn as sns
-import matplotlib.pyplot as plt
+import glob
+import multiprocessing
+from functools import partial
 from scipy.optimize import minimize
+from scipy.signal import fftconvolve
 
 __author__ = "Gao, Yuqian <Yuqian.Gao@pnnl.gov>"
 __maintainer__ = "Anubhav <anubhav@pnnl.gov>"
@@ -17,36 +18,11 @@ class InternalAnalysis:
     ):
         self.parent_folder = parent_folder
 
-    def findproteinname(s):
-        """Get Protein type
-        :param s:
-        :return:
-        """
-        p1 = re.compile(r"^Contaminant_")
-        p2 = re.compile(r"^XXX_Contaminant_")
-        p3 = re.compile(r"^XXX_")
-        if p1.search(s) is not None:
-            return "None"
-        elif p2.search(s) is not None:
-            return "None"
-        elif p3.search(s) is not None:
-            return "Reversed"
-        else:  # the rest
-            return "Forward"
-
-    def cleansequence(s):
-        """
-        clean peptide sequence is the sequence without prefix and postfix but with oxidation
-        :param s:
-        :return:
-        """
-        p = re.compile(r"\.(?P<cleanseq>[A-Z\*@#]+)\.")
-        m = p.search(s)
-        return m.group("cleanseq")
-
-    def process_data(self):
+    def process_data(self, output_format="csv"):
         """
 
+        :param output_format: "csv" or "parquet", format of the per dataset forward and
+            reversed peptide identification files, see write_dataset_files
         :return:
         """
         # import table
@@ -79,10 +55,22 @@ class InternalAnalysis:
             },
             inplace=True,
         )
-        data["Protein_Type"] = data["Protein"].apply(self.findproteinname)
-        data["Clean Peptide Sequence"] = data["Peptide"].apply(self.cleansequence)
-        data["SpecID"] = data.apply(
-            lambda row: str(row["Dataset_ID"]) + "_" + str(row["Scan"]), axis=1
+        # protein type from the decoy and contaminant prefixes; the clean sequence drops the
+        # flanking residues but keeps the modifications, and is NaN for peptides without them
+        data["Protein_Type"] = np.select(
+            [
+                data["Protein"].str.startswith("Contaminant_")
+                | data["Protein"].str.startswith("XXX_Contaminant_"),
+                data["Protein"].str.startswith("XXX_"),
+            ],
+            ["None", "Reversed"],
+            "Forward",
+        )
+        data["Clean Peptide Sequence"] = data["Peptide"].str.extract(
+            r"\.([A-Z\*@#]+)\.", expand=False
+        )
+        data["SpecID"] = (
+            data["Dataset_ID"].astype(str) + "_" + data["Scan"].astype(str)
         )
 
         # Save protein to peptide mapping of forward peptide identification
@@ -141,50 +129,274 @@ class InternalAnalysis:
         dataset_list = data_cleaned_forward["Dataset_ID"].unique().tolist()
 
         # Export forward and reverse for individual dataset
-        for i in range(len(dataset_list)):
-            df_ff = data_cleaned_forward[
-                data_cleaned_forward["Dataset_ID"] == dataset_list[i]
-            ].copy()
-            df_ff.to_csv(
-                "Results/Data/"
-                + str(dataset_list[i])
-                + "_forward_peptide_identification.csv",
-                index=False,
-            )
-            df_rr = data_cleaned_reversed[
-                data_cleaned_reversed["Dataset_ID"] == dataset_list[i]
-            ].copy()
-            df_rr.to_csv(
-                "Results/Data/"
-                + str(dataset_list[i])
-                + "_reversed_peptide_identification.csv",
-                index=False,
-            )
-            del df_ff
-            del df_rr
+        write_dataset_files(
+            data_cleaned_forward,
+            dataset_list,
+            "forward_peptide_identification",
+            output_format,
+        )
+        write_dataset_files(
+            data_cleaned_reversed,
+            dataset_list,
+            "reversed_peptide_identification",
+            output_format,
+        )
 
         del data_cleaned_forward
         del data_cleaned_reversed
 
 
+def dataset_file(dataset_ID, name, output_format="csv", folder="Results/Data/"):
+    """
+    :return: path of the <name> file of a dataset, e.g. Results/Data/<ID>_<name>.csv
+    """
+    return folder + str(dataset_ID) + "_" + name + "." + output_format
+
+
+def write_dataset_files(
+    data, dataset_list, name, output_format="csv", folder="Results/Data/"
+):
+    """
+    Writes the rows of every dataset in dataset_list to its own file, see dataset_file, in
+    one groupby pass over data. Datasets without rows get a file with just the header.
+    :param data: rows of all datasets, with a Dataset_ID column
+    :param output_format: "csv" or "parquet"
+    """
+
+    def write(df, dataset_ID):
+        file = dataset_file(dataset_ID, name, output_format, folder)
+        if output_format == "parquet":
+            df.to_parquet(file, index=False)
+        else:
+            df.to_csv(file, index=False)
+
+    remaining = set(dataset_list)
+    for dataset_ID, df in data.groupby("Dataset_ID", sort=False):
+        if dataset_ID in remaining:
+            write(df, dataset_ID)
+            remaining.discard(dataset_ID)
+    for dataset_ID in dataset_list:
+        if dataset_ID in remaining:
+            write(data.iloc[:0], dataset_ID)
+
+
+def read_dataset_file(dataset_ID, name, folder="Results/Data/"):
+    """
+    Reads the <name> file of a dataset written by write_dataset_files, parquet or csv. If
+    both exist, the one written last, so a rerun in the other format is not shadowed.
+    """
+    parquet_file = dataset_file(dataset_ID, name, "parquet", folder)
+    csv_file = dataset_file(dataset_ID, name, "csv", folder)
+    if os.path.exists(parquet_file) and (
+        not os.path.exists(csv_file)
+        or os.path.getmtime(parquet_file) >= os.path.getmtime(csv_file)
+    ):
+        return pd.read_parquet(parquet_file)
+    return pd.read_csv(csv_file)
+
+
+def kde_mode(values, grid_size=4096):
+    """
+    Mode of the Gaussian kernel density estimate of values, with Scott's rule bandwidth as
+    seaborn's distplot uses. The density is evaluated on a regular grid by binning the values
+    onto it and convolving with the kernel, so the cost is linear in the number of values.
+    :param values: 1-D data
+    :param grid_size: number of grid points between min - 3 * bandwidth and max + 3 * bandwidth
+    :return: grid point with the highest density
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        raise ValueError("kde_mode needs at least one finite value")
+    bandwidth = values.std(ddof=1) * values.size ** (-1 / 5) if values.size > 1 else 0.0
+    if not bandwidth > 0:
+        return float(values[0])
+
+    # linear binning onto the grid
+    grid = np.linspace(
+        values.min() - 3 * bandwidth, values.max() + 3 * bandwidth, grid_size
+    )
+    delta = grid[1] - grid[0]
+    position = (values - grid[0]) / delta
+    left = np.minimum(np.floor(position).astype(np.int64), grid_size - 2)
+    weight = position - left
+    counts = np.bincount(left, weights=1 - weight, minlength=grid_size) + np.bincount(
+        left + 1, weights=weight, minlength=grid_size
+    )
+
+    # Gaussian kernel truncated at 5 bandwidths
+    half_width = min(int(np.ceil(5 * bandwidth / delta)), grid_size - 1)
+    offsets = np.arange(-half_width, half_width + 1) * delta
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    density = fftconvolve(counts, kernel, mode="same")
+
+    return float(grid[np.argmax(density)])
+
+
+class PeptideCutoffIndex:
+    """
+    PSMs of one dataset sorted by DelM_PPM, with integer coded clean peptide sequences, so the
+    peptides passing a set of cutoffs are counted from a slice of the sorted arrays instead of
+    filtering the whole frame.
+    """
+
+    def __init__(self, data):
+        """
+        :param data: PSMs with DelM_PPM, MSGFDB_SpecEValue and Clean Peptide Sequence
+        """
+        delm_ppm = data["DelM_PPM"].to_numpy(dtype=float)
+        order = np.argsort(delm_ppm, kind="stable")
+        self.delm_ppm = delm_ppm[order]
+        self.spec_e_value = data["MSGFDB_SpecEValue"].to_numpy(dtype=float)[order]
+        codes, peptides = pd.factorize(data["Clean Peptide Sequence"])
+        self.peptide = codes[order]
+        # one flag per peptide, reused by every count
+        self.seen = np.zeros(len(peptides), dtype=bool)
+
+        # the same PSMs sorted by MSGFDB_SpecEValue instead, for best_spec_e_values
+        order = np.argsort(self.spec_e_value, kind="stable")
+        self.spec_e_value_sorted = self.spec_e_value[order]
+        self.delm_ppm_by_spec = self.delm_ppm[order]
+        self.peptide_by_spec = self.peptide[order]
+
+    def count_peptides(self, low, high, spec_e_value):
+        """
+        :return: number of distinct peptides of the PSMs with low < DelM_PPM < high and
+            MSGFDB_SpecEValue < spec_e_value
+        """
+        start = np.searchsorted(self.delm_ppm, low, side="right")
+        end = np.searchsorted(self.delm_ppm, high, side="left")
+        passing = self.peptide[start:end][self.spec_e_value[start:end] < spec_e_value]
+        passing = passing[passing >= 0]
+        self.seen[passing] = True
+        count = np.count_nonzero(self.seen)
+        self.seen[passing] = False
+        return count
+
+    def best_spec_e_values(self, low, high):
+        """
+        Best (lowest) MSGFDB_SpecEValue of every peptide among the PSMs with
+        low < DelM_PPM < high. count_peptides(low, high, x) is the number of these below x.
+        :return: sorted array, one value per peptide
+        """
+        positions = np.flatnonzero(
+            (self.delm_ppm_by_spec > low)
+            & (self.delm_ppm_by_spec < high)
+            & (self.peptide_by_spec >= 0)
+        )
+        # first position of each peptide in SpecEValue order
+        first = np.full(len(self.seen), len(self.spec_e_value_sorted))
+        np.minimum.at(first, self.peptide_by_spec[positions], positions)
+        is_best = np.zeros(len(self.spec_e_value_sorted) + 1, dtype=bool)
+        is_best[first] = True
+        return self.spec_e_value_sorted[is_best[:-1]]
+
+
+def grid_search_cutoffs(index_f, index_r, ppm_shift, ppm_step=0.5):
+    """
+    Minimizes the PepFDR objective of parameter_optimization over a grid of DelM_PPM windows
+    that meet its constraints (delppm1, delppm2 >= 5, delppm1 + delppm2 <= 20). Within a
+    window the peptide counts only change at the best SpecEValues of its peptides, so one
+    SpecEValue cutoff between each pair of them covers every possible cutoff.
+    :param index_f: PeptideCutoffIndex of the forward PSMs
+    :param index_r: PeptideCutoffIndex of the reversed PSMs
+    :return: [delppm1, delppm2, log10_specprob] with the lowest objective, to seed COBYLA,
+        or None if no window has a PSM with a finite, positive SpecEValue
+    """
+    best_value, best_params = np.inf, None
+    for delppm1 in np.arange(5, 15 + ppm_step / 2, ppm_step):
+        for delppm2 in np.arange(5, 20 - delppm1 + ppm_step / 2, ppm_step):
+            window = (ppm_shift - delppm2, ppm_shift + delppm1)
+            f_best = index_f.best_spec_e_values(*window)
+            r_best = index_r.best_spec_e_values(*window)
+            values = np.union1d(f_best, r_best)
+            values = values[np.isfinite(values) & (values > 0)]
+            if len(values) == 0:
+                continue
+            log10_values = np.log10(values)
+            log10_specprobs = np.append(
+                (log10_values[:-1] + log10_values[1:]) / 2, log10_values[-1] + 0.5
+            )
+            spec_e_values = 10 ** log10_specprobs
+            f_pep = np.searchsorted(f_best, spec_e_values, side="left")
+            r_pep = np.searchsorted(r_best, spec_e_values, side="left")
+            total = f_pep + r_pep
+            fdr_pep = np.where(total == 0, 1, r_pep / np.maximum(total, 1))
+            value = 1 / (0.050001 - fdr_pep) * (-f_pep)
+            i = np.argmin(value)
+            if value[i] < best_value:
+                best_value = value[i]
+                best_params = [delppm1, delppm2, log10_specprobs[i]]
+    return best_params
+
+
+def plot_parameter_optimization(
+    dataset_ID, data_f, data_r, ppm_shift, fitted_params, plot_folder="Results/Plots/"
+):
+    """
+    Plots the DelM_PPM and MSGFDB_SpecEValue distributions of a dataset with the fitted
+    cutoffs, to plot_folder/<dataset_ID>.jpg. Only this stage needs seaborn and matplotlib,
+    which are imported here and render without a display.
+    :param fitted_params: delppm1, delppm2, log10_specprob from parameter_optimization
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    plt.close("all")
+    fig, axes = plt.subplots(nrows=2, ncols=1, figsize=(7, 15))
+    # plot the DelM_PPM
+    sns.distplot(data_f["DelM_PPM"], label="forward", ax=axes[0], bins=200)
+    axes[0].axvline(x=ppm_shift, color="r", linestyle="--")
+    axes[0].axvline(x=ppm_shift - fitted_params[1], color="g", linestyle="-")
+    axes[0].axvline(x=ppm_shift + fitted_params[0], color="g", linestyle="-")
+    sns.distplot(data_r["DelM_PPM"], label="reversed", ax=axes[0], bins=200)
+    axes[0].set_xlabel("DelM_PPM")
+    axes[0].set_ylabel("Density")
+    axes[0].set_title(
+        r"left bound: %.2f; right bound: %.2f"
+        % (ppm_shift - fitted_params[1], ppm_shift + fitted_params[0])
+    )
+    # plot MSGFDB_SpecEValue
+    sns.distplot(
+        data_f["MSGFDB_SpecEValue"], label="forward", kde=False, ax=axes[1], bins=5000
+    )
+    sns.distplot(
+        data_r["MSGFDB_SpecEValue"], label="reversed", kde=False, ax=axes[1], bins=5000
+    )
+    axes[1].axvline(x=10 ** fitted_params[2], color="g", linestyle="-")
+    axes[1].set_title("MSGFDB_SpecEValue: %.2e" % (10 ** fitted_params[2]))
+    axes[1].set_xlabel("log(MSGFDB_SpecEValue)")
+    axes[1].set_ylabel("Density")
+    axes[1].set_xscale("log")
+    # save
+    plt.tight_layout()
+    plt.savefig(plot_folder + str(dataset_ID) + ".jpg")
+    plt.close("all")
+
+
 # optimize the filtering criteria and filter the data
-def parameter_optimization(dataset_ID):
+def parameter_optimization(dataset_ID, plot=True, grid_search=False):
     """
 
     :param dataset_ID:
+    :param plot: also plot the fit, see plot_parameter_optimization. Off on headless workers.
+    :param grid_search: seed COBYLA with grid_search_cutoffs instead of the fixed guess
+        and its retries. Falls back to those if the grid has no candidate cutoffs.
     :return:
     """
-    data_f = pd.read_csv(
-        "Results/Data/" + str(dataset_ID) + "_forward_peptide_identification.csv"
-    )
-    data_r = pd.read_csv(
-        "Results/Data/" + str(dataset_ID) + "_reversed_peptide_identification.csv"
-    )
+    data_f = read_dataset_file(dataset_ID, "forward_peptide_identification")
+    data_r = read_dataset_file(dataset_ID, "reversed_peptide_identification")
 
     # Fit a 1-D data of DelM_PPM and get the peak ppm_shift
     ppm_shift_df = data_f[(data_f["DelM_PPM"] < 10) & (data_f["DelM_PPM"] > -10)].copy()
-    ax = sns.distplot(ppm_shift_df["DelM_PPM"])
-    ppm_shift = ax.get_lines()[0].get_xdata()[np.argmax(ax.get_lines()[0].get_ydata())]
+    ppm_shift = kde_mode(ppm_shift_df["DelM_PPM"])
+
+    # sorted PSMs, for evaluating PepFDR without filtering the frames
+    index_f = PeptideCutoffIndex(data_f)
+    index_r = PeptideCutoffIndex(data_r)
 
     def PepFDR(Params):
         """
@@ -199,19 +411,9 @@ def parameter_optimization(dataset_ID):
             log10_specprob,
         ) = Params  # use log10 value so that it is managable for the computer
         ### The FDR function ###
-        pep_total = data_r["Clean Peptide Sequence"].unique().size
-        df_r = data_r[
-            (data_r["DelM_PPM"] < ppm_shift + delppm1)
-            & (data_r["DelM_PPM"] > ppm_shift - delppm2)
-            & (data_r["MSGFDB_SpecEValue"] < 10 ** log10_specprob)
-        ].copy()
-        df_f = data_f[
-            (data_f["DelM_PPM"] < ppm_shift + delppm1)
-            & (data_f["DelM_PPM"] > ppm_shift - delppm2)
-            & (data_f["MSGFDB_SpecEValue"] < 10 ** log10_specprob)
-        ].copy()
-        f_pep = df_f["Clean Peptide Sequence"].unique().size
-        r_pep = df_r["Clean Peptide Sequence"].unique().size
+        cutoffs = (ppm_shift - delppm2, ppm_shift + delppm1, 10 ** log10_specprob)
+        f_pep = index_f.count_peptides(*cutoffs)
+        r_pep = index_r.count_peptides(*cutoffs)
         ### fdr_pep ###
         if (f_pep == 0) & (r_pep == 0):
             fdr_pep = 1
@@ -252,69 +454,60 @@ def parameter_optimization(dataset_ID):
     con3 = {"type": "ineq", "fun": constraint3}
 
     # Miminize PepFDR
-    initial_guess = [
-        min(10, max(data_f["DelM_PPM"]) - ppm_shift),
-        min(10, ppm_shift - min(data_f["DelM_PPM"])),
-        -15,
-    ]
-    # print(dataset_ID, initial_guess)
-    result = minimize(
-        PepFDR, initial_guess, method="COBYLA", constraints=[con1, con2, con3]
-    )
-    if result.success:
-        fitted_params = result.x
-    else:
-        n = 0
-        while (result.success == False) & (n < 40):
-            initial_guess = [
-                initial_guess[0] + 0.2,
-                initial_guess[1] + 0.2,
-                initial_guess[2],
-            ]
-            result = minimize(
-                PepFDR, initial_guess, method="COBYLA", constraints=[con1, con2, con3]
+    initial_guess = None
+    if grid_search:
+        initial_guess = grid_search_cutoffs(index_f, index_r, ppm_shift)
+        if initial_guess is None:
+            print(
+                "No grid search cutoffs @ Dataset ID: %s, using the fixed initial guess"
+                % dataset_ID
             )
-            n = n + 1
+    if initial_guess is not None:
+        result = minimize(
+            PepFDR, initial_guess, method="COBYLA", constraints=[con1, con2, con3]
+        )
+        # the grid point is feasible, keep it if COBYLA fails or ends on a worse point
+        if result.success and PepFDR(result.x) <= PepFDR(initial_guess):
+            fitted_params = result.x
+        else:
+            fitted_params = np.array(initial_guess)
+    else:
+        initial_guess = [
+            min(10, max(data_f["DelM_PPM"]) - ppm_shift),
+            min(10, ppm_shift - min(data_f["DelM_PPM"])),
+            -15,
+        ]
+        # print(dataset_ID, initial_guess)
+        result = minimize(
+            PepFDR, initial_guess, method="COBYLA", constraints=[con1, con2, con3]
+        )
         if result.success:
             fitted_params = result.x
         else:
-            print(
-                "Failed optimization @ Dataset ID: %s, Database: %s" % (dataset_ID, DB)
-            )
-            print(initial_guess)
-            raise ValueError(result.message)
-
-    ### plots ###
-    plt.close("all")
-    fig, axes = plt.subplots(nrows=2, ncols=1, figsize=(7, 15))
-    # plot the DelM_PPM
-    sns.distplot(data_f["DelM_PPM"], label="forward", ax=axes[0], bins=200)
-    axes[0].axvline(x=ppm_shift, color="r", linestyle="--")
-    axes[0].axvline(x=ppm_shift - fitted_params[1], color="g", linestyle="-")
-    axes[0].axvline(x=ppm_shift + fitted_params[0], color="g", linestyle="-")
-    sns.distplot(data_r["DelM_PPM"], label="reversed", ax=axes[0], bins=200)
-    axes[0].set_xlabel("DelM_PPM")
-    axes[0].set_ylabel("Density")
-    axes[0].set_title(
-        r"left bound: %.2f; right bound: %.2f"
-        % (ppm_shift - fitted_params[1], ppm_shift + fitted_params[0])
-    )
-    # plot MSGFDB_SpecEValue
-    sns.distplot(
-        data_f["MSGFDB_SpecEValue"], label="forward", kde=False, ax=axes[1], bins=5000
-    )
-    sns.distplot(
-        data_r["MSGFDB_SpecEValue"], label="reversed", kde=False, ax=axes[1], bins=5000
-    )
-    axes[1].axvline(x=10 ** fitted_params[2], color="g", linestyle="-")
-    axes[1].set_title("MSGFDB_SpecEValue: %.2e" % (10 ** fitted_params[2]))
-    axes[1].set_xlabel("log(MSGFDB_SpecEValue)")
-    axes[1].set_ylabel("Density")
-    axes[1].set_xscale("log")
-    # save
-    plt.tight_layout()
-    plt.savefig("Results/Plots/" + str(dataset_ID) + ".jpg")
-    plt.close("all")
+            n = 0
+            while (result.success == False) & (n < 40):
+                initial_guess = [
+                    initial_guess[0] + 0.2,
+                    initial_guess[1] + 0.2,
+                    initial_guess[2],
+                ]
+                result = minimize(
+                    PepFDR, initial_guess, method="COBYLA", constraints=[con1, con2, con3]
+                )
+                n = n + 1
+            if result.success:
+                fitted_params = result.x
+            else:
+                print(
+                    "Failed optimization @ Dataset ID: %s, Database: %s" % (dataset_ID, DB)
+                )
+                print(initial_guess)
+                raise ValueError(result.message)
+
+    if plot:
+        plot_parameter_optimization(
+            dataset_ID, data_f, data_r, ppm_shift, fitted_params
+        )
 
     # #Filter the data
     df_f = data_f[
@@ -342,8 +535,9 @@ def parameter_optimization(dataset_ID):
         fdr_spec = r_spec / (f_spec + r_spec)
 
     # Modified on Aug 02, 2019 to use Clean Peptide Sequence instead of peptide
-    f_pep = df_f["Clean Peptide Sequence"].unique().size
-    r_pep = df_r["Clean Peptide Sequence"].unique().size
+    # NaN clean sequences are not peptides, as in PeptideCutoffIndex.count_peptides
+    f_pep = df_f["Clean Peptide Sequence"].nunique()
+    r_pep = df_r["Clean Peptide Sequence"].nunique()
     if (f_pep == 0) & (r_pep == 0):
         fdr_pep = 1
     else:
@@ -421,3 +615,36 @@ def parameter_optimization(dataset_ID):
     df_Intensity["Dataset_ID"] = dataset_ID
 
     return df_Metadata, df_SpecID_f, df_SpecID_r, df_SpectraCount, df_Intensity
+
+
+def study_parameter_optimization(dataset_IDs=None, processes=None, plot=False):
+    """
+    parameter_optimization of every dataset of a study, concurrently in a process pool, each
+    seeded with grid_search_cutoffs.
+    :param dataset_IDs: datasets to optimize, by default all with a forward peptide
+        identification file in Results/Data/ (see write_dataset_files)
+    :param processes: pool size, by default the number of cores
+    :param plot: also plot every fit
+    :return: the df_Metadata rows of all datasets as one table, and the
+        parameter_optimization results of every dataset in dataset_IDs order
+    """
+    if dataset_IDs is None:
+        suffix = "_forward_peptide_identification."
+        # the IDs are ints everywhere else, e.g. in the Dataset_ID column
+        dataset_IDs = sorted(
+            {
+                int(os.path.basename(file).rsplit(suffix, 1)[0])
+                for file in glob.glob("Results/Data/*" + suffix + "*")
+            }
+        )
+
+    with multiprocessing.Pool(processes) as pool:
+        # one dataset per task: each is a full optimization
+        results = pool.map(
+            partial(parameter_optimization, plot=plot, grid_search=True),
+            dataset_IDs,
+            chunksize=1,
+        )
+
+    df_study_metadata = pd.concat([result[0] for result in results], ignore_index=True)
+    return df_study_metadata, results
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the src package is imported from the repository root, as setup.py installs it
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
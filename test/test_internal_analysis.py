@@ -0,0 +1,391 @@
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import gaussian_kde
+
+from src.post_processing import internal_analysis
+from src.post_processing.internal_analysis import (
+    InternalAnalysis,
+    PeptideCutoffIndex,
+    grid_search_cutoffs,
+    kde_mode,
+    parameter_optimization,
+    read_dataset_file,
+    study_parameter_optimization,
+    write_dataset_files,
+)
+
+RESULTANT_COLUMNS = [
+    "JobNum", "Dataset_x", "Dataset_y", "Scan", "Protein", "Peptide", "NTT", "DelM", "DelM_PPM",
+    "StatMomentsArea", "PeakMaxIntensity", "MSGFDB_SpecEValue", "EValue", "QValue", "PepQValue",
+]
+
+
+def legacy_findproteinname(s):
+    p1 = re.compile(r"^Contaminant_")
+    p2 = re.compile(r"^XXX_Contaminant_")
+    p3 = re.compile(r"^XXX_")
+    if p1.search(s) is not None:
+        return "None"
+    elif p2.search(s) is not None:
+        return "None"
+    elif p3.search(s) is not None:
+        return "Reversed"
+    else:
+        return "Forward"
+
+
+def legacy_cleansequence(s):
+    p = re.compile(r"\.(?P<cleanseq>[A-Z\*@#]+)\.")
+    m = p.search(s)
+    return m.group("cleanseq")
+
+
+def legacy_process_data(parent_folder):
+    """
+    InternalAnalysis.process_data before it was vectorized, with the per row regex functions
+    called as plain functions, and the per dataset masking loop.
+    """
+    data = pd.read_table(parent_folder + "resultants_df.txt")[RESULTANT_COLUMNS]
+    data.rename(columns={"Dataset_x": "Dataset", "Dataset_y": "Dataset_ID", "JobNum": "Job"}, inplace=True)
+    data["Protein_Type"] = data["Protein"].apply(legacy_findproteinname)
+    data["Clean Peptide Sequence"] = data["Peptide"].apply(legacy_cleansequence)
+    data["SpecID"] = data.apply(lambda row: str(row["Dataset_ID"]) + "_" + str(row["Scan"]), axis=1)
+
+    df_mapping = data[data["Protein_Type"] == "Forward"][["Protein", "Peptide", "Clean Peptide Sequence"]].copy()
+    df_mapping.drop_duplicates(inplace=True)
+    df_new = df_mapping[["Protein", "Clean Peptide Sequence"]].copy()
+    df_new.drop_duplicates(inplace=True)
+    df_redundancy = df_new.groupby(["Clean Peptide Sequence"]).count()
+    df_redundancy.reset_index(inplace=True)
+    df_redundancy.rename(columns={"Protein": "Clean Peptide Sequence Redundancy"}, inplace=True)
+    df_mapping = df_mapping.merge(df_redundancy, how="left", on=["Clean Peptide Sequence"])
+    df_mapping.to_csv("Results/protein_peptide_map.csv", index=False)
+
+    df_ids = data[["Dataset", "Job", "Dataset_ID"]].copy()
+    df_ids.drop_duplicates(inplace=True)
+    df_ids.to_csv("Results/dataset_job_map.csv", index=False)
+
+    del data["Protein"]
+    del data["Dataset"]
+    del data["Job"]
+    data.drop_duplicates(inplace=True)
+    data_cleaned_forward = data[data["Protein_Type"] == "Forward"].copy()
+    del data_cleaned_forward["Protein_Type"]
+    data_cleaned_forward.drop_duplicates(inplace=True)
+    data_cleaned_reversed = data[data["Protein_Type"] == "Reversed"].copy()
+    del data_cleaned_reversed["Protein_Type"]
+    data_cleaned_reversed.drop_duplicates(inplace=True)
+
+    dataset_list = data_cleaned_forward["Dataset_ID"].unique().tolist()
+    for i in range(len(dataset_list)):
+        df_ff = data_cleaned_forward[data_cleaned_forward["Dataset_ID"] == dataset_list[i]].copy()
+        df_ff.to_csv("Results/Data/" + str(dataset_list[i]) + "_forward_peptide_identification.csv", index=False)
+        df_rr = data_cleaned_reversed[data_cleaned_reversed["Dataset_ID"] == dataset_list[i]].copy()
+        df_rr.to_csv("Results/Data/" + str(dataset_list[i]) + "_reversed_peptide_identification.csv", index=False)
+
+
+def legacy_pep_counts(data_f, data_r, ppm_shift, params):
+    """
+    Peptide counts of PepFDR before PeptideCutoffIndex: filter the frames and count the
+    distinct clean sequences.
+    """
+    delppm1, delppm2, log10_specprob = params
+    counts = []
+    for data in [data_f, data_r]:
+        df = data[
+            (data["DelM_PPM"] < ppm_shift + delppm1)
+            & (data["DelM_PPM"] > ppm_shift - delppm2)
+            & (data["MSGFDB_SpecEValue"] < 10 ** log10_specprob)
+        ].copy()
+        counts.append(df["Clean Peptide Sequence"].unique().size)
+    return counts
+
+
+def pep_fdr_objective(f_pep, r_pep):
+    fdr_pep = 1 if (f_pep == 0) & (r_pep == 0) else r_pep / (f_pep + r_pep)
+    return 1 / (0.050001 - fdr_pep) * (-f_pep)
+
+
+def make_resultants(seed, n_datasets=5, n=3000):
+    """
+    Synthetic resultants_df.txt rows: forward, reversed and contaminant PSMs of several
+    datasets, with some rows repeated as the protein joins repeat them.
+    """
+    rng = np.random.default_rng(seed)
+    sequences = ["".join(rng.choice(list("ACDEFGHIKLMNPQRSTVWY"), rng.integers(6, 12))) for _ in range(150)]
+    sequences = [s[:3] + "*" + s[3:] if i % 7 == 0 else s for i, s in enumerate(sequences)]
+    dataset_ids = rng.choice(np.arange(1000, 1000 + n_datasets), n)
+    kind = rng.choice(["forward", "reversed", "contaminant", "reversed_contaminant"], n, p=[0.6, 0.3, 0.05, 0.05])
+    protein_number = rng.integers(0, 60, n)
+    protein = np.select(
+        [kind == "forward", kind == "reversed", kind == "contaminant"],
+        [np.char.add("prot", protein_number.astype(str)), np.char.add("XXX_prot", protein_number.astype(str)),
+         np.char.add("Contaminant_prot", protein_number.astype(str))],
+        np.char.add("XXX_Contaminant_prot", protein_number.astype(str)),
+    )
+    peptide = ["K." + sequences[i] + ".R" for i in rng.integers(0, len(sequences), n)]
+    correct = (kind == "forward") & (rng.random(n) < 0.7)
+    data = pd.DataFrame({
+        "JobNum": dataset_ids + 5000,
+        "Dataset_x": np.char.add("dataset_", dataset_ids.astype(str)),
+        "Dataset_y": dataset_ids,
+        "Scan": rng.integers(1, 20000, n),
+        "Protein": protein,
+        "Peptide": peptide,
+        "NTT": rng.integers(0, 3, n),
+        "DelM": rng.normal(0, 0.01, n),
+        "DelM_PPM": np.where(correct, rng.normal(2, 2, n), rng.uniform(-20, 20, n)),
+        "StatMomentsArea": 10 ** rng.uniform(3, 9, n),
+        "PeakMaxIntensity": 10 ** rng.uniform(3, 9, n),
+        "MSGFDB_SpecEValue": np.where(correct, 10 ** rng.uniform(-20, -10, n), 10 ** rng.uniform(-12, -6, n)),
+        "EValue": 10 ** rng.uniform(-10, 1, n),
+        "QValue": rng.random(n),
+        "PepQValue": rng.random(n),
+    })
+    # the last dataset has no reversed PSMs, so its reversed file has only a header
+    data = data[~((data["Dataset_y"] == dataset_ids.max()) & (kind == "reversed"))]
+    repeated = data.sample(frac=0.1, random_state=seed)
+    return pd.concat([data, repeated], ignore_index=True)
+
+
+def make_dataset(seed, n_f=1500, n_r=500, n_peptides=300):
+    """
+    Forward and reversed PSMs of one dataset, as parameter_optimization reads them.
+    """
+    rng = np.random.default_rng(seed)
+
+    def psms(n, correct):
+        peptides = rng.integers(0, n_peptides, n).astype(str)
+        return pd.DataFrame({
+            "SpecID": np.char.add("1_", rng.integers(1, 20000, n).astype(str)),
+            "Dataset_ID": 1,
+            "Scan": rng.integers(1, 20000, n),
+            "Peptide": np.char.add(np.char.add("K.PEP", peptides), ".R"),
+            "Clean Peptide Sequence": np.char.add("PEP", peptides),
+            "MSGFDB_SpecEValue": np.where(correct, 10 ** rng.uniform(-20, -10, n), 10 ** rng.uniform(-12, -6, n)),
+            "StatMomentsArea": 10 ** rng.uniform(3, 9, n),
+            "DelM_PPM": np.where(correct, rng.normal(2, 2, n), rng.uniform(-20, 20, n)),
+        })
+
+    return psms(n_f, rng.random(n_f) < 0.7), psms(n_r, np.zeros(n_r, dtype=bool))
+
+
+@pytest.fixture
+def results_folder(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("Results/Data")
+    os.makedirs("Results/Plots")
+    return tmp_path
+
+
+@pytest.mark.parametrize("seed", range(2))
+def test_process_data_matches_legacy(tmp_path, monkeypatch, seed):
+    make_resultants(seed).to_csv(tmp_path / "resultants_df.txt", sep="\t", index=False)
+    parent_folder = str(tmp_path) + "/"
+    outputs = {}
+    for name, process in [("legacy", legacy_process_data), ("new", lambda folder: InternalAnalysis(folder).process_data())]:
+        os.makedirs(tmp_path / name / "Results" / "Data")
+        monkeypatch.chdir(tmp_path / name)
+        process(parent_folder)
+        outputs[name] = {
+            os.path.relpath(os.path.join(folder, file), tmp_path / name): open(os.path.join(folder, file), "rb").read()
+            for folder, _, files in os.walk("Results") for file in files
+        }
+
+    assert len(outputs["new"]) == 2 + 2 * 5
+    assert outputs["new"] == outputs["legacy"]
+
+
+def test_process_data_parquet(tmp_path, monkeypatch):
+    make_resultants(0).to_csv(tmp_path / "resultants_df.txt", sep="\t", index=False)
+    frames = {}
+    for output_format in ["csv", "parquet"]:
+        os.makedirs(tmp_path / output_format / "Results" / "Data")
+        monkeypatch.chdir(tmp_path / output_format)
+        InternalAnalysis(str(tmp_path) + "/").process_data(output_format)
+        frames[output_format] = [read_dataset_file(dataset_ID, name) for dataset_ID in range(1000, 1005)
+                                 for name in ["forward_peptide_identification", "reversed_peptide_identification"]]
+
+    for csv_df, parquet_df in zip(frames["csv"], frames["parquet"]):
+        # an empty csv reads back with an object index
+        pd.testing.assert_frame_equal(parquet_df, csv_df, check_dtype=False, check_index_type=False)
+
+
+def test_process_data_peptide_without_flanking_residues(tmp_path, monkeypatch):
+    # the per row regex raised on these; the column-wise extract leaves them NaN
+    resultants = make_resultants(0)
+    resultants.loc[0, ["Protein", "Peptide"]] = ["prot1", "PEPTIDE"]
+    resultants.to_csv(tmp_path / "resultants_df.txt", sep="\t", index=False)
+    with pytest.raises(AttributeError):
+        legacy_cleansequence("PEPTIDE")
+
+    os.makedirs(tmp_path / "Results" / "Data")
+    monkeypatch.chdir(tmp_path)
+    InternalAnalysis(str(tmp_path) + "/").process_data()
+    data_f = read_dataset_file(resultants.loc[0, "Dataset_y"], "forward_peptide_identification")
+    assert data_f.loc[data_f["Peptide"] == "PEPTIDE", "Clean Peptide Sequence"].isna().all()
+    assert data_f.loc[data_f["Peptide"] != "PEPTIDE", "Clean Peptide Sequence"].notna().all()
+
+
+def test_write_dataset_files_empty_dataset(results_folder):
+    data = pd.DataFrame({"Dataset_ID": [1, 1, 3], "Scan": [10, 11, 12]})
+    write_dataset_files(data, [1, 2, 3], "forward_peptide_identification")
+    assert read_dataset_file(1, "forward_peptide_identification")["Scan"].tolist() == [10, 11]
+    assert read_dataset_file(2, "forward_peptide_identification").columns.tolist() == ["Dataset_ID", "Scan"]
+    assert read_dataset_file(2, "forward_peptide_identification").empty
+
+
+@pytest.mark.parametrize("newer", ["csv", "parquet"])
+def test_read_dataset_file_reads_newer_file(results_folder, newer):
+    older = "parquet" if newer == "csv" else "csv"
+    write_dataset_files(pd.DataFrame({"Dataset_ID": [1], "Run": [older]}), [1], "forward_peptide_identification", older)
+    write_dataset_files(pd.DataFrame({"Dataset_ID": [1], "Run": [newer]}), [1], "forward_peptide_identification", newer)
+    os.utime("Results/Data/1_forward_peptide_identification." + older, (1000000000, 1000000000))
+    os.utime("Results/Data/1_forward_peptide_identification." + newer, (1000000100, 1000000100))
+    assert read_dataset_file(1, "forward_peptide_identification")["Run"].tolist() == [newer]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_kde_mode_matches_gaussian_kde(seed):
+    rng = np.random.default_rng(seed)
+    values = np.concatenate([rng.normal(rng.uniform(-3, 3), rng.uniform(0.5, 2), 2000), rng.uniform(-10, 10, 500)])
+    kde = gaussian_kde(values)
+    bandwidth = kde.factor * values.std(ddof=1)
+    lo, hi = values.min() - 3 * bandwidth, values.max() + 3 * bandwidth
+
+    # the 100 point grid seaborn's distplot drew, which parameter_optimization read the mode from
+    legacy_grid = np.linspace(lo, hi, 100)
+    legacy_mode = legacy_grid[np.argmax(kde(legacy_grid))]
+    fine_grid = np.linspace(lo, hi, 20000)
+    fine_mode = fine_grid[np.argmax(kde(fine_grid))]
+
+    mode = kde_mode(values)
+    assert abs(mode - fine_mode) <= 2 * (hi - lo) / 4095
+    assert abs(mode - legacy_mode) <= (hi - lo) / 99
+
+
+def test_kde_mode_degenerate():
+    assert kde_mode([2.5]) == 2.5
+    assert kde_mode([1.0, 1.0, np.nan]) == 1.0
+    with pytest.raises(ValueError):
+        kde_mode([np.nan])
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_count_peptides_matches_legacy(seed):
+    data_f, data_r = make_dataset(seed)
+    index_f, index_r = PeptideCutoffIndex(data_f), PeptideCutoffIndex(data_r)
+    rng = np.random.default_rng(seed)
+    ppm_shift = rng.normal(2, 1)
+    params = np.column_stack([rng.uniform(0, 15, 300), rng.uniform(0, 15, 300), rng.uniform(-20, -5, 300)])
+    # cutoffs exactly on PSM values, where < and > matter
+    on_values = data_f.sample(50, random_state=seed)
+    params[:50, 0] = on_values["DelM_PPM"] - ppm_shift
+    params[50:100, 1] = ppm_shift - on_values["DelM_PPM"]
+    params[100:150, 2] = np.log10(on_values["MSGFDB_SpecEValue"])
+
+    for delppm1, delppm2, log10_specprob in params:
+        cutoffs = (ppm_shift - delppm2, ppm_shift + delppm1, 10 ** log10_specprob)
+        counts = [index_f.count_peptides(*cutoffs), index_r.count_peptides(*cutoffs)]
+        assert counts == legacy_pep_counts(data_f, data_r, ppm_shift, (delppm1, delppm2, log10_specprob))
+
+
+def test_count_peptides_skips_nan_sequences():
+    data_f, _ = make_dataset(0)
+    data_f.loc[::10, "Clean Peptide Sequence"] = np.nan
+    index_f = PeptideCutoffIndex(data_f)
+    for spec_e_value in [1e-15, 1e-10, 1e-6]:
+        df = data_f[(data_f["DelM_PPM"] > -5) & (data_f["DelM_PPM"] < 8) & (data_f["MSGFDB_SpecEValue"] < spec_e_value)]
+        assert index_f.count_peptides(-5, 8, spec_e_value) == df["Clean Peptide Sequence"].nunique()
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_best_spec_e_values(seed):
+    data_f, _ = make_dataset(seed)
+    data_f.loc[::10, "Clean Peptide Sequence"] = np.nan
+    index_f = PeptideCutoffIndex(data_f)
+    for low, high in [(-5, 8), (-20, 20), (1.5, 1.6)]:
+        df = data_f[(data_f["DelM_PPM"] > low) & (data_f["DelM_PPM"] < high)]
+        best = index_f.best_spec_e_values(low, high)
+        assert best.tolist() == sorted(df.groupby("Clean Peptide Sequence")["MSGFDB_SpecEValue"].min().tolist())
+        for spec_e_value in np.append(best, [0, 1e-12, 1]):
+            assert np.searchsorted(best, spec_e_value) == index_f.count_peptides(low, high, spec_e_value)
+
+
+@pytest.mark.parametrize("seed", range(2))
+def test_grid_search_cutoffs_is_grid_minimum(seed):
+    data_f, data_r = make_dataset(seed, n_f=400, n_r=150, n_peptides=120)
+    index_f, index_r = PeptideCutoffIndex(data_f), PeptideCutoffIndex(data_r)
+    ppm_shift = 1.7
+    params = grid_search_cutoffs(index_f, index_r, ppm_shift)
+    best = pep_fdr_objective(*legacy_pep_counts(data_f, data_r, ppm_shift, params))
+
+    # on random grid windows, no SpecEValue cutoff at or just above a PSM value does better
+    rng = np.random.default_rng(seed)
+    cutoffs = np.union1d(data_f["MSGFDB_SpecEValue"], data_r["MSGFDB_SpecEValue"])
+    cutoffs = np.log10(np.concatenate([cutoffs, np.nextafter(cutoffs, np.inf), [1]]))
+    for _ in range(8):
+        delppm1 = rng.choice(np.arange(5, 15.25, 0.5))
+        delppm2 = rng.choice(np.arange(5, 20 - delppm1 + 0.25, 0.5))
+        for log10_specprob in cutoffs[rng.choice(len(cutoffs), 60, replace=False)]:
+            counts = legacy_pep_counts(data_f, data_r, ppm_shift, (delppm1, delppm2, log10_specprob))
+            assert pep_fdr_objective(*counts) >= best
+
+
+def test_grid_search_cutoffs_without_candidates():
+    data_f, data_r = make_dataset(0, n_f=50, n_r=20)
+    data_f["MSGFDB_SpecEValue"] = 0.0
+    data_r["MSGFDB_SpecEValue"] = np.nan
+    assert grid_search_cutoffs(PeptideCutoffIndex(data_f), PeptideCutoffIndex(data_r), 0) is None
+    # every PSM outside of the widest window
+    data_f, data_r = make_dataset(0, n_f=50, n_r=20)
+    assert grid_search_cutoffs(PeptideCutoffIndex(data_f), PeptideCutoffIndex(data_r), 100) is None
+
+
+def write_dataset(dataset_ID, data_f, data_r):
+    data_f, data_r = data_f.assign(Dataset_ID=dataset_ID), data_r.assign(Dataset_ID=dataset_ID)
+    write_dataset_files(data_f, [dataset_ID], "forward_peptide_identification")
+    write_dataset_files(data_r, [dataset_ID], "reversed_peptide_identification")
+
+
+@pytest.mark.parametrize("grid_search", [False, True])
+def test_parameter_optimization_counts_without_nan(results_folder, grid_search):
+    data_f, data_r = make_dataset(0)
+    # peptides without flanking residues, see test_process_data_peptide_without_flanking_residues
+    data_f.loc[:30, "Clean Peptide Sequence"] = np.nan
+    data_f.loc[:30, ["DelM_PPM", "MSGFDB_SpecEValue"]] = [2.0, 1e-30]
+    write_dataset(1, data_f, data_r)
+
+    df_metadata, df_specid_f, df_specid_r = parameter_optimization(1, plot=False, grid_search=grid_search)[:3]
+    assert df_metadata["Dataset_ID"].tolist() == [1]
+    cutoffs = df_metadata.loc[0, ["PPM cutoff left", "PPM cutoff right", "SpecProb cutoff"]].tolist()
+    f_pep = PeptideCutoffIndex(data_f).count_peptides(*cutoffs)
+    assert df_metadata["Peptide forward"].tolist() == [f_pep]
+    assert df_metadata["Peptide forward"].tolist() == [df_specid_f["Clean Peptide Sequence"].nunique()]
+    # unique().size counted NaN as one more peptide
+    assert df_specid_f["Clean Peptide Sequence"].unique().size == f_pep + 1
+    assert df_metadata["Peptide reverse"].tolist() == [df_specid_r["Clean Peptide Sequence"].nunique()]
+
+
+def test_parameter_optimization_falls_back_without_grid_cutoffs(results_folder, monkeypatch):
+    write_dataset(1, *make_dataset(0))
+    expected = parameter_optimization(1, plot=False)
+    monkeypatch.setattr(internal_analysis, "grid_search_cutoffs", lambda *args: None)
+    result = parameter_optimization(1, plot=False, grid_search=True)
+    for expected_df, df in zip(expected, result):
+        pd.testing.assert_frame_equal(df, expected_df)
+
+
+def test_study_parameter_optimization(results_folder):
+    for dataset_ID in [3, 12]:
+        write_dataset(dataset_ID, *make_dataset(dataset_ID))
+
+    df_study_metadata, results = study_parameter_optimization(processes=2)
+    assert df_study_metadata["Dataset_ID"].tolist() == [3, 12]
+    for dataset_ID, result in zip([3, 12], results):
+        for expected_df, df in zip(parameter_optimization(dataset_ID, plot=False, grid_search=True), result):
+            pd.testing.assert_frame_equal(df, expected_df)
@@ -0,0 +1,297 @@
+import argparse
+import csv
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ficus_analysis import DataOutputtable
+
+# Benchmark of the report generation stage (DataOutputtable) on synthetic inputs.
+# Inputs are generated once per scale into --workdir and reused by later runs.
+
+AMINO_ACIDS = np.frombuffer(b"ACDEFGHIKLMNPQRSTVWY", dtype=np.uint8)
+
+# MSGF+ syn columns followed by the MASIC SICstats columns, as results_merge.py writes them.
+RESULTANT_COLUMNS = [
+    "ResultID", "Scan", "FragMethod", "SpecIndex", "Charge", "PrecursorMZ", "DelM", "DelM_PPM", "MH",
+    "Peptide", "Protein", "NTT", "DeNovoScore", "MSGFScore", "MSGFDB_SpecEValue", "Rank_MSGFDB_SpecEValue",
+    "EValue", "QValue", "PepQValue", "IsotopeError",
+    "ElutionTime", "ScanType", "TotalIonIntensity", "BasePeakIntensity", "BasePeakMZ", "Optimal_Scan_Number",
+    "PeakMaxIntensity", "PeakSignalToNoiseRatio", "FWHMInScans", "PeakArea", "ParentIonIntensity",
+    "ParentIonMZ", "StatMomentsArea", "PeakScanStart", "PeakScanEnd", "PeakWidthMinutes",
+]
+
+RESULT_COLUMNS = [
+    "date", "psms", "resultant_rows", "proteins", "peptides", "decoy_fraction", "degeneracy",
+    "threshold", "did_split", "chunksize", "load_seconds", "gen_reports_seconds", "total_seconds", "peak_rss_bytes",
+    "python", "pandas", "numpy",
+]
+
+def random_sequences(rng: np.random.Generator, n: int, min_length: int, max_length: int) -> np.ndarray:
+    """
+    n random amino acid sequences with lengths uniform in [min_length, max_length].
+    """
+    lengths = rng.integers(min_length, max_length + 1, n)
+    residues = AMINO_ACIDS[rng.integers(0, len(AMINO_ACIDS), lengths.sum())].tobytes().decode()
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    return np.array([residues[start:end] for start, end in zip(starts.tolist(), ends.tolist())], dtype=object)
+
+def protein_names(n: int, n_contaminants: int) -> np.ndarray:
+    """
+    JGI style gene ids, the last n_contaminants of them named like the contaminant proteins
+    appended to the search fasta.
+    """
+    ids = pd.Series(np.arange(n - n_contaminants))
+    contig = (ids // 40 + 1).astype(str).str.zfill(7)
+    start = ids % 40 * 900 + 1
+    names = ("Ga0482109_" + contig + "_" + start.astype(str) + "_" + (start + 899).astype(str)).to_numpy(dtype=object)
+    contaminants = np.array([f"Contaminant_K2C{i}_HUMAN" for i in range(n_contaminants)], dtype=object)
+    return np.concatenate([names, contaminants])
+
+def generate_inputs(
+    workdir,
+    psms: int,
+    decoy_fraction: float = 0.1,
+    degeneracy: float = 1.5,
+    annotated_fraction: float = 0.9,
+    seed: int = 0,
+    chunk_size: int = 1_000_000,
+) -> dict:
+    """
+    Writes a synthetic resultant tsv, ProteinDigestionSimulator fasta txt and JGI functional
+    annotation gff to workdir. Files already there are reused.
+
+    :param psms: number of spectra. The resultant has one row per spectrum and protein, so
+        about psms * degeneracy rows.
+    :param decoy_fraction: fraction of spectra matched to a decoy (XXX_) protein.
+    :param degeneracy: mean number of proteins a target peptide maps to.
+    :param annotated_fraction: fraction of proteins with a CDS feature in the gff.
+    :return: dict with the paths of the inputs and the size of the dataset.
+    """
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+    inputs = {
+        "resultant_file": workdir / "resultant.tsv",
+        "fasta_txt_file": workdir / "fasta.txt",
+        "gff_file": workdir / "functional_annotation.gff",
+        "info_file": workdir / "info.tsv",
+    }
+    if inputs["info_file"].exists():
+        info = pd.read_csv(inputs["info_file"], sep="\t").to_dict("records")[0]
+        return {**inputs, **info}
+
+    rng = np.random.default_rng(seed)
+    n_proteins = max(psms // 25, 100)
+    n_peptides = max(psms // 4, 100)
+    n_contaminants = min(100, n_proteins // 10)
+    proteins = protein_names(n_proteins, n_contaminants)
+    peptides = random_sequences(rng, n_peptides, 7, 30)
+
+    # peptide -> proteins in CSR form: the proteins of peptide i are
+    # peptide_proteins[peptide_offsets[i]:peptide_offsets[i + 1]].
+    peptide_degeneracy = 1 + rng.poisson(degeneracy - 1, n_peptides)
+    peptide_offsets = np.concatenate([[0], np.cumsum(peptide_degeneracy)])
+    peptide_proteins = rng.integers(0, n_proteins, peptide_offsets[-1])
+
+    result_id = 0
+    with open(inputs["resultant_file"], "w") as fh:
+        fh.write("\t".join(RESULTANT_COLUMNS) + "\n")
+        for start in range(0, psms, chunk_size):
+            n = min(chunk_size, psms - start)
+            scans = np.arange(start, start + n) + 1
+            is_decoy = rng.random(n) < decoy_fraction
+            # a few peptides are identified much more often than the rest.
+            peptide_index = (n_peptides * rng.random(n) ** 3).astype(np.int64)
+            counts = np.where(is_decoy, 1, peptide_degeneracy[peptide_index])
+
+            # one row per spectrum and protein.
+            row_psm = np.repeat(np.arange(n), counts)
+            within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            row_peptide = peptide_index[row_psm]
+            row_decoy = is_decoy[row_psm]
+            row_protein = np.where(
+                row_decoy,
+                rng.integers(0, n_proteins, len(row_psm)),
+                peptide_proteins[peptide_offsets[row_peptide] + within],
+            )
+            protein = pd.Series(proteins[row_protein])
+            protein[row_decoy] = "XXX_" + protein[row_decoy]
+            sequence = pd.Series(peptides[row_peptide])
+            sequence[row_decoy] = sequence[row_decoy].str[::-1]
+
+            spec_e_value = np.where(is_decoy, 10 ** rng.uniform(-13, -7, n), 10 ** rng.uniform(-24, -8, n))
+            q_value = np.where(is_decoy, rng.uniform(0.01, 1, n), rng.uniform(0, 0.08, n))
+            precursor_mz = rng.uniform(300, 1500, n)
+            stat_moments_area = np.where(rng.random(n) < 0.1, 0.0, rng.lognormal(16, 2, n))
+            m = len(row_psm)
+            chunk_df = pd.DataFrame({
+                "ResultID": np.arange(result_id, result_id + m) + 1,
+                "Scan": scans[row_psm],
+                "FragMethod": "HCD",
+                "SpecIndex": scans[row_psm],
+                "Charge": rng.integers(1, 5, n)[row_psm],
+                "PrecursorMZ": precursor_mz[row_psm],
+                "DelM": rng.uniform(-0.01, 0.01, n)[row_psm],
+                "DelM_PPM": rng.uniform(-10, 10, n)[row_psm],
+                "MH": (precursor_mz * 2)[row_psm],
+                "Peptide": ("K." + sequence + ".R").to_numpy(),
+                "Protein": protein.to_numpy(),
+                "NTT": 2,
+                "DeNovoScore": rng.integers(1, 300, n)[row_psm],
+                "MSGFScore": rng.integers(-50, 300, n)[row_psm],
+                "MSGFDB_SpecEValue": spec_e_value[row_psm],
+                "Rank_MSGFDB_SpecEValue": 1,
+                "EValue": (spec_e_value * 1e5)[row_psm],
+                "QValue": q_value[row_psm],
+                "PepQValue": (q_value / 2)[row_psm],
+                "IsotopeError": 0,
+                "ElutionTime": (scans / 500.0)[row_psm],
+                "ScanType": "HMSn",
+                "TotalIonIntensity": rng.lognormal(18, 1, n)[row_psm],
+                "BasePeakIntensity": rng.lognormal(16, 1, n)[row_psm],
+                "BasePeakMZ": rng.uniform(100, 1500, n)[row_psm],
+                "Optimal_Scan_Number": (scans - 3)[row_psm],
+                "PeakMaxIntensity": rng.lognormal(15, 2, n)[row_psm],
+                "PeakSignalToNoiseRatio": rng.uniform(1, 500, n)[row_psm],
+                "FWHMInScans": rng.integers(1, 40, n)[row_psm],
+                "PeakArea": rng.lognormal(17, 2, n)[row_psm],
+                "ParentIonIntensity": rng.lognormal(15, 1, n)[row_psm],
+                "ParentIonMZ": precursor_mz[row_psm],
+                "StatMomentsArea": stat_moments_area[row_psm],
+                "PeakScanStart": (scans - 10)[row_psm],
+                "PeakScanEnd": (scans + 10)[row_psm],
+                "PeakWidthMinutes": rng.uniform(0, 1, n)[row_psm],
+            })
+            chunk_df.to_csv(fh, sep="\t", index=False, header=False)
+            result_id += m
+
+    fasta_txt_df = pd.DataFrame({
+        "ProteinName": proteins,
+        "Description": "hypothetical protein",
+        "Sequence": random_sequences(rng, n_proteins, 100, 500),
+    })
+    fasta_txt_df.to_csv(inputs["fasta_txt_file"], sep="\t", index=False)
+
+    annotated = proteins[: n_proteins - n_contaminants]
+    annotated = annotated[rng.random(len(annotated)) < annotated_fraction]
+    n_annotated = len(annotated)
+    attributes = "ID=" + pd.Series(annotated) + ";translation_table=11;start_type=ATG"
+    for tag, value, fraction in [
+        ("product", "hypothetical protein ", 0.8),
+        ("pfam", "pfam", 0.5),
+        ("ko", "KO:K", 0.4),
+        ("ec_number", "EC:1.1.1.", 0.2),
+        ("cog", "COG", 0.4),
+    ]:
+        has_tag = rng.random(n_annotated) < fraction
+        values = value + pd.Series(rng.integers(1, 10000, n_annotated)).astype(str).str.zfill(5)
+        attributes[has_tag] = attributes[has_tag] + f";{tag}=" + values[has_tag]
+    gff_df = pd.DataFrame({
+        "seq_id": "Ga0482109_" + pd.Series(annotated).str.split("_").str[1],
+        "source": "Prodigal v2.6.3",
+        "type": np.where(rng.random(n_annotated) < 0.02, "tRNA", "CDS"),
+        "start": 1,
+        "end": 900,
+        "score": ".",
+        "strand": "+",
+        "phase": "0",
+        "attributes": attributes,
+    })
+    with open(inputs["gff_file"], "w") as fh:
+        fh.write("##gff-version 3\n")
+        gff_df.to_csv(fh, sep="\t", index=False, header=False)
+
+    info = {
+        "psms": psms,
+        "resultant_rows": result_id,
+        "proteins": n_proteins,
+        "peptides": n_peptides,
+        "decoy_fraction": decoy_fraction,
+        "degeneracy": degeneracy,
+    }
+    pd.DataFrame([info]).to_csv(inputs["info_file"], sep="\t", index=False)
+    return {**inputs, **info}
+
+def time_gen_reports(inputs: dict, threshold: str, did_split: bool, chunksize=None) -> dict:
+    """
+    Loads inputs and generates their reports, run in a fresh process so peak RSS
+    belongs to this scale only.
+    """
+    start = time.perf_counter()
+    data_obj = DataOutputtable(
+        inputs["gff_file"],
+        inputs["resultant_file"],
+        inputs["fasta_txt_file"],
+        threshold,
+        "benchmark",
+        "benchmark",
+        "benchmark",
+        did_split,
+        False,
+        drop_intermediates=True,
+        resultant_chunksize=chunksize,
+    )
+    loaded = time.perf_counter()
+    data_obj.gen_reports()
+    end = time.perf_counter()
+    return {
+        "load_seconds": loaded - start,
+        "gen_reports_seconds": end - loaded,
+        "total_seconds": end - start,
+        # ru_maxrss is in kilobytes on linux.
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Times DataOutputtable.gen_reports on synthetic inputs of increasing size')
+    parser.add_argument('--scales', type=str, default='1e4,1e5,1e6,1e7', help='Comma separated PSM counts')
+    parser.add_argument('--workdir', type=str, default='benchmark_inputs', help='Where generated inputs are kept')
+    parser.add_argument('--out', type=str, default='benchmark_results.tsv', help='Results file, rows are appended')
+    parser.add_argument('--decoy-fraction', type=float, default=0.1)
+    parser.add_argument('--degeneracy', type=float, default=1.5, help='Mean number of proteins per peptide')
+    parser.add_argument('--threshold', type=str, default='0.05', help='QValue, or SpecEValue with --did-split')
+    parser.add_argument('--did-split', action='store_true')
+    parser.add_argument('--chunksize', type=int, default=None, help='Stream the resultant in chunks of this many rows')
+    parser.add_argument('--repeat', type=int, default=1, help='Timed runs per scale')
+    parser.add_argument('--seed', type=int, default=0)
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+
+    out_file = Path(args.out)
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    write_header = not out_file.exists()
+    with open(out_file, 'a', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=RESULT_COLUMNS, delimiter='\t')
+        if write_header:
+            writer.writeheader()
+        for psms in [int(float(scale)) for scale in args.scales.split(',')]:
+            workdir = Path(args.workdir) / f"psms_{psms}_decoy_{args.decoy_fraction}_degeneracy_{args.degeneracy}_seed_{args.seed}"
+            inputs = generate_inputs(workdir, psms, args.decoy_fraction, args.degeneracy, seed=args.seed)
+            for _ in range(args.repeat):
+                with multiprocessing.get_context('spawn').Pool(1) as pool:
+                    timing = pool.apply(time_gen_reports, (inputs, args.threshold, args.did_split, args.chunksize))
+                row = {
+                    "date": datetime.now().isoformat(timespec='seconds'),
+                    **{key: inputs[key] for key in ["psms", "resultant_rows", "proteins", "peptides", "decoy_fraction", "degeneracy"]},
+                    "threshold": args.threshold,
+                    "did_split": args.did_split,
+                    "chunksize": args.chunksize,
+                    **timing,
+                    "python": platform.python_version(),
+                    "pandas": pd.__version__,
+                    "numpy": np.__version__,
+                }
+                writer.writerow(row)
+                fp.flush()
+                sys.stdout.write(f"{psms}\t{timing['total_seconds']:.2f}s\t{timing['peak_rss_bytes'] / 2**20:.0f}MiB\n")
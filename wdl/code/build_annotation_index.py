@@ -0,0 +1,21 @@
+import argparse
+import sys
+
+from ficus_analysis import build_annotation_index
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Pre-builds the annotation index ficus_analysis.py loads instead of parsing the gff'
+    )
+    parser.add_argument('--gff', type=str, nargs='+', required=True, help='Annotation gff file(s) to index')
+    parser.add_argument('--cache-dir', type=str, required=True, help='Directory to write the index to (ANNOTATION_INDEX_DIR)')
+    parser.add_argument('--metagenome-free', action='store_true', help='Index Kaiko gffs for metagenome free analysis')
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+
+    for gff_file in args.gff:
+        index_file = build_annotation_index(gff_file, args.cache_dir, args.metagenome_free)
+        sys.stdout.write(f"{gff_file}\t{index_file}\n")
@@ -1,58 +1,106 @@
 import argparse
-import csv
 from decimal import *
 from collections import namedtuple
-from functools import partial
 import json
 import sys
 
+import numpy as np
+import pandas as pd
+
 FdrResult = namedtuple('FdrResult', 'SpecEValue FDR')
 
+# FdrExact result when no SpecEValue reaches the FDR: a threshold no PSM passes, with no PSMs no FDR.
+NO_THRESHOLD = FdrResult(Decimal(0), Decimal(0))
+
+# SpecEValue of every first hit as float64 and whether its protein is a decoy, in file order.
+# decimal_spec_e_values caches the exact SpecEValues read back from the file, by row, see
+# FdrSearchStrategy.decimal_spec_e_values.
+FirstHits = namedtuple('FirstHits', 'file spec_e_values is_decoy decimal_spec_e_values')
+
+CHUNK_SIZE = 1000000
+
 class FdrSearchStrategy():
-    def __init__(self, data):
+    def __init__(self, data: FirstHits, decimal_fallback: bool = True):
+        '''
+        :param decimal_fallback: compare SpecEValues that parse to the same float as a threshold
+            as Decimals read back from the file, see count_filtered.
+        '''
         self.data = data
-        self.decoys = list(filter(lambda data_row: data_row['Protein'].startswith('XXX'), self.data))
+        self.decimal_fallback = decimal_fallback
+        # sorted once, so the number of rows at or below any SpecEValue is a binary search.
+        self.order = np.argsort(data.spec_e_values, kind='stable')
+        self.spec_e_values = data.spec_e_values[self.order]
+        # decoy_counts[i]: decoys among the i smallest SpecEValues.
+        self.decoy_counts = np.concatenate([[0], np.cumsum(data.is_decoy[self.order])])
         super().__init__()
 
-    def __select(self, data_row, spec_e_value: Decimal):
-        return data_row['MSGFDB_SpecEValue'] <= spec_e_value
+    def count_filtered(self, spec_e_value: Decimal):
+        '''
+        :return: number of rows, and of decoy rows, with a SpecEValue <= spec_e_value.
+        '''
+        value = float(spec_e_value)
+        start = int(np.searchsorted(self.spec_e_values, value, side='left'))
+        end = int(np.searchsorted(self.spec_e_values, value, side='right'))
+        if start == end or not self.decimal_fallback:
+            return end, int(self.decoy_counts[end])
+
+        # rows whose float equals the threshold's can be on either side of it.
+        rows = self.order[start:end]
+        selected = np.array([row_value <= spec_e_value for row_value in self.decimal_spec_e_values(rows)])
+        return start + int(selected.sum()), int(self.decoy_counts[start]) + int(self.data.is_decoy[rows][selected].sum())
 
-    def __count_filtered(self, data_list, spec_e_value: Decimal):
-        return len(list(filter(partial(self.__select, spec_e_value = spec_e_value), data_list)))
+    def decimal_spec_e_values(self, rows: np.ndarray) -> list:
+        '''
+        Decimal SpecEValues of rows, cached on the FirstHits. Rows not cached yet are read from
+        the file in one pass, together with every row prefetch_rows says the search may need.
+        '''
+        cache = self.data.decimal_spec_e_values
+        missing = [row for row in rows.tolist() if row not in cache]
+        if missing:
+            missing = [row for row in np.union1d(missing, self.prefetch_rows()).tolist() if row not in cache]
+            cache.update(zip(missing, get_decimal_spec_e_values(self.data.file, np.array(missing, dtype=np.int64))))
+        return [cache[row] for row in rows.tolist()]
+
+    def prefetch_rows(self) -> np.ndarray:
+        '''
+        :return: rows whose float may equal a threshold the search compares against later.
+        '''
+        return np.empty(0, dtype=np.int64)
 
     def fdr1(self, spec_e_value: Decimal) -> Decimal:
-       fdr = ((Decimal(self.__count_filtered(self.decoys, spec_e_value)) * 2) / self.__count_filtered(self.data, spec_e_value))
+       count, decoy_count = self.count_filtered(spec_e_value)
+       fdr = ((Decimal(decoy_count) * 2) / count)
        return fdr
 
     def find_values(self) -> FdrResult:
         pass
 
 class FdrImmediate(FdrSearchStrategy):
-    def __init__(self, data, spec_e_value: Decimal):
+    def __init__(self, data, spec_e_value: Decimal, **kwargs):
         self.spec_e_value = spec_e_value
-        super().__init__(data)
+        super().__init__(data, **kwargs)
 
     def find_values(self) -> FdrResult:
         fdr = self.fdr1(self.spec_e_value)
 
         return FdrResult(self.spec_e_value, fdr)
-              
+
 class FdrDownIterate(FdrSearchStrategy):
-    def __init__(self, data, spec_e_value: Decimal, fdr: Decimal, spec_e_inc: Decimal):
+    def __init__(self, data, spec_e_value: Decimal, fdr: Decimal, spec_e_inc: Decimal, **kwargs):
         self.spec_e_value = spec_e_value
         self.fdr = fdr
         self.spec_e_inc = spec_e_inc
-        super().__init__(data)
+        super().__init__(data, **kwargs)
 
     def find_values(self) -> FdrResult:
         fdr_tmp = self.fdr
         spec_e_tmp = self.spec_e_value
- 
+
         spec_e_last = fdr_tmp
         fdr_last = spec_e_tmp
 
         while True:
-            spec_e_tmp -= self.spec_e_inc 
+            spec_e_tmp -= self.spec_e_inc
             fdr_tmp = self.fdr1(spec_e_tmp)
 
             if self.fdr > fdr_tmp:
@@ -63,6 +111,76 @@ class FdrDownIterate(FdrSearchStrategy):
 
         return FdrResult(spec_e_last, fdr_last)
 
+    def prefetch_rows(self) -> np.ndarray:
+        # rows near a step spec_e_value - k * spec_e_inc, k >= 1. The float arithmetic can be
+        # off by a few ulps of spec_e_value; a row missed here is still read when it is needed.
+        start, inc = float(self.spec_e_value), float(self.spec_e_inc)
+        steps = np.maximum(np.round((start - self.spec_e_values) / inc), 1)
+        near = np.abs(self.spec_e_values - (start - steps * inc)) <= 4 * np.spacing(start)
+        return self.order[near]
+
+class FdrExact(FdrSearchStrategy):
+    '''
+    Largest SpecEValue of the data, at most spec_e_value when given, at which the FDR is at most fdr.
+    Every distinct SpecEValue is tried at once on the cumulative counts of the sorted values.
+    When none reaches fdr, the result is NO_THRESHOLD: SpecEValues are positive, so no PSM passes 0.
+    '''
+    def __init__(self, data, fdr: Decimal, spec_e_value: Decimal = None, **kwargs):
+        self.fdr = fdr
+        self.spec_e_value = spec_e_value
+        super().__init__(data, **kwargs)
+
+    def passes(self, counts: np.ndarray, decoy_counts: np.ndarray) -> np.ndarray:
+        # 2 * decoy_count / count <= fdr, in integers.
+        numerator, denominator = self.fdr.as_integer_ratio()
+        dtype = np.int64 if max(numerator, denominator) < 2 ** 31 else object
+        return (decoy_counts.astype(dtype) * (2 * denominator)) <= (counts.astype(dtype) * numerator)
+
+    def find_values(self) -> FdrResult:
+        end = len(self.spec_e_values)
+        if self.spec_e_value is not None:
+            end = int(np.searchsorted(self.spec_e_values, float(self.spec_e_value), side='right'))
+
+        # one candidate per distinct float: the position after its last row.
+        group_ends = np.concatenate([np.flatnonzero(np.diff(self.spec_e_values[:end])), [end - 1]]) + 1 if end else np.empty(0, dtype=np.int64)
+        group_starts = np.concatenate([[0], group_ends[:-1]])
+        passing = np.flatnonzero(self.passes(group_ends, self.decoy_counts[group_ends]))
+
+        if not self.decimal_fallback:
+            if len(passing) == 0:
+                return self.no_threshold()
+            group_end = group_ends[passing[-1]]
+            return FdrResult(Decimal(repr(self.spec_e_values[group_end - 1])), (Decimal(int(self.decoy_counts[group_end])) * 2) / int(group_end))
+
+        # Rows sharing a float can still differ as Decimals, which splits their candidate. Only
+        # groups above the best float candidate, or at the --spece boundary, can change the result.
+        best = int(passing[-1]) if len(passing) else -1
+        last = len(group_ends) - 1
+        groups = [group for group in range(max(best, 0), len(group_ends))
+                  if group in (best, last) or group_ends[group] - group_starts[group] > 1]
+        rows = np.concatenate([self.order[group_starts[group]:group_ends[group]] for group in groups]) if groups else np.empty(0, dtype=np.int64)
+        values = dict(zip(rows.tolist(), self.decimal_spec_e_values(rows)))
+
+        for group in reversed(groups):
+            start = group_starts[group]
+            group_rows = self.order[start:group_ends[group]]
+            group_values = np.array([values[row] for row in group_rows.tolist()], dtype=object)
+            for spec_e_tmp in sorted(set(group_values), reverse=True):
+                if self.spec_e_value is not None and spec_e_tmp > self.spec_e_value:
+                    continue
+                selected = group_values <= spec_e_tmp
+                count = start + int(selected.sum())
+                decoy_count = int(self.decoy_counts[start]) + int(self.data.is_decoy[group_rows][selected].sum())
+                fdr_tmp = (Decimal(decoy_count) * 2) / count
+                if fdr_tmp <= self.fdr:
+                    return FdrResult(spec_e_tmp, fdr_tmp)
+
+        return self.no_threshold()
+
+    def no_threshold(self) -> FdrResult:
+        sys.stderr.write(f'No SpecEValue threshold reaches an FDR of {self.fdr}, no PSM passes\n')
+        return NO_THRESHOLD
+
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--file', type=str, help='First Hits file to process')
@@ -73,40 +191,143 @@ def get_args():
     parser.add_argument('--speceinc', type=str, help='')
     parser.add_argument('--precision', type=int, help='Floating point precision', required=False)
     parser.add_argument('--single', action='store_true', help='Prints FDR for given SpecEValue')
+    parser.add_argument('--search', choices=['exact', 'stepped'], default='stepped',
+                        help='stepped: legacy search stepping down from --spece by --speceinc. '
+                             'exact: largest SpecEValue up to --spece with FDR <= --fdr')
+    parser.add_argument('--qvalues', type=str, required=False,
+                        help='Only writes every PSM\'s FDR and q-value, and those of its peptide, to this file, '
+                             'without searching for a threshold')
+    parser.add_argument('--no-decimal-fallback', action='store_true',
+                        help='Compare SpecEValues as float64 only, also where they tie with the threshold')
     # parser.add_argument('--log', action='store_true')
     parser.add_argument('--out', type=str, help='', default='out.json')
 
     return parser.parse_args()
 
-def get_dat(filepath: str):
-    with open(filepath) as data_file:
-        reader = csv.DictReader(data_file, delimiter='\t')
+def get_dat(filepath: str) -> FirstHits:
+    '''
+    Reads the Protein and MSGFDB_SpecEValue columns of a first hits file into arrays, in chunks,
+    so memory is bounded by the arrays rather than the rows.
+    '''
+    spec_e_values = []
+    is_decoy = []
+    for chunk in pd.read_csv(filepath, sep='\t', usecols=['Protein', 'MSGFDB_SpecEValue'],
+                             dtype={'Protein': str, 'MSGFDB_SpecEValue': np.float64},
+                             float_precision='round_trip', chunksize=CHUNK_SIZE):
+        spec_e_values.append(chunk['MSGFDB_SpecEValue'].to_numpy())
+        is_decoy.append(chunk['Protein'].str.startswith('XXX').to_numpy(dtype=bool))
+
+    if not spec_e_values:
+        return FirstHits(filepath, np.empty(0), np.empty(0, dtype=bool), {})
+    return FirstHits(filepath, np.concatenate(spec_e_values), np.concatenate(is_decoy), {})
+
+def get_decimal_spec_e_values(filepath: str, rows: np.ndarray) -> list:
+    '''
+    :return: MSGFDB_SpecEValue of the given rows (positions in the file) as Decimals of the file text.
+    '''
+    wanted = np.unique(rows)
+    values = {}
+    start = 0
+    for chunk in pd.read_csv(filepath, sep='\t', usecols=['MSGFDB_SpecEValue'], dtype=str, chunksize=CHUNK_SIZE):
+        in_chunk = wanted[(wanted >= start) & (wanted < start + len(chunk))]
+        for row, value in zip(in_chunk.tolist(), chunk['MSGFDB_SpecEValue'].to_numpy()[in_chunk - start]):
+            values[row] = Decimal(value)
+        start += len(chunk)
+
+    return [values[row] for row in rows.tolist()]
+
+def get_psms(filepath: str) -> pd.DataFrame:
+    '''
+    Reads the columns of a first hits file written to the q-value file, in chunks.
+    '''
+    return pd.concat(
+        pd.read_csv(filepath, sep='\t', usecols=['Scan', 'Charge', 'Peptide', 'Protein', 'MSGFDB_SpecEValue'],
+                    dtype={'Scan': np.int32, 'Charge': np.int8, 'Peptide': str, 'Protein': str, 'MSGFDB_SpecEValue': np.float64},
+                    float_precision='round_trip', chunksize=CHUNK_SIZE),
+        ignore_index=True,
+    )
 
-        return [{'Protein': row['Protein'], 'MSGFDB_SpecEValue': Decimal(row['MSGFDB_SpecEValue'])} for row in reader]
+def fdr_curve(spec_e_values: np.ndarray, is_decoy: np.ndarray):
+    '''
+    Target-decoy curve in one sorted pass.
+
+    :return: FDR at each row's own SpecEValue, 2 * decoys / rows at or below it, and the row's
+        q-value, the lowest FDR of any threshold at or above it. Both in the order of the rows.
+    '''
+    order = np.argsort(spec_e_values, kind='stable')
+    sorted_values = spec_e_values[order]
+    decoy_counts = np.concatenate([[0], np.cumsum(is_decoy[order])])
+    # rows tied on SpecEValue pass or fail any threshold together.
+    counts = np.searchsorted(sorted_values, sorted_values, side='right')
+    fdr = 2 * decoy_counts[counts] / counts
+    qvalue = np.minimum.accumulate(fdr[::-1])[::-1]
+
+    fdr_out = np.empty_like(fdr)
+    qvalue_out = np.empty_like(qvalue)
+    fdr_out[order] = fdr
+    qvalue_out[order] = qvalue
+    return fdr_out, qvalue_out
+
+def get_qvalues(psms: pd.DataFrame) -> pd.DataFrame:
+    '''
+    PSM and peptide level FDR and q-values of the first hits. A peptide is scored by its best
+    PSM, and is a decoy when that PSM is.
+
+    :return: Scan, Charge, Peptide, MSGFDB_SpecEValue, FDR, QValue, PepFDR, PepQValue of every
+        PSM, sorted by MSGFDB_SpecEValue.
+    '''
+    is_decoy = psms['Protein'].str.startswith('XXX').to_numpy(dtype=bool)
+    spec_e_values = psms['MSGFDB_SpecEValue'].to_numpy()
+    fdr, qvalue = fdr_curve(spec_e_values, is_decoy)
+
+    # peptides without their flanking residues, as ficus_analysis.py reports them.
+    sequence = psms['Peptide'].str.extract(r'\.(.*)\.', expand=False).fillna(psms['Peptide'])
+    best = np.argsort(spec_e_values, kind='stable')
+    best = best[~sequence.iloc[best].duplicated().to_numpy()]
+    peptide_fdr, peptide_qvalue = fdr_curve(spec_e_values[best], is_decoy[best])
+    peptides = pd.DataFrame({'PepFDR': peptide_fdr, 'PepQValue': peptide_qvalue}, index=sequence.iloc[best].to_numpy())
+    peptides = peptides.reindex(sequence.to_numpy())
+
+    qvalues = psms[['Scan', 'Charge', 'Peptide', 'MSGFDB_SpecEValue']].assign(
+        FDR=fdr,
+        QValue=qvalue,
+        PepFDR=peptides['PepFDR'].to_numpy(),
+        PepQValue=peptides['PepQValue'].to_numpy(),
+    )
+    return qvalues.sort_values('MSGFDB_SpecEValue', kind='stable')
 
 if __name__ == "__main__":
     args = get_args()
-    
+
     getcontext().prec = args.precision if args.precision is not None else 45
 
+    if args.qvalues is not None:
+        # ficus_analysis.py cuts the q-values at the FDR itself, no threshold to search for
+        get_qvalues(get_psms(args.file)).to_csv(args.qvalues, sep='\t', index=False)
+        sys.exit(0)
+
     rows = get_dat(args.file)
     result = None
     to_write = None
 
-    spec_e_value = Decimal(args.spece)
-    spec_e_value_inc = Decimal(args.speceinc)
+    spec_e_value = Decimal(args.spece) if args.spece is not None else None
     fdr = Decimal(args.fdr)
+    decimal_fallback = not args.no_decimal_fallback
 
-    fdr_iterate = FdrDownIterate(rows, spec_e_value, fdr, spec_e_value_inc)
-    result = fdr_iterate.find_values()
+    if args.search == 'stepped':
+        spec_e_value_inc = Decimal(args.speceinc)
+        fdr_search = FdrDownIterate(rows, spec_e_value, fdr, spec_e_value_inc, decimal_fallback=decimal_fallback)
+    else:
+        fdr_search = FdrExact(rows, fdr, spec_e_value, decimal_fallback=decimal_fallback)
+    result = fdr_search.find_values()
     to_write = result.SpecEValue
 
     sys.stdout.write(str(to_write))
 
-    with open(args.out, 'w+') as fp:  
+    with open(args.out, 'w+') as fp:
         out_dat = {
             "FDR": float(result.FDR),
             "SpecEValue": float(result.SpecEValue),
         }
-        dat = json.dumps(out_dat)     
-        fp.write(dat)
\ No newline at end of file
+        dat = json.dumps(out_dat)
+        fp.write(dat)
@@ -1,28 +1,300 @@
 import pandas as pd
+import numpy as np
 import warnings
 import sys
+import re
 import json
 import functools
+import hashlib
+import multiprocessing
+import resource
+import time
 from pathlib import Path
-from typing import Tuple, Optional
+from typing import Tuple, Optional, List
 from datetime import datetime
 
 warnings.filterwarnings("ignore")
 
-import gffpandas.gffpandas as gffpd
 import os
 
 pd.set_option("display.precision", 20)
 
+# Columns of the resultant (MSGF+ syn + MASIC SICstats merge) file used by DataOutputtable,
+# and the dtypes they are read as. All other columns are skipped at parse time.
+RESULTANT_DTYPES = {
+    "Scan": "int32",
+    "Charge": "int8",
+    "SpecIndex": "int32",
+    "Peptide": "object",
+    "Protein": "object",
+    "MSGFDB_SpecEValue": "float64",
+    "QValue": "float64",
+    "StatMomentsArea": "float64",
+}
+
+# Columns of the ProteinDigestionSimulator FASTA txt file used by DataOutputtable.
+FASTA_TXT_DTYPES = {
+    "ProteinName": "object",
+}
+
+GFF3_COLUMNS = ["seq_id", "source", "type", "start", "end", "score", "strand", "phase", "attributes"]
+
+# Version of the annotation index format, part of its file name (see annotation_index_path).
+# Bump it whenever parse_annotation, gff_attributes_to_columns or DataOutputtable.parse_attributes
+# change what they return, so indexes written by older code are rebuilt instead of reused.
+ANNOTATION_INDEX_VERSION = 1
+
+# read_csv has the pyarrow engine from pandas 1.4 on. The post-processing image is python 3.7,
+# which has at most pandas 1.3.5, so there only the c engine is available.
+PANDAS_VERSION = tuple(int(part) for part in pd.__version__.split(".")[:2])
+
 def timestamp_as_string():
     return datetime.now().strftime("%Y%m%d%H%M%S")
-    
+
+def read_tsv(file, dtypes: dict, round_trip: bool = False, engine: str = "c", chunksize: Optional[int] = None):
+    """
+    Reads only the columns in dtypes from a tab separated file, with those dtypes.
+
+    :param round_trip: parse floats with round-trip precision. Needed for numbers that are
+        compared against the threshold or written back out; the pyarrow engine always does this.
+    :param engine: pandas read_csv engine, "c" or "pyarrow" (pandas >= 1.4).
+    :param chunksize: return an iterator over frames of chunksize rows instead (c engine only).
+    """
+    if engine == "pyarrow" and PANDAS_VERSION < (1, 4):
+        raise ValueError(f"the pyarrow csv engine needs pandas >= 1.4, found pandas {pd.__version__}")
+    kwargs = {}
+    if round_trip and engine != "pyarrow":
+        kwargs["float_precision"] = "round_trip"
+    return pd.read_csv(
+        file, sep="\t", usecols=list(dtypes), dtype=dtypes, engine=engine, chunksize=chunksize, **kwargs
+    )
+
+def is_parquet(file) -> bool:
+    """
+    Whether file is a Parquet file, by its magic number, e.g. a results_merge.py --output-format parquet resultant.
+    """
+    with open(file, "rb") as f:
+        return f.read(4) == b"PAR1"
+
+def read_table(file, dtypes: dict, round_trip: bool = False, engine: str = "c", chunksize: Optional[int] = None):
+    """
+    read_tsv, or for a Parquet file (see is_parquet) the same columns read from it with the
+    same dtypes. Parquet stores floats exactly, so round_trip and engine only apply to text.
+    With chunksize, Parquet files are read a row batch of chunksize rows at a time.
+    """
+    if not is_parquet(file):
+        return read_tsv(file, dtypes, round_trip=round_trip, engine=engine, chunksize=chunksize)
+    if chunksize is None:
+        return pd.read_parquet(file, columns=list(dtypes)).astype(dtypes)
+
+    import pyarrow.parquet as pq
+
+    batches = pq.ParquetFile(file).iter_batches(batch_size=chunksize, columns=list(dtypes))
+    return (batch.to_pandas().astype(dtypes) for batch in batches)
+
+def read_gff(gff_file) -> pd.DataFrame:
+    """
+    Reads the type and attributes columns of a gff3 file, the only ones query_0 uses.
+    """
+    return pd.read_csv(
+        gff_file,
+        sep="\t",
+        comment="#",
+        header=None,
+        names=GFF3_COLUMNS,
+        usecols=["type", "attributes"],
+        dtype={"type": "object", "attributes": "object"},
+    )
+
+def gff_attributes_to_columns(attributes: pd.Series, tags: List[str]) -> pd.DataFrame:
+    """
+    Vectorized gffpandas attributes_to_columns() restricted to tags: one column per tag holding
+    the value of its last tag=value pair, None where the tag is absent.
+    """
+    columns = {}
+    for tag in tags:
+        values = attributes.str.extract(rf"^(?:.*;)?{re.escape(tag)}=([^;]*)", expand=False)
+        columns[tag] = values.astype(object).where(values.notna(), None)
+    return pd.DataFrame(columns, index=attributes.index)
+
+def file_md5(file, chunk_size: int = 1 << 20) -> str:
+    md5 = hashlib.md5()
+    with open(file, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def parse_annotation(gff_file, is_metagenome_free_analysis: bool) -> pd.DataFrame:
+    """
+    Parses the gff3 attributes query_0 uses. Nothing here depends on the dataset, so the result
+    can be shared by every run against the same annotation (see load_annotation_index).
+
+    :return: dataframe with col: ['Protein', 'Product', 'pfam', 'ko', 'ec_number', 'cog']
+    """
+    annotation_df = read_gff(gff_file)
+    if is_metagenome_free_analysis:
+        # Kaiko gffs: every feature, Protein is the short id still to be mapped to the fasta name.
+        col_of_interest = ["ID", "product", "ko", "ec_number", "cog", "pfam"]
+        parsed_attributes = annotation_df["attributes"].apply(DataOutputtable.parse_attributes)
+        attributeTag_df = pd.json_normalize(parsed_attributes).fillna("None")[col_of_interest]
+    else:
+        filtered_df = annotation_df[annotation_df["type"] == "CDS"]
+        col_of_interest = ["ID", "product", "pfam", "ko", "ec_number", "cog"]
+        attributeTag_df = gff_attributes_to_columns(filtered_df["attributes"], col_of_interest)
+    return attributeTag_df.rename(columns={"ID": "Protein", "product": "Product"})
+
+def annotation_index_path(gff_file, cache_dir, is_metagenome_free_analysis: bool) -> Path:
+    """
+    Index file for gff_file in cache_dir, named after the gff's md5 and ANNOTATION_INDEX_VERSION
+    so neither an edited gff nor a changed parser reuses a stale index.
+    """
+    kind = "kaiko" if is_metagenome_free_analysis else "jgi"
+    return Path(cache_dir) / f"{file_md5(gff_file)}.{kind}.v{ANNOTATION_INDEX_VERSION}.annotation.parquet"
+
+def build_annotation_index(gff_file, cache_dir, is_metagenome_free_analysis: bool) -> Path:
+    """
+    Parses gff_file and writes its annotation index (Parquet, needs pyarrow) to cache_dir.
+
+    :return: path of the written index.
+    """
+    index_file = annotation_index_path(gff_file, cache_dir, is_metagenome_free_analysis)
+    index_file.parent.mkdir(parents=True, exist_ok=True)
+    annotation = parse_annotation(gff_file, is_metagenome_free_analysis)
+    # write then rename, so runs sharing cache_dir never read a partial index.
+    tmp_file = index_file.with_name(f"{index_file.name}.{os.getpid()}.tmp")
+    annotation.to_parquet(tmp_file, index=False)
+    os.replace(tmp_file, index_file)
+    return index_file
+
+def load_annotation_index(gff_file, cache_dir, is_metagenome_free_analysis: bool) -> pd.DataFrame:
+    """
+    parse_annotation() through the index in cache_dir, building the index on first use.
+    Without a cache_dir the gff is parsed directly.
+    """
+    if cache_dir is None:
+        return parse_annotation(gff_file, is_metagenome_free_analysis)
+    index_file = annotation_index_path(gff_file, cache_dir, is_metagenome_free_analysis)
+    if not index_file.exists():
+        index_file = build_annotation_index(gff_file, cache_dir, is_metagenome_free_analysis)
+    return pd.read_parquet(index_file)
+
+def read_qvalues(qvalue_file) -> pd.DataFrame:
+    """
+    The columns qvalue_cutoff needs of the file compute_fdr.py --qvalues writes.
+    """
+    return read_tsv(qvalue_file, {"MSGFDB_SpecEValue": "float64", "QValue": "float64"}, round_trip=True)
+
+def qvalue_cutoff(qvalues: pd.DataFrame, fdr) -> str:
+    """
+    MSGFDB_SpecEValue cut-off that keeps exactly the PSMs with a q-value <= fdr, from q-values as
+    compute_fdr.get_qvalues returns them (see read_qvalues). q-values never decrease with the
+    SpecEValue, so this is the largest SpecEValue with a passing q-value.
+
+    :return: the cut-off, as a threshold string for DataOutputtable.
+    """
+    passing = qvalues.loc[qvalues["QValue"] <= float(fdr), "MSGFDB_SpecEValue"]
+    return repr(float(passing.max())) if len(passing) else "-inf"
+
+class PeptideProteinIncidence:
+    """
+    Sparse peptide x protein incidence matrix of distinct (peptide, protein) pairs, in CSR form
+    over categorical codes: the proteins of peptide p are indices[indptr[p]:indptr[p + 1]].
+    """
+
+    def __init__(self, peptide_codes: np.ndarray, protein_codes: np.ndarray, n_peptides: int, n_proteins: int):
+        """
+        :param peptide_codes: peptide code of every pair, pairs must be distinct.
+        :param protein_codes: protein code of every pair.
+        """
+        order = np.argsort(peptide_codes, kind="stable")
+        self.indices = protein_codes[order]
+        self.entry_peptide = peptide_codes[order]
+        self.indptr = np.zeros(n_peptides + 1, dtype=np.int64)
+        np.cumsum(np.bincount(peptide_codes, minlength=n_peptides), out=self.indptr[1:])
+        # row and column sums.
+        self.proteins_per_peptide = np.diff(self.indptr)
+        self.peptides_per_protein = np.bincount(self.indices, minlength=n_proteins)
+
+    def razor_rule(self, peptide_codes: np.ndarray, protein_codes: np.ndarray) -> np.ndarray:
+        """
+        Razor protein rules of get_razor_protein_associated_with_peptide, for the given pairs:
+        0: the peptide maps to this protein only.
+        1: of the peptide's proteins, only this one has a peptide mapping to it alone.
+        2: none of the peptide's proteins has such a peptide, and this one has the most
+           peptides (all tied proteins are razor proteins).
+        Degenerate peptides with more than one protein of rule 1 have no razor protein.
+
+        :return: rule of every pair, -1 where the protein is not a razor protein of the peptide.
+        """
+        entry_count = self.proteins_per_peptide[self.entry_peptide]
+        # proteins with at least one peptide of their own.
+        has_unique_peptide = np.bincount(
+            self.indices[entry_count == 1], minlength=len(self.peptides_per_protein)
+        ) > 0
+        # per peptide: number of such proteins and the largest peptide count of its proteins.
+        degenerate_entry = entry_count > 1
+        unique_protein_count = np.bincount(
+            self.entry_peptide[degenerate_entry & has_unique_peptide[self.indices]],
+            minlength=len(self.proteins_per_peptide),
+        )
+        max_peptides_per_protein = np.zeros(len(self.proteins_per_peptide), dtype=np.int64)
+        non_empty = self.proteins_per_peptide > 0
+        if non_empty.any():
+            max_peptides_per_protein[non_empty] = np.maximum.reduceat(
+                self.peptides_per_protein[self.indices], self.indptr[:-1][non_empty]
+            )
+
+        proteins_per_peptide = self.proteins_per_peptide[peptide_codes]
+        unique_protein = unique_protein_count[peptide_codes]
+        rule = np.full(len(peptide_codes), -1, dtype=np.int8)
+        rule[proteins_per_peptide == 1] = 0
+        rule[(proteins_per_peptide > 1) & (unique_protein == 1) & has_unique_peptide[protein_codes]] = 1
+        rule[
+            (proteins_per_peptide > 1)
+            & (unique_protein == 0)
+            & (self.peptides_per_protein[protein_codes] == max_peptides_per_protein[peptide_codes])
+        ] = 2
+        return rule
+
 class DataOutputtable:
     """
     Created based of data manipulation performed using MSSQLsever queries by
     Purvine, Samuel O <Samuel.Purvine@pnnl.gov>
     """
 
+    # Query graph: node -> nodes whose results are passed to it, in argument order.
+    # Every node is a method of this class and is evaluated at most once per run (see evaluate).
+    QUERY_GRAPH = {
+        "query_0": [],
+        "query_1": [],
+        "query_4": ["query_1"],
+        "get_razor_protein_associated_with_peptide": ["query_4"],
+        "encode_annotation": ["query_0"],
+        "query_8": ["get_razor_protein_associated_with_peptide", "encode_annotation"],
+        "query_9": [],
+        "query_10": ["query_9", "encode_annotation"],
+        "query_11": ["query_10"],
+        "query_12": [],
+        "query_13": ["query_11", "query_8", "query_12"],
+        "query_14": ["query_13"],
+        "query_15": ["query_8"],
+        "query_16": ["query_15"],
+        "query_17": ["encode_annotation", "query_15"],
+        "query_18": ["query_17"],
+        "query_19": ["create_peptide_report", "query_16", "query_18", "query_14"],
+        "query_20": ["query_0"],
+        "query_21": [],
+        "query_22": [],
+        "query_23": ["query_21", "query_22"],
+        "query_24": ["create_peptide_report", "query_21", "query_23", "query_20"],
+        "create_peptide_report": ["query_13"],
+        "create_protein_report": ["query_19"],
+        "create_qc_metrics": ["query_24"],
+    }
+
+    # QUERY_GRAPH nodes that don't depend on the FDR threshold, kept across set_threshold calls.
+    THRESHOLD_INDEPENDENT_NODES = {"query_0", "encode_annotation", "query_20", "query_22"}
+
     def __init__(
         self,
         gff_file,
@@ -33,99 +305,358 @@ class DataOutputtable:
         faa_id,         # this can go away
         dataset_name,
         did_split_analysis,
-        is_metagenome_free_analysis # reevaluate if this is needed or not since new kaiko writes much better .gffs
+        is_metagenome_free_analysis, # reevaluate if this is needed or not since new kaiko writes much better .gffs
+        drop_intermediates=False,
+        csv_engine="c",
+        annotation_cache_dir=None,
+        annotation_df=None,
+        fasta_txt_df=None,
+        profile_queries=False,
+        resultant_chunksize=None,
+        resultant_df=None
     ):
 
         self.dataset_id = dataset_id
         self.faa_id = faa_id
         self.threshold = float(threshold)
-        # read annotation file.
+        # annotation file, parsed in query_0 or loaded from its index in annotation_cache_dir.
+        # annotation_df (parse_annotation output) and fasta_txt_df let several datasets share
+        # one load of both files, see run_batch.
         self.gff_file = gff_file
-        self.annotation = gffpd.read_gff3(gff_file)
+        self.annotation_cache_dir = annotation_cache_dir
+        self.annotation_df = annotation_df
         self.dataset_name = dataset_name
-        self.fasta_txt_file_df = pd.read_csv(fasta_txt_file, sep="\t", float_precision="round_trip")
-        self.resultant_df = pd.read_csv(resultant_file, sep="\t", float_precision="round_trip")
+        if fasta_txt_df is None:
+            fasta_txt_df = read_tsv(fasta_txt_file, FASTA_TXT_DTYPES, engine=csv_engine)
+        self.fasta_txt_file_df = fasta_txt_df
         self.did_split_analysis = did_split_analysis
         self.is_metagenome_free_analysis = is_metagenome_free_analysis
 
+        # FDR-filtered base frames, built once and shared read-only by all queries.
+        self.filtered_base_df = None
+        self.FiltPeps_gen_df = None
+        self.FiltPeps_pairs_df = None
+        self.incidence = None
+
+        # shared protein and peptide dictionaries, see encode_resultant.
+        self.protein_dtype = None
+        self.peptide_dtype = None
+        # With resultant_chunksize the resultant is streamed instead of held in resultant_df,
+        # keeping only what the queries need of it (see stream_resultant).
+        self.resultant_df = None
+        self.resultant_pairs_df = None
+        self.total_psm_count = None
+        if resultant_df is not None:
+            # an already merged resultant, as results_merge.merge_tables returns it.
+            self.resultant_df = resultant_df[list(RESULTANT_DTYPES)].astype(RESULTANT_DTYPES)
+            self.encode_resultant()
+        elif resultant_chunksize is None:
+            self.resultant_df = read_table(resultant_file, RESULTANT_DTYPES, round_trip=True, engine=csv_engine)
+            self.encode_resultant()
+        else:
+            self.stream_resultant(resultant_file, resultant_chunksize)
+
         # saved to served multiple calls
-        self.query_8_result = None
         self.peptide_report = None
 
+        # QUERY_GRAPH results. With drop_intermediates a result is released as soon as
+        # every node that consumes it has been evaluated, to bound peak memory.
+        self.drop_intermediates = drop_intermediates
+        self.query_results = {}
+        self.pending_consumers = {}
+        self.query_targets = set()
+        self.retained_nodes = set()
+
+        # score order of the PSMs, built by the first set_threshold call.
+        self.sweep_base_df = None
+        self.sweep_max_threshold = None
+        self.sweep_order = None
+        self.sweep_scores = None
+        self.sweep_is_decoy = None
+
+        # per query performance records, see write_df_excel and query_profile.
+        self.profile_queries = profile_queries
+        self.query_profile_records = []
+        self.profile_stack = []
+
         # # building log excel files:
         # gff_parent_path = Path(gff_file).parent
         # self.writer = pd.ExcelWriter(gff_parent_path / f"query_results_{timestamp_as_string()}.xlsx")
         
     def write_df_excel(func):
         '''
-        This function wraps all query functions to write the resultant 10k rows of the returned 
-        dataframe to an excel file.
+        This function wraps all query functions. With profile_queries it records the wall time,
+        peak RSS growth and the size of the returned dataframe of every call (see query_profile).
+        The excel dump of the resultant 10k rows is kept below, disabled.
         '''
         @functools.wraps(func)
         def capture(self, *args, **kwargs):
-            result_df: pd.DataFrame = func(self, *args, **kwargs)   
+            if not self.profile_queries:
+                return func(self, *args, **kwargs)
+
+            # queries calling other queries: the time of nested calls is subtracted to get self_seconds.
+            self.profile_stack.append(0.0)
+            peak_rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.perf_counter()
+            try:
+                result_df: pd.DataFrame = func(self, *args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                nested_seconds = self.profile_stack.pop()
+                if self.profile_stack:
+                    self.profile_stack[-1] += seconds
+            peak_rss_end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            is_df = isinstance(result_df, pd.DataFrame)
+            self.query_profile_records.append({
+                "query": func.__name__,
+                "depth": len(self.profile_stack),
+                "seconds": seconds,
+                "self_seconds": seconds - nested_seconds,
+                "rows": len(result_df) if is_df else None,
+                "memory_bytes": int(result_df.memory_usage(deep=True).sum()) if is_df else None,
+                # ru_maxrss is in kilobytes on linux.
+                "peak_rss_delta_bytes": (peak_rss_end - peak_rss_start) * 1024,
+            })
             # result_df.iloc[:10000].to_excel(self.writer, sheet_name=func.__name__, index=False)
             return result_df
         return capture
 
+    def query_profile(self) -> pd.DataFrame:
+        """
+        :return: one row per profiled query call, in the order the calls returned. Empty unless profile_queries.
+            rows and memory_bytes are empty for nodes that don't return a dataframe.
+        """
+        return pd.DataFrame(
+            self.query_profile_records,
+            columns=["query", "depth", "seconds", "self_seconds", "rows", "memory_bytes", "peak_rss_delta_bytes"],
+        ).astype({"rows": pd.Int64Dtype(), "memory_bytes": pd.Int64Dtype()})
+
+    def evaluate(self, node: str) -> pd.DataFrame:
+        """
+        Returns the result of a QUERY_GRAPH node, computing it and its dependencies first if needed.
+        Results are cached read-only; callers get a shallow copy they may add columns to,
+        sort or rename in place.
+        """
+        if node not in self.query_results:
+            dependencies = self.QUERY_GRAPH[node]
+            inputs = [self.evaluate(dependency) for dependency in dependencies]
+            self.query_results[node] = self.set_read_only(getattr(self, node)(*inputs))
+            del inputs
+            for dependency in dependencies:
+                self.release(dependency)
+        return self.query_results[node].copy(deep=False)
+
+    def release(self, node: str):
+        """
+        Marks one consumer of node as done and drops the cached result once none are left.
+        """
+        if node not in self.pending_consumers:
+            return
+        self.pending_consumers[node] -= 1
+        if (
+            self.drop_intermediates
+            and self.pending_consumers[node] == 0
+            and node not in self.query_targets
+            and node not in self.retained_nodes
+        ):
+            self.query_results.pop(node, None)
+
+    def run_query_graph(self, targets: List[str]) -> List[pd.DataFrame]:
+        """
+        Evaluates targets, computing every node they depend on exactly once.
+
+        :param targets: QUERY_GRAPH nodes to return, in order.
+        :return: list of target results.
+        """
+        self.query_targets = set(targets)
+        self.pending_consumers = {}
+        seen = set()
+        stack = list(targets)
+        while stack:
+            node = stack.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            for dependency in self.QUERY_GRAPH[node]:
+                self.pending_consumers[dependency] = self.pending_consumers.get(dependency, 0) + 1
+                stack.append(dependency)
+
+        return [self.evaluate(target) for target in targets]
+
+    def set_threshold(self, threshold):
+        """
+        Switches the reports to another FDR threshold, reusing the loaded resultant and every
+        threshold independent query result. The PSMs are sorted by score once, on the first call,
+        so the rows passing any threshold are found with a binary search.
+        In streaming mode only the PSMs passing the threshold the resultant was loaded with were
+        kept, so thresholds can't go above it.
+        """
+        threshold = float(threshold)
+        if self.sweep_order is None:
+            if self.resultant_df is None:
+                self.sweep_base_df = self.filtered_base_df
+                self.sweep_max_threshold = self.threshold
+            else:
+                self.sweep_base_df = self.resultant_df
+                self.sweep_max_threshold = np.inf
+            score = self.sweep_base_df["MSGFDB_SpecEValue" if self.did_split_analysis else "QValue"].to_numpy()
+            self.sweep_order = np.argsort(score, kind="stable")
+            self.sweep_scores = score[self.sweep_order]
+            self.sweep_is_decoy = self.sweep_base_df["Protein"].str.startswith("XXX").to_numpy(dtype=bool)
+            self.retained_nodes = set(self.THRESHOLD_INDEPENDENT_NODES)
+        if threshold > self.sweep_max_threshold:
+            raise ValueError(
+                f"threshold {threshold} is above {self.sweep_max_threshold}, the threshold the resultant was streamed with"
+            )
+
+        # the rows FiltPeps would select, in file order.
+        rows = np.sort(self.sweep_order[: np.searchsorted(self.sweep_scores, threshold, side="right")])
+        rows = rows[~self.sweep_is_decoy[rows]]
+        self.threshold = threshold
+        self.filtered_base_df = self.set_read_only(self.sweep_base_df.iloc[rows])
+        self.FiltPeps_gen_df = None
+        self.FiltPeps_pairs_df = None
+        self.incidence = None
+        self.peptide_report = None
+        self.query_profile_records = []
+        for node in list(self.query_results):
+            if node not in self.retained_nodes:
+                del self.query_results[node]
+
+    @staticmethod
+    def set_read_only(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Marks the numpy arrays backing df as non-writeable so a frame shared between
+        queries can't be modified in place. Projections (df[cols]) are still writeable copies.
+        """
+        for block in df._mgr.blocks:
+            if hasattr(block.values, "flags"):
+                block.values.flags.writeable = False
+        return df
+
+    def encode_resultant(self):
+        """
+        Replaces the resultant Protein strings, and the PeptideSequence extracted from Peptide,
+        with categoricals. Every frame derived from resultant_df shares these two dtypes, so the
+        joins, groupbys and drop_duplicates in the queries run on the integer codes.
+        Categories are sorted, so sorting by code orders rows by name; to_csv writes the names.
+        The queries sort by PeptideSequence and RazorProtein stably: the unstable default orders
+        tied codes differently from tied strings, and rows of a peptide keep resultant order,
+        the order its abundances are summed in.
+        """
+        self.resultant_df["PeptideSequence"] = (
+            self.resultant_df["Peptide"].str.extract(r"\.(.*)\.", expand=False).astype("category")
+        )
+        self.resultant_df["Protein"] = self.resultant_df["Protein"].astype("category")
+        # Peptide is only needed to extract PeptideSequence.
+        del self.resultant_df["Peptide"]
+        self.peptide_dtype = self.resultant_df["PeptideSequence"].dtype
+        self.protein_dtype = self.resultant_df["Protein"].dtype
+
+    def stream_resultant(self, resultant_file, chunksize: int):
+        """
+        Out-of-core alternative to reading resultant_df and encode_resultant. Reads the resultant
+        chunksize rows at a time and keeps, encoded like encode_resultant does:
+        - filtered_base_df: the FiltPeps rows, typically a few percent of the file.
+        - resultant_pairs_df: the distinct non-decoy 'PeptideSequence', 'Protein' pairs (query_15).
+        - total_psm_count: the number of distinct 'Scan', 'Charge' (query_22).
+        Text resultants are always read with the c engine, the pyarrow engine can't read in chunks.
+        """
+        filtered_chunks = []
+        pairs_chunks = []
+        # psm_seen[scan, charge] marks the ('Scan', 'Charge') groups seen so far, see mark_psms.
+        psm_seen = np.zeros((0, 0), dtype=bool)
+        for chunk in read_table(resultant_file, RESULTANT_DTYPES, round_trip=True, chunksize=chunksize):
+            chunk["PeptideSequence"] = chunk["Peptide"].str.extract(r"\.(.*)\.", expand=False)
+            del chunk["Peptide"]
+            filtered_chunks.append(self.FiltPeps(chunk))
+            pairs = chunk[["PeptideSequence", "Protein"]]
+            pairs_chunks.append(pairs[~pairs["Protein"].str.startswith("XXX")].drop_duplicates())
+            psm_seen = self.mark_psms(psm_seen, chunk["Scan"].to_numpy(), chunk["Charge"].to_numpy())
+            del chunk
+
+        filtered_df = pd.concat(filtered_chunks)
+        pairs_df = pd.concat(pairs_chunks).drop_duplicates()
+        self.total_psm_count = int(psm_seen.sum())
+
+        # categories of the kept rows only, sorted like astype("category") sorts them.
+        self.peptide_dtype = pd.CategoricalDtype(
+            pd.Index(pd.concat([filtered_df["PeptideSequence"], pairs_df["PeptideSequence"]]))
+            .dropna().unique().sort_values()
+        )
+        self.protein_dtype = pd.CategoricalDtype(
+            pd.Index(pd.concat([filtered_df["Protein"], pairs_df["Protein"]])).dropna().unique().sort_values()
+        )
+        for df in [filtered_df, pairs_df]:
+            df["PeptideSequence"] = df["PeptideSequence"].astype(self.peptide_dtype)
+            df["Protein"] = df["Protein"].astype(self.protein_dtype)
+        self.filtered_base_df = self.set_read_only(filtered_df)
+        self.resultant_pairs_df = self.set_read_only(pairs_df)
+
+    @staticmethod
+    def mark_psms(seen: np.ndarray, scans: np.ndarray, charges: np.ndarray) -> np.ndarray:
+        """
+        Sets seen[scan, charge] for every row, growing seen to the largest scan and charge first.
+        Its size is bounded by the scan numbers of the run, not by the number of rows, and
+        it doesn't need the rows in scan order. Scan and Charge are never negative.
+
+        :return: seen, or its grown copy.
+        """
+        if len(scans) == 0:
+            return seen
+        n_scans, n_charges = int(scans.max()) + 1, int(charges.max()) + 1
+        if n_scans > seen.shape[0] or n_charges > seen.shape[1]:
+            # grow the scans at least twofold, chunks typically go up a few scans at a time.
+            grown = np.zeros((max(n_scans, 2 * seen.shape[0]), max(n_charges, seen.shape[1])), dtype=bool)
+            grown[: seen.shape[0], : seen.shape[1]] = seen
+            seen = grown
+        seen[scans, charges] = True
+        return seen
+
     def FiltPeps(self, df: pd.DataFrame) -> pd.DataFrame:
 
         qvalue_filtered_df = df[df["MSGFDB_SpecEValue"] <= self.threshold] if self.did_split_analysis else df[df["QValue"] <= self.threshold]
+        # PeptideSequence is extracted once by encode_resultant.
         non_decoy_filtered_df = qvalue_filtered_df[
             ~qvalue_filtered_df["Protein"].str.startswith("XXX")
         ]
-        non_decoy_filtered_df["PeptideSequence"] = non_decoy_filtered_df[
-            "Peptide"
-        ].str.extract(r"\.(.*)\.")
         return non_decoy_filtered_df
 
-    @write_df_excel
-    def get_FiltPeps_gen(self, df):
-        FiltPeps_df = self.FiltPeps(df)
-        return FiltPeps_df.drop_duplicates().sort_values(by=["PeptideSequence"])
-
-    @write_df_excel
-    def get_FiltPeps(self, df: pd.DataFrame) -> pd.DataFrame:
-        FiltPeps_df = self.FiltPeps(df)
-        return (
-            FiltPeps_df[["PeptideSequence", "Protein"]]
-            .drop_duplicates()
-            .sort_values(by=["PeptideSequence"])
-        )
+    def get_filtered_base(self) -> pd.DataFrame:
+        """
+        FDR-filtered, decoy-free resultant rows with PeptideSequence extracted.
+        Computed once from resultant_df and kept read-only; queries use projections of it.
+        """
+        if self.filtered_base_df is None:
+            self.filtered_base_df = self.set_read_only(self.FiltPeps(self.resultant_df))
+        return self.filtered_base_df
 
     @write_df_excel
-    def query_2(self) -> pd.DataFrame:
+    def get_FiltPeps_gen(self, columns: List[str]) -> pd.DataFrame:
         """
-        counting distinct peptides per protein using 5% FDR filter and removing Decoy proteins
-        :param query_1_df:
-        :return: dataframe with col: 'Protein'  'peptides_per_protein'
+        :param columns: columns to project out of the PeptideSequence sorted filtered rows.
+        :return: copy of the requested columns.
         """
-        temp_df = self.resultant_df.copy()
-        FiltPeps_df = self.get_FiltPeps(temp_df)
-        grouped_by_protein = FiltPeps_df.groupby("Protein")
-        counted_peptides_df = (
-            grouped_by_protein["PeptideSequence"]
-            .count()
-            .reset_index(name="peptides_per_protein")
-        )
-
-        return counted_peptides_df
+        if self.FiltPeps_gen_df is None:
+            # Every resultant row is distinct by ResultID, so no drop_duplicates here: on the few
+            # columns read it would drop rows that the sums below should count.
+            self.FiltPeps_gen_df = self.set_read_only(
+                self.get_filtered_base().sort_values(by=["PeptideSequence"], kind="mergesort")
+            )
+        return self.FiltPeps_gen_df[columns]
 
     @write_df_excel
-    def query_3(self) -> pd.DataFrame:
+    def get_FiltPeps(self) -> pd.DataFrame:
         """
-
-        :param query_1_df:
-        :return: dataframe with col: 'PeptideSequence'  'proteins_per_peptide'
+        :return: copy of the distinct 'PeptideSequence', 'Protein' pairs of the filtered rows.
         """
-        temp_df = self.resultant_df.copy()
-        FiltPeps_df = self.get_FiltPeps(temp_df)
-        grouped_by_peptide = FiltPeps_df.groupby("PeptideSequence")
-        counted_protein_df = (
-            grouped_by_peptide["Protein"].count().reset_index(name="proteins_per_peptide")
-        )
-
-        return counted_protein_df
+        if self.FiltPeps_pairs_df is None:
+            self.FiltPeps_pairs_df = self.set_read_only(
+                self.get_filtered_base()[["PeptideSequence", "Protein"]]
+                .drop_duplicates()
+                .sort_values(by=["PeptideSequence"], kind="mergesort")
+            )
+        return self.FiltPeps_pairs_df[["PeptideSequence", "Protein"]]
 
     @write_df_excel
     def query_1(self) -> pd.DataFrame:
@@ -134,132 +665,113 @@ class DataOutputtable:
         :param resultant_df:
         :return:
         """
-        temp_df = self.resultant_df.copy()
-        FiltPeps_df = self.get_FiltPeps(temp_df)
-
-        return FiltPeps_df.drop_duplicates().sort_values(by=["PeptideSequence"])
-
-    @write_df_excel
-    def query_4(self, table_1: pd.DataFrame, table_2: pd.DataFrame, table_3: pd.DataFrame) -> pd.DataFrame:
-
-        # inner join on 'Protein'
-        merge_1 = table_1.merge(table_2, how="inner", on="Protein")
-
-        # inner join on 'PeptideSequence'
-        merge_3 = merge_1.merge(table_3, how="inner", on="PeptideSequence")
-
-        col_of_interest = [
-            "Protein",
-            "PeptideSequence",
-            "peptides_per_protein",
-            "proteins_per_peptide",
-        ]
-
-        return merge_3[col_of_interest].sort_values(by=["PeptideSequence"])
+        FiltPeps_df = self.get_FiltPeps()
 
-    @write_df_excel
-    def get_MaxPepCounts(self, table_4: pd.DataFrame) -> pd.DataFrame:
-        peps_morethan_1_protein = table_4[table_4["proteins_per_peptide"] > 1]
-        peps_morethan_1_protein[
-            "max_peptides_per_protein"
-        ] = peps_morethan_1_protein.groupby(["PeptideSequence"])[
-            "peptides_per_protein"
-        ].transform(
-            max
-        )
-        return peps_morethan_1_protein[
-            ["PeptideSequence", "max_peptides_per_protein"]
-        ].drop_duplicates()
+        return FiltPeps_df.drop_duplicates().sort_values(by=["PeptideSequence"], kind="mergesort")
 
     @write_df_excel
-    def get_MaxPepCounts_table_4_joined(self, table_4: pd.DataFrame) -> pd.DataFrame:
-        MaxPepCounts_df = self.get_MaxPepCounts(table_4)
-        joined = MaxPepCounts_df.merge(
-            table_4,
-            how="inner",
-            left_on=["PeptideSequence", "max_peptides_per_protein"],
-            right_on=["PeptideSequence", "peptides_per_protein"],
-        )
-        joined["CountOfPeptideCounts"] = joined.groupby(["PeptideSequence"])[
-            "peptides_per_protein"
-        ].transform("count")
-        return joined
+    def get_incidence(self) -> PeptideProteinIncidence:
+        """
+        Peptide x protein incidence matrix of the distinct filtered pairs (get_FiltPeps), built once.
+        Its row and column sums are the peptides per protein and proteins per peptide counts.
+        """
+        if self.incidence is None:
+            pairs = self.get_FiltPeps()
+            peptide_codes = pairs["PeptideSequence"].cat.codes.to_numpy()
+            protein_codes = pairs["Protein"].cat.codes.to_numpy()
+            # pairs without a peptide or protein have no place in the matrix.
+            valid = (peptide_codes >= 0) & (protein_codes >= 0)
+            self.incidence = PeptideProteinIncidence(
+                peptide_codes[valid].astype(np.int64),
+                protein_codes[valid].astype(np.int64),
+                len(self.peptide_dtype.categories),
+                len(self.protein_dtype.categories),
+            )
+        return self.incidence
 
     @write_df_excel
-    def get_BestIndexedProtein(self, table_4: pd.DataFrame) -> pd.DataFrame:
-        MaxPepCounts_table_4_joined_df = self.get_MaxPepCounts_table_4_joined(table_4)
-        filtered = MaxPepCounts_table_4_joined_df[
-            MaxPepCounts_table_4_joined_df["CountOfPeptideCounts"] > 1
-        ]
+    def query_4(self, table_1: pd.DataFrame) -> pd.DataFrame:
+        """
+        query_1 pairs with their peptides per protein and proteins per peptide counts, looked up
+        in the incidence matrix.
+        :return: dataframe with col: 'Protein', 'PeptideSequence', 'peptides_per_protein', 'proteins_per_peptide'
+        """
+        incidence = self.get_incidence()
+        # pairs without a peptide or protein have no counts, the former inner joins dropped them.
+        valid = table_1["PeptideSequence"].notna().to_numpy() & table_1["Protein"].notna().to_numpy()
+        table_1 = table_1[valid]
+        # row order of the former inner joins on Protein, then on PeptideSequence, which the
+        # report row order follows.
+        for key in ["Protein", "PeptideSequence"]:
+            table_1 = table_1.iloc[self.group_by_first_appearance(table_1[key].cat.codes.to_numpy())]
+        peptide_codes = table_1["PeptideSequence"].cat.codes.to_numpy()
+        protein_codes = table_1["Protein"].cat.codes.to_numpy()
+        merge_3 = pd.DataFrame({
+            "Protein": table_1["Protein"],
+            "PeptideSequence": table_1["PeptideSequence"],
+            "peptides_per_protein": incidence.peptides_per_protein[protein_codes],
+            "proteins_per_peptide": incidence.proteins_per_peptide[peptide_codes],
+        })
+
+        return merge_3.sort_values(by=["PeptideSequence"], kind="mergesort")
 
-        return filtered[["PeptideSequence", "CountOfPeptideCounts"]]
+    @staticmethod
+    def group_by_first_appearance(codes: np.ndarray) -> np.ndarray:
+        """
+        :return: positions that order rows by key, keys in order of first appearance and rows of a
+            key in their original order.
+        """
+        _, first_position, inverse = np.unique(codes, return_index=True, return_inverse=True)
+        key_rank = np.empty(len(first_position), dtype=np.int64)
+        key_rank[np.argsort(first_position)] = np.arange(len(first_position))
+        return np.argsort(key_rank[inverse], kind="stable")
 
     @write_df_excel
     def get_razor_protein_associated_with_peptide(self, table_4: pd.DataFrame) -> pd.DataFrame:
-
-        peps_with_1_protein = table_4[table_4["proteins_per_peptide"] == 1]
-
-        non_degenerate_razor_protein_df = peps_with_1_protein[["PeptideSequence", "Protein"]] 
-
-        peps_with_many_proteins = table_4[table_4["proteins_per_peptide"] > 1]
-
-        non_degenerate_protein_set = set(non_degenerate_razor_protein_df['Protein'].unique())
-        NonDegenerate_razor_protein_list_member_int_df = peps_with_many_proteins[peps_with_many_proteins['Protein'].isin(non_degenerate_protein_set)]
-
-        Degenerate_peptides_with_only_unique_protein =  NonDegenerate_razor_protein_list_member_int_df.drop_duplicates(subset=['PeptideSequence'], keep=False, inplace=False)[['PeptideSequence', 'Protein']]
-
-        Degenerate_peptides_with_morethanone_unique_protein_to_remove_df = NonDegenerate_razor_protein_list_member_int_df[NonDegenerate_razor_protein_list_member_int_df['PeptideSequence'].duplicated(keep=False)]
-
-        peptides_found_or_unable_to_match_set = set(Degenerate_peptides_with_morethanone_unique_protein_to_remove_df['PeptideSequence']) \
-            | set(Degenerate_peptides_with_only_unique_protein['PeptideSequence']) \
-            | set(non_degenerate_razor_protein_df['PeptideSequence'])
-        
-        max_peptide_per_protein_count = peps_with_many_proteins.copy()
-        max_peptide_per_protein_count = max_peptide_per_protein_count[~max_peptide_per_protein_count['PeptideSequence'].isin(peptides_found_or_unable_to_match_set)]
-        max_peptide_per_protein_count["max_peptides_per_protein"] = max_peptide_per_protein_count.groupby(["PeptideSequence"])["peptides_per_protein"].transform(max)
-        max_peptide_per_protein_count = max_peptide_per_protein_count[max_peptide_per_protein_count["peptides_per_protein"] == max_peptide_per_protein_count["max_peptides_per_protein"]]
-        Degenerate_peptides_with_max_nonunique_peptide_count_df = max_peptide_per_protein_count[["PeptideSequence", "Protein"]]
-
-        result = pd.concat([non_degenerate_razor_protein_df, Degenerate_peptides_with_only_unique_protein, Degenerate_peptides_with_max_nonunique_peptide_count_df])
+        """
+        Razor protein of every peptide, see PeptideProteinIncidence.razor_rule for the rules.
+        :return: dataframe with col: 'PeptideSequence', 'RazorProtein'. Rows of rule 0, 1 and 2
+            in turn, in table_4 order.
+        """
+        rule = self.get_incidence().razor_rule(
+            table_4["PeptideSequence"].cat.codes.to_numpy(),
+            table_4["Protein"].cat.codes.to_numpy(),
+        )
+        pairs = table_4[["PeptideSequence", "Protein"]]
+        result = pd.concat([pairs[rule == 0], pairs[rule == 1], pairs[rule == 2]])
         result = result.rename(columns={"Protein": "RazorProtein"})
         return result
 
     @write_df_excel
     def parse_MSGFjobs_MASIC_resultant(self) -> pd.DataFrame:
-        table_1 = self.query_1()
-        table_2 = self.query_2()
-        table_3 = self.query_3()
-        table_4 = self.query_4(table_1, table_2, table_3)
-        peptide_to_razor_protein_df = self.get_razor_protein_associated_with_peptide(table_4)
+        peptide_to_razor_protein_df = self.evaluate("get_razor_protein_associated_with_peptide")
         return peptide_to_razor_protein_df
 
     @write_df_excel
     def query_0(self) -> pd.DataFrame:
         """
 
-        :param gff_file: JGI annotation file.
+        Annotation of every protein, from the gff or its index (see load_annotation_index).
+
         :return: dataframe with col: ['protein', 'Product', 'pfam', 'ko', 'ec_number', 'cog']
         """
 
+        if self.annotation_df is not None:
+            # shared with other datasets: columns are replaced below, never modified in place.
+            attributeTag_df = self.annotation_df.copy(deep=False)
+        else:
+            attributeTag_df = load_annotation_index(
+                self.gff_file, self.annotation_cache_dir, self.is_metagenome_free_analysis
+            )
         if self.is_metagenome_free_analysis:
             tmp_fasta_df = self.fasta_txt_file_df[['ProteinName']].copy()
             tmp_fasta_df.rename(columns={"ProteinName": "Protein"}, inplace=True)
             tmp_fasta_df['protein_simple'] = tmp_fasta_df['Protein'].str.split('|').str[1]
             protein_map = tmp_fasta_df.set_index('protein_simple')['Protein'].to_dict()
 
-            col_of_interest = ["ID", "product", "ko", "ec_number", "cog", "pfam"]
-            parsed_attributes = self.annotation.df["attributes"].apply(self.parse_attributes)
-            attributeTag_df = pd.json_normalize(parsed_attributes).fillna("None")[col_of_interest]
-            cols_to_rename = {"ID": "Protein", "product": "Product"}
-            attributeTag_df.rename(columns=cols_to_rename, inplace=True)
             attributeTag_df['Protein'] = attributeTag_df['Protein'].map(protein_map)
             attributeTag_df = attributeTag_df.replace('NA', None)
         else:
-            filtered_df = self.annotation.filter_feature_of_type(["CDS"])
-            col_of_interest = ["ID", "product", "pfam", "ko", "ec_number", "cog"]
-            attributeTag_df = filtered_df.attributes_to_columns()[col_of_interest]
-            cols_to_rename = {"ID": "Protein", "product": "Product"}
-            attributeTag_df.rename(columns=cols_to_rename, inplace=True)
             # cleaning up columns
             # TODO: remove KO: EC: strings
             attributeTag_df["ko"] = attributeTag_df["ko"]  # .str.replace('KO:', '')
@@ -270,14 +782,21 @@ class DataOutputtable:
         return attributeTag_df
 
     @write_df_excel
-    def query_8(self) -> pd.DataFrame:
-        # TODO:remove all tables except table_5_6_7_unioned
-        # 1. get razor_protein_associated_with_peptide
-        #         table_1,table_2,table_3,table_4,
-        table_5_6_7_unioned = self.parse_MSGFjobs_MASIC_resultant()
-        # 2. get annotations
-        AnnotationSplitout_df = self.query_0()
+    def encode_annotation(self, AnnotationSplitout_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        :param AnnotationSplitout_df: annotations from query_0.
+        :return: the annotations with Protein in the resultant's protein categories. Proteins
+            that never occur in the resultant can't join to a peptide and are dropped.
+        """
+        AnnotationSplitout_df["Protein"] = AnnotationSplitout_df["Protein"].astype(self.protein_dtype)
+        return AnnotationSplitout_df.dropna(subset=["Protein"])
 
+    @write_df_excel
+    def query_8(self, table_5_6_7_unioned: pd.DataFrame, AnnotationSplitout_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        :param table_5_6_7_unioned: razor protein associated with each peptide.
+        :param AnnotationSplitout_df: annotations from encode_annotation.
+        """
         merged = table_5_6_7_unioned.merge(
             AnnotationSplitout_df,
             how="left",
@@ -302,8 +821,8 @@ class DataOutputtable:
 
     @write_df_excel
     def get_FwdPeptideSequences(self) -> pd.DataFrame:
-        FiltPeps_df = self.get_FiltPeps(self.resultant_df)
-        FiltPeps_df["GeneCount"] = FiltPeps_df.groupby(["PeptideSequence"])[
+        FiltPeps_df = self.get_FiltPeps()
+        FiltPeps_df["GeneCount"] = FiltPeps_df.groupby(["PeptideSequence"], observed=True)[
             "Protein"
         ].transform("nunique")
         return FiltPeps_df[["PeptideSequence", "GeneCount"]]
@@ -312,12 +831,7 @@ class DataOutputtable:
     def query_9(self) -> pd.DataFrame:
         FwdPeptideSequences_df = self.get_FwdPeptideSequences()
 
-        temp_df = self.resultant_df.copy()
-        # temp_df['Peptide'] = temp_df['Peptide'].str.extract(r'\.(.*)\.')
-
-        FiltPassPeptideAbundanceData = self.get_FiltPeps_gen(temp_df)[
-            ["PeptideSequence", "Protein"]
-        ]
+        FiltPassPeptideAbundanceData = self.get_FiltPeps_gen(["PeptideSequence", "Protein"])
 
         merged = FwdPeptideSequences_df.merge(
             FiltPassPeptideAbundanceData,
@@ -329,7 +843,7 @@ class DataOutputtable:
         return (
             merged[["PeptideSequence", "GeneCount", "Protein"]]
             .drop_duplicates()
-            .sort_values(by=["PeptideSequence"])
+            .sort_values(by=["PeptideSequence"], kind="mergesort")
         )
 
     def build_annotation_str(self, Protein: str, Product: str, pfam: str, ko: str, ec_number: str, cog: str) -> str:
@@ -353,75 +867,117 @@ class DataOutputtable:
             annotation_str = Protein
         return annotation_str
 
+    @staticmethod
+    def annotation_attribute(values: pd.Series, tag: str) -> pd.Series:
+        """
+        Columnar form of the `if value and (value != None) and (value != "nan")` checks in
+        build_annotation_str: ";tag=value" per row, or "" where the value is skipped.
+        None, "" and the string "nan" are skipped; a float NaN is kept and written as "nan".
+        """
+        text = values.astype(str)
+        skipped = (
+            (text == "")
+            | (values.notna() & (text == "nan"))
+            | (values.isna() & (text == "None"))
+        )
+        return (f";{tag}=" + text).where(~skipped, "")
+
+    def build_annotation_column(self, df: pd.DataFrame) -> pd.Series:
+        """
+        Vectorized build_annotation_str over the Protein, Product, pfam, ko, ec_number and cog columns of df.
+        """
+        protein = df["Protein"].astype(object)
+        annotation = "gene_name=" + protein
+        for column, tag in [
+            ("Product", "product"),
+            ("pfam", "pfam"),
+            ("ko", "ko"),
+            ("ec_number", "ec_number"),
+            ("cog", "cog"),
+        ]:
+            annotation = annotation + self.annotation_attribute(df[column], tag)
+
+        # the contaminants aren't present in the JGI provided annotation files!
+        is_contaminant = protein.str.startswith("Contaminant")
+        return annotation.where(~is_contaminant, protein)
+
+    @staticmethod
+    def join_grouped(
+        df: pd.DataFrame, keys: List[str], value: str, sep: str, sort_values: bool = True
+    ) -> pd.DataFrame:
+        """
+        Joins the values of each group of keys into one string, in a single sort over df.
+        Replaces groupby(keys)[value].transform(lambda x: sep.join(x)) followed by drop_duplicates;
+        merge the result back on keys where a per-row value is needed.
+
+        :param sort_values: join each group's values in sorted order, otherwise in the order they have in df.
+        :return: dataframe with col: keys + [value], one row per group, ordered by keys.
+        """
+        ordered = df[keys + [value]].dropna(subset=keys).sort_values(
+            by=keys + [value] if sort_values else keys, kind="mergesort"
+        )
+
+        # a group starts wherever any key differs from the previous row.
+        is_start = np.zeros(len(ordered), dtype=bool)
+        is_start[:1] = True
+        for key in keys:
+            key_values = ordered[key]
+            if isinstance(key_values.dtype, pd.CategoricalDtype):
+                key_values = key_values.cat.codes
+            key_values = key_values.to_numpy()
+            is_start[1:] |= key_values[1:] != key_values[:-1]
+        starts = np.flatnonzero(is_start)
+        ends = np.append(starts[1:], len(ordered))
+
+        values = ordered[value].tolist()
+        grouped = ordered.iloc[starts][keys].reset_index(drop=True)
+        grouped[value] = [sep.join(values[start:end]) for start, end in zip(starts.tolist(), ends.tolist())]
+        return grouped
+
     @write_df_excel
-    def query_10(self) -> pd.DataFrame:
-        table_9 = self.query_9()
-        AnnotationSplitout_df = self.query_0()
+    def query_10(self, table_9: pd.DataFrame, AnnotationSplitout_df: pd.DataFrame) -> pd.DataFrame:
         merged = table_9.merge(
             AnnotationSplitout_df, how="left", left_on=["Protein"], right_on=["Protein"]
         )
-        merged["annotation"] = merged.apply(
-            lambda x: self.build_annotation_str(
-                x.Protein, x.Product, x.pfam, x.ko, x.ec_number, x.cog
-            ),
-            axis=1,
-        )
+        merged["annotation"] = self.build_annotation_column(merged)
 
         return merged[
             ["PeptideSequence", "GeneCount", "Protein", "annotation"]
-        ].sort_values(by=["PeptideSequence"])
+        ].sort_values(by=["PeptideSequence"], kind="mergesort")
 
     @write_df_excel
-    def query_11(self) -> pd.DataFrame:
-        table_10 = self.query_10()
+    def query_11(self, table_10: pd.DataFrame) -> pd.DataFrame:
 
-        # prerare protein list
-        table_10["FullGeneList"] = (
-            table_10.sort_values("Protein")
-            .groupby(["PeptideSequence", "GeneCount"])["Protein"]
-            .transform(lambda x: ", ".join(x))
-        )
+        keys = ["PeptideSequence", "GeneCount"]
 
-        # sort them!
-        get_list_func = lambda x: x.split(", ") if len(x.split(", ")) > 1 else x
-        f = (
-            lambda x: ", ".join(sorted(get_list_func(x)))
-            if isinstance(get_list_func(x), list)
-            else get_list_func(x)
-        )
-        table_10["FullGeneList"] = table_10["FullGeneList"].apply(f)
+        # prepare sorted protein and annotation lists
+        PeptideGeneLists = self.join_grouped(table_10, keys, "Protein", ", ")
+        AnnotationLists = self.join_grouped(table_10, keys, "annotation", " | ")
 
-        table_10["AnnotationList"] = (
-            table_10.sort_values("annotation")
-            .groupby(["PeptideSequence", "GeneCount"])["annotation"]
-            .transform(lambda x: " | ".join(x))
-        )
+        # both are ordered by keys, one row per group.
+        PeptideGeneLists.rename(columns={"Protein": "FullGeneList"}, inplace=True)
+        PeptideGeneLists["AnnotationList"] = AnnotationLists["annotation"]
 
-        return (
-            table_10[["PeptideSequence", "GeneCount", "FullGeneList", "AnnotationList"]]
-            .drop_duplicates()
-            .sort_values(by=["PeptideSequence"])
-        )
+        return PeptideGeneLists[["PeptideSequence", "GeneCount", "FullGeneList", "AnnotationList"]]
 
     @write_df_excel
     def query_12(self) -> pd.DataFrame:
 
-        temp_df = self.resultant_df.copy()
-        FiltPassPeptideAbundanceData = self.get_FiltPeps_gen(temp_df)[
+        FiltPassPeptideAbundanceData = self.get_FiltPeps_gen(
             ["SpecIndex", "PeptideSequence", "StatMomentsArea"]
-        ].drop_duplicates(
+        ).drop_duplicates(
             subset=["SpecIndex", "PeptideSequence", "StatMomentsArea"]
         )  # .sort_values(by=[''])
         FiltPassPeptideAbundanceData[
             "SpectralCount"
-        ] = FiltPassPeptideAbundanceData.groupby(["PeptideSequence"])[
+        ] = FiltPassPeptideAbundanceData.groupby(["PeptideSequence"], observed=True)[
             "SpecIndex"
         ].transform(
             "count"
         )
         FiltPassPeptideAbundanceData[
             "sum(StatMomentsArea)"
-        ] = FiltPassPeptideAbundanceData.groupby(["PeptideSequence"])[
+        ] = FiltPassPeptideAbundanceData.groupby(["PeptideSequence"], observed=True)[
             "StatMomentsArea"
         ].transform(
             "sum"
@@ -432,23 +988,25 @@ class DataOutputtable:
                 ["PeptideSequence", "SpectralCount", "sum(StatMomentsArea)"]
             ]
             .drop_duplicates()
-            .sort_values(by=["PeptideSequence"])
+            .sort_values(by=["PeptideSequence"], kind="mergesort")
         )
 
     @write_df_excel
-    def query_13(self) -> pd.DataFrame:
-        temp_df = self.resultant_df.copy()
-        # temp_df['Dataset_x'] = 'default value'
-        filtered = self.get_FiltPeps_gen(temp_df)[
+    def query_13(
+        self,
+        PeptideGeneListsANDAnnotationList_df: pd.DataFrame,
+        PeptideRazorProteinAnnotated_df: pd.DataFrame,
+        PeptideAbundanceInfo_df: pd.DataFrame,
+    ) -> pd.DataFrame:
+        filtered = self.get_FiltPeps_gen(
             ["PeptideSequence", "QValue"]
             # ["Dataset_x", "PeptideSequence", "QValue"]
-        ]
+        )
         groupby_columns = ["PeptideSequence"]
         # groupby_columns = ["Dataset_x", "PeptideSequence"]
-        filtered["min(QValue)"] = filtered.groupby(groupby_columns)["QValue"].transform(
+        filtered["min(QValue)"] = filtered.groupby(groupby_columns, observed=True)["QValue"].transform(
             "min"
         )
-        PeptideGeneListsANDAnnotationList_df = self.query_11()
 
         # inner join on 'PeptideSequence'
         merged_1 = filtered.merge(
@@ -458,16 +1016,11 @@ class DataOutputtable:
             right_on=["PeptideSequence"],
         )
 
-        PeptideRazorProteinAnnotated_df = self.query_8()
-        # saved for multiple call.
-        self.query_8_result = PeptideRazorProteinAnnotated_df.copy()
-
         # left outer join 'PeptideSequence'
         merged_2 = merged_1.merge(
             PeptideRazorProteinAnnotated_df, how="left", on=["PeptideSequence"]
         )
 
-        PeptideAbundanceInfo_df = self.query_12()
         # inner join on 'PeptideSequence'
         merged_3 = merged_2.merge(
             PeptideAbundanceInfo_df,
@@ -508,17 +1061,16 @@ class DataOutputtable:
         )
 
     @write_df_excel
-    def query_14(self) -> pd.DataFrame:
-        Peptide_Report = self.query_13()
+    def query_14(self, Peptide_Report: pd.DataFrame) -> pd.DataFrame:
 
-        Peptide_Report["UniquePeptideCount"] = Peptide_Report.groupby(["RazorProtein"])[
+        Peptide_Report["UniquePeptideCount"] = Peptide_Report.groupby(["RazorProtein"], observed=True)[
             "PeptideSequence"
         ].transform("count")
-        Peptide_Report["SummedSpectraCounts"] = Peptide_Report.groupby(["RazorProtein"])[
+        Peptide_Report["SummedSpectraCounts"] = Peptide_Report.groupby(["RazorProtein"], observed=True)[
             "SpectralCount"
         ].transform("sum")
         Peptide_Report["SummedPeptideMASICAbundances"] = Peptide_Report.groupby(
-            ["RazorProtein"]
+            ["RazorProtein"], observed=True
         )["sum(MASICAbundance)"].transform("sum")
 
         return (
@@ -531,15 +1083,16 @@ class DataOutputtable:
                 ]
             ]
             .drop_duplicates() # TODO check if this needs to be removed, probably does
-            .sort_values(by=["RazorProtein"])
+            .sort_values(by=["RazorProtein"], kind="mergesort")
         )
 
     @write_df_excel
-    def query_15(self) -> pd.DataFrame:
+    def query_15(self, PeptideRazorProteinAnnotated_df: pd.DataFrame) -> pd.DataFrame:
 
-        PeptideRazorProteinAnnotated_df = self.query_8_result  # self.query_8()
-        temp_df = self.resultant_df.copy()
-        temp_df["PeptideSequence"] = temp_df["Peptide"].str.extract(r"\.(.*)\.")
+        if self.resultant_df is None:
+            temp_df = self.resultant_pairs_df.copy(deep=False)
+        else:
+            temp_df = self.resultant_df[["PeptideSequence", "Protein"]]
         merged = PeptideRazorProteinAnnotated_df.merge(
             temp_df,
             how="inner",
@@ -551,37 +1104,27 @@ class DataOutputtable:
         return (
             non_decoy_filtered_df[["RazorProtein", "Protein"]]
             .drop_duplicates(subset=["RazorProtein", "Protein"]) # TODO check if this needs to be removed, probably does
-            .sort_values(by=["RazorProtein"])
+            .sort_values(by=["RazorProtein"], kind="mergesort")
         )
 
     @write_df_excel
-    def query_16(self) -> pd.DataFrame:
-        RazorProteinGeneLists = self.query_15()  # .drop_duplicates(subset=['Protein'])
-
-        # prepare protein list
-        RazorProteinGeneLists["FullGeneList"] = RazorProteinGeneLists.groupby(
-            ["RazorProtein"]
-        )["Protein"].transform(lambda x: ", ".join(x))
-        # sort them!
-        get_list_func = lambda x: x.split(", ") if len(x.split(", ")) > 1 else x
-        f = (
-            lambda x: ", ".join(sorted(get_list_func(x)))
-            if isinstance(get_list_func(x), list)
-            else get_list_func(x)
-        )
-        RazorProteinGeneLists["FullGeneList"] = RazorProteinGeneLists[
-            "FullGeneList"
-        ].apply(f)
-
-        RazorProteinGeneLists["GeneCount"] = RazorProteinGeneLists.groupby(
-            ["RazorProtein"]
-        )["Protein"].transform("count")
-        RazorProteinGeneLists.sort_values(["FullGeneList"], ascending=True, inplace=True)
+    def query_16(self, RazorProteinGeneLists: pd.DataFrame) -> pd.DataFrame:
+
+        # prepare sorted protein list
+        FullGeneLists = self.join_grouped(RazorProteinGeneLists, ["RazorProtein"], "Protein", ", ")
+        FullGeneLists.rename(columns={"Protein": "FullGeneList"}, inplace=True)
+
+        GeneCounts = (
+            RazorProteinGeneLists.groupby(["RazorProtein"], observed=True)["Protein"]
+            .count()
+            .reset_index(name="GeneCount")
+        )
 
         return (
-            RazorProteinGeneLists[["RazorProtein", "GeneCount", "FullGeneList"]]
-            .drop_duplicates()
-            .sort_values(by=["RazorProtein"])
+            GeneCounts.merge(FullGeneLists, how="inner", on=["RazorProtein"])[
+                ["RazorProtein", "GeneCount", "FullGeneList"]
+            ]
+            .sort_values(by=["RazorProtein"], kind="mergesort")
         )
 
     def mod_build_annotation_str(
@@ -604,52 +1147,58 @@ class DataOutputtable:
                 annotation_str = annotation_str + f";cog={cog}"
             return annotation_str
 
-    @write_df_excel
-    def query_17(self) -> pd.DataFrame:
+    def mod_build_annotation_column(self, df: pd.DataFrame) -> pd.Series:
+        """
+        Vectorized mod_build_annotation_str over the RazorProtein, Protein, Product, pfam, ko,
+        ec_number and cog columns of df.
+        """
+        product = df["Product"].astype(str)
+        annotation = "gene_name=" + df["Protein"].astype(object) + ";product=" + product
+        for column in ["pfam", "ko", "ec_number", "cog"]:
+            annotation = annotation + self.annotation_attribute(df[column], column)
 
-        AnnotationSplitout_df = self.query_0()
+        # handle <class 'float'> nan, None is written as product=None
+        is_nan_product = df["Product"].isna() & (product != "None")
+        return annotation.where(~is_nan_product, df["RazorProtein"].astype(object))
 
-        table_15 = self.query_15()  # have RazorProtein
+    @write_df_excel
+    def query_17(self, AnnotationSplitout_df: pd.DataFrame, table_15: pd.DataFrame) -> pd.DataFrame:
+        # table_15 have RazorProtein
         ProteinRazorProteinsAnnotated = table_15.merge(
             AnnotationSplitout_df, how="left", left_on=["Protein"], right_on=["Protein"]
         )
         #         display(ProteinRazorProteinsAnnotated)
-        ProteinRazorProteinsAnnotated["annotation"] = ProteinRazorProteinsAnnotated.apply(
-            lambda x: self.mod_build_annotation_str(
-                x.RazorProtein, x.Protein, x.Product, x.pfam, x.ko, x.ec_number, x.cog
-            ),
-            axis=1,
+        ProteinRazorProteinsAnnotated["annotation"] = self.mod_build_annotation_column(
+            ProteinRazorProteinsAnnotated
         )
 
         return (
             ProteinRazorProteinsAnnotated[["RazorProtein", "Protein", "annotation"]]
             .drop_duplicates()
-            .sort_values(by=["RazorProtein"])
+            .sort_values(by=["RazorProtein"], kind="mergesort")
         )
 
     @write_df_excel
-    def query_18(self) -> pd.DataFrame:
-
-        RazorProteinAnnotationLists = self.query_17()
+    def query_18(self, RazorProteinAnnotationLists: pd.DataFrame) -> pd.DataFrame:
 
-        RazorProteinAnnotationLists[
-            "AnnotationList"
-        ] = RazorProteinAnnotationLists.groupby(["RazorProtein"])["annotation"].transform(
-            lambda x: " | ".join(x)
+        # annotations are joined in the order query_17 returns them.
+        AnnotationLists = self.join_grouped(
+            RazorProteinAnnotationLists, ["RazorProtein"], "annotation", " | ", sort_values=False
         )
 
-        return (
-            RazorProteinAnnotationLists[["RazorProtein", "AnnotationList"]]
-            .drop_duplicates()
-            .sort_values(by=["RazorProtein"])
-        )
+        return AnnotationLists.rename(columns={"annotation": "AnnotationList"})
 
     @write_df_excel
-    def query_19(self) -> pd.DataFrame:
-        Peptide_Report_df = self.peptide_report.copy()[
+    def query_19(
+        self,
+        Peptide_Report_df: pd.DataFrame,
+        RazorProteinGeneLists: pd.DataFrame,
+        RazorProteinAnnotationLists: pd.DataFrame,
+        PeptideAbundanceInfo_df: pd.DataFrame,
+    ) -> pd.DataFrame:
+        Peptide_Report_df = Peptide_Report_df[
             ["DatasetName", "RazorProtein", "Product", "EC_Number", "pfam", "KO", "COG"]
         ]
-        RazorProteinGeneLists = self.query_16()
         merged_1 = Peptide_Report_df.merge(
             RazorProteinGeneLists,
             how="inner",
@@ -657,7 +1206,6 @@ class DataOutputtable:
             right_on=["RazorProtein"],
         )
 
-        RazorProteinAnnotationLists = self.query_18()
         merged_2 = merged_1.merge(
             RazorProteinAnnotationLists,
             how="inner",
@@ -665,7 +1213,6 @@ class DataOutputtable:
             right_on=["RazorProtein"],
         )
 
-        PeptideAbundanceInfo_df = self.query_14()
         merged_3 = merged_2.merge(
             PeptideAbundanceInfo_df,
             how="inner",
@@ -697,18 +1244,17 @@ class DataOutputtable:
 
 
     @write_df_excel
-    def query_20(self) -> pd.DataFrame:
+    def query_20(self, AnnotationSplitout_df: pd.DataFrame) -> pd.DataFrame:
 
         total_proteins_per_peptide = pd.DataFrame(
-            {"total_protein_count": self.query_0()["Protein"].nunique()}, index=[0]
+            {"total_protein_count": AnnotationSplitout_df["Protein"].nunique()}, index=[0]
         )
 
         return total_proteins_per_peptide
 
     @write_df_excel
     def query_21(self) -> pd.DataFrame:
-        temp_df = self.resultant_df.copy()
-        filtered = self.get_FiltPeps_gen(temp_df)[["Scan", "Charge"]]
+        filtered = self.get_FiltPeps_gen(["Scan", "Charge"])
         PSM_Count = pd.DataFrame(
             {"PSM_Count": len(filtered.groupby(["Scan", "Charge"])["Scan"])}, index=[0]
         )
@@ -717,11 +1263,14 @@ class DataOutputtable:
 
     @write_df_excel
     def query_22(self) -> pd.DataFrame:
-        temp_df = self.resultant_df.copy()
+        if self.resultant_df is None:
+            return pd.DataFrame({"Total_PSM_Count": self.total_psm_count}, index=[0])
+
+        temp_df = self.resultant_df[["Scan", "Charge"]]
         Total_PSM_Count = pd.DataFrame(
             {
                 "Total_PSM_Count": len(
-                    temp_df[["Scan", "Charge"]].groupby(["Scan", "Charge"])["Scan"]
+                    temp_df.groupby(["Scan", "Charge"])["Scan"]
                 )
             },
             index=[0],
@@ -730,11 +1279,11 @@ class DataOutputtable:
         return Total_PSM_Count
 
     @write_df_excel
-    def query_23(self) -> pd.DataFrame:
+    def query_23(self, PSM_Count: pd.DataFrame, Total_PSM_Count: pd.DataFrame) -> pd.DataFrame:
         Table12 = pd.DataFrame(
             {
                 "PSM_identification_rate": (
-                    self.query_21().PSM_Count / self.query_22().Total_PSM_Count
+                    PSM_Count.PSM_Count / Total_PSM_Count.Total_PSM_Count
                 )
                 * 100
             },
@@ -744,8 +1293,13 @@ class DataOutputtable:
         return Table12
 
     @write_df_excel
-    def query_24(self) -> pd.DataFrame:
-        Peptide_Report_df = self.peptide_report.copy()
+    def query_24(
+        self,
+        Peptide_Report_df: pd.DataFrame,
+        PSM_Count: pd.DataFrame,
+        Table12: pd.DataFrame,
+        total_proteins_per_peptide: pd.DataFrame,
+    ) -> pd.DataFrame:
         unique_peptide_seq_count = (
             Peptide_Report_df.PeptideSequence.drop_duplicates().count()
         )
@@ -754,12 +1308,12 @@ class DataOutputtable:
 
         qc_metrics = pd.DataFrame(
             {
-                "PSM_count": self.query_21().PSM_Count,
-                "PSM_identification_rate": self.query_23().PSM_identification_rate,
+                "PSM_count": PSM_Count.PSM_Count,
+                "PSM_identification_rate": Table12.PSM_identification_rate,
                 "unique_peptide_seq_count": unique_peptide_seq_count,
                 "RazorProtein_count": RazorProtein_count,
                 "mean_peptide_count": mean_peptide_count,
-                "total_protein_count": self.query_20().total_protein_count
+                "total_protein_count": total_proteins_per_peptide.total_protein_count
             },
             index=[0],
         )
@@ -767,30 +1321,31 @@ class DataOutputtable:
         return qc_metrics
 
     @write_df_excel
-    def create_peptide_report(self) -> pd.DataFrame:
-        Peptide_Report_df = self.query_13()
+    def create_peptide_report(self, Peptide_Report_df: pd.DataFrame) -> pd.DataFrame:
         Peptide_Report_df.sort_values(["GeneCount"], ascending=False, inplace=True)
 
         return Peptide_Report_df
 
     @write_df_excel
-    def create_protein_report(self) -> pd.DataFrame:
-        Protein_Report_df = self.query_19()
+    def create_protein_report(self, Protein_Report_df: pd.DataFrame) -> pd.DataFrame:
         Protein_Report_df.sort_values(["GeneCount"], ascending=False, inplace=True)
         
         return Protein_Report_df
 
     @write_df_excel
-    def create_qc_metrics(self) -> pd.DataFrame:
-        qc_metrics_df = self.query_24()
-        
+    def create_qc_metrics(self, qc_metrics_df: pd.DataFrame) -> pd.DataFrame:
+
         return qc_metrics_df
 
     def gen_reports(self) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
         print(f"ReportGen start {self.dataset_id} : {self.faa_id}")
-        self.peptide_report = self.create_peptide_report()
-        protein_report = self.create_protein_report()
-        qc_metrics_report = self.create_qc_metrics()
+        (
+            self.peptide_report,
+            protein_report,
+            qc_metrics_report,
+        ) = self.run_query_graph(
+            ["create_peptide_report", "create_protein_report", "create_qc_metrics"]
+        )
         print(f"ReportGen end {self.dataset_id} : {self.faa_id}")
 
         # rename to adhere nmdc.schema.json
@@ -828,6 +1383,184 @@ class DataOutputtable:
                 attributes_map[key] = value
         return attributes_map
 
+def write_reports(data_obj: DataOutputtable, output_dir=".", reports=None, columnar=False) -> List[Path]:
+    """
+    Generates the reports of data_obj and writes them as
+    {dataset_id}_{faa_id}_{Peptide_Report,Protein_Report,QC_metrics}.tsv in output_dir,
+    plus {dataset_id}_{faa_id}_Query_Profile.tsv when data_obj profiles its queries.
+
+    :param reports: gen_reports() output, generated when not given.
+    :param columnar: also write each report as a zstd compressed .parquet next to its .tsv.
+    :return: paths of the written reports.
+    """
+    if reports is None:
+        reports = data_obj.gen_reports()
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    output_files = []
+    for report, name in zip(reports, ["Peptide_Report", "Protein_Report", "QC_metrics"]):
+        output_file = Path(output_dir) / f"{data_obj.dataset_id}_{data_obj.faa_id}_{name}.tsv"
+        report.to_csv(output_file, sep="\t", index=False)
+        output_files.append(output_file)
+        if columnar:
+            output_file = output_file.with_suffix(".parquet")
+            report.to_parquet(output_file, index=False, compression="zstd")
+            output_files.append(output_file)
+    if data_obj.profile_queries:
+        output_file = Path(output_dir) / f"{data_obj.dataset_id}_{data_obj.faa_id}_Query_Profile.tsv"
+        data_obj.query_profile().to_csv(output_file, sep="\t", index=False)
+        output_files.append(output_file)
+    return output_files
+
+def write_threshold_sweep(
+    data_obj: DataOutputtable,
+    thresholds: List[str],
+    output_dir=".",
+    main_threshold: Optional[str] = None,
+    main_reports=None,
+    columnar=False,
+) -> Path:
+    """
+    Writes the reports of data_obj for every threshold, to output_dir/threshold_{threshold}/, and
+    the QC metrics of all thresholds to output_dir/{dataset_id}_{faa_id}_Threshold_Sweep.tsv.
+    Everything is generated from the already loaded data, see DataOutputtable.set_threshold.
+
+    :param main_threshold: threshold of the primary reports, also listed in the summary, with
+        primary set, from main_reports (their gen_reports() output).
+    :param columnar: also write the reports as Parquet, see write_reports.
+    :return: path of the summary.
+    """
+    def summary_row(threshold, reports, primary):
+        qc_metrics = reports[2].copy()
+        qc_metrics.insert(0, "threshold", threshold)
+        qc_metrics.insert(1, "primary", primary)
+        qc_metrics.insert(2, "peptide_report_rows", len(reports[0]))
+        qc_metrics.insert(3, "protein_report_rows", len(reports[1]))
+        return qc_metrics
+
+    summary = []
+    if main_threshold is not None:
+        summary.append(summary_row(main_threshold, main_reports, True))
+    for threshold in sorted(thresholds, key=float):
+        data_obj.set_threshold(threshold)
+        reports = data_obj.gen_reports()
+        write_reports(data_obj, Path(output_dir) / f"threshold_{threshold}", reports, columnar=columnar)
+        summary.append(summary_row(threshold, reports, False))
+
+    summary_df = pd.concat(summary, ignore_index=True)
+    # the primary row in threshold order too, before a sweep row of the same threshold.
+    summary_df = summary_df.iloc[np.argsort(summary_df["threshold"].astype(float).to_numpy(), kind="stable")]
+    summary_file = Path(output_dir) / f"{data_obj.dataset_id}_{data_obj.faa_id}_Threshold_Sweep.tsv"
+    summary_df.to_csv(summary_file, sep="\t", index=False)
+    return summary_file
+
+# annotation and fasta txt frames shared by every dataset of a batch, see run_batch.
+_batch_shared = {}
+
+def _init_batch(shared: dict):
+    _batch_shared.update(shared)
+
+def _run_batch_entry(entry: dict) -> List[Path]:
+    shared = _batch_shared
+    sweep_thresholds = shared["sweep_thresholds"]
+    data_obj = DataOutputtable(
+        shared["gff_file"],
+        entry["resultant_file"],
+        shared["fasta_txt_file"],
+        # in streaming mode the load threshold bounds the sweep, see set_threshold.
+        max([entry["threshold"]] + sweep_thresholds, key=float),
+        entry["dataset_id"],
+        shared["faa_id"],
+        entry["dataset_name"],
+        shared["did_split_analysis"],
+        shared["is_metagenome_free_analysis"],
+        drop_intermediates=True,
+        annotation_df=shared["annotation_df"],
+        fasta_txt_df=shared["fasta_txt_df"],
+        profile_queries=shared["profile_queries"],
+        resultant_chunksize=shared["resultant_chunksize"],
+    )
+    if not sweep_thresholds:
+        return write_reports(data_obj, shared["output_dir"], columnar=shared["columnar_reports"])
+
+    data_obj.set_threshold(entry["threshold"])
+    reports = data_obj.gen_reports()
+    output_files = write_reports(data_obj, shared["output_dir"], reports, columnar=shared["columnar_reports"])
+    output_files.append(
+        write_threshold_sweep(
+            data_obj,
+            sweep_thresholds,
+            Path(shared["output_dir"]) / "threshold_sweep",
+            main_threshold=entry["threshold"],
+            main_reports=reports,
+            columnar=shared["columnar_reports"],
+        )
+    )
+    return output_files
+
+def read_manifest(manifest_file) -> List[dict]:
+    """
+    Reads a batch manifest: a tab separated file with header
+    dataset_id, resultant_file, threshold, dataset_name and one row per dataset.
+    """
+    manifest_df = pd.read_csv(
+        manifest_file,
+        sep="\t",
+        usecols=["dataset_id", "resultant_file", "threshold", "dataset_name"],
+        dtype=str,
+    )
+    return manifest_df.to_dict("records")
+
+def run_batch(
+    manifest: List[dict],
+    gff_file,
+    fasta_txt_file,
+    faa_id,
+    did_split_analysis: bool,
+    is_metagenome_free_analysis: bool,
+    output_dir=".",
+    processes: int = 1,
+    annotation_cache_dir=None,
+    profile_queries: bool = False,
+    resultant_chunksize: Optional[int] = None,
+    sweep_thresholds: Optional[List[str]] = None,
+    columnar_reports: bool = False,
+) -> List[List[Path]]:
+    """
+    Writes the reports of every dataset in manifest, all searched against the same gff and
+    fasta txt. Both files are read once and shared by all datasets.
+
+    :param manifest: entries with keys dataset_id, resultant_file, threshold, dataset_name
+        (see read_manifest).
+    :param processes: number of worker processes, datasets run one after another when 1.
+        Workers receive the shared frames once, at start up.
+    :param sweep_thresholds: also write every dataset's reports for these thresholds, to
+        output_dir/threshold_sweep (see write_threshold_sweep).
+    :param columnar_reports: also write the reports as Parquet, see write_reports.
+    :return: paths of the written reports, per entry.
+    """
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    shared = {
+        "gff_file": gff_file,
+        "fasta_txt_file": fasta_txt_file,
+        "faa_id": faa_id,
+        "did_split_analysis": did_split_analysis,
+        "is_metagenome_free_analysis": is_metagenome_free_analysis,
+        "output_dir": output_dir,
+        "profile_queries": profile_queries,
+        "resultant_chunksize": resultant_chunksize,
+        "sweep_thresholds": list(sweep_thresholds or []),
+        "columnar_reports": columnar_reports,
+        "annotation_df": load_annotation_index(gff_file, annotation_cache_dir, is_metagenome_free_analysis),
+        "fasta_txt_df": read_tsv(fasta_txt_file, FASTA_TXT_DTYPES),
+    }
+    if processes <= 1:
+        _init_batch(shared)
+        return [_run_batch_entry(entry) for entry in manifest]
+
+    with multiprocessing.Pool(processes, initializer=_init_batch, initargs=(shared,)) as pool:
+        # one dataset per task: datasets are few and large.
+        return pool.map(_run_batch_entry, manifest, chunksize=1)
+
 if __name__ == "__main__":
 
     fasta_txt_file = sys.argv[1]
@@ -844,31 +1577,58 @@ if __name__ == "__main__":
 
     is_split_analysis = is_split_analysis.rstrip().lower() == "true"
     is_metagenome_free_analysis = is_metagenome_free_analysis.rstrip().lower() == "true"
+    # optional comma separated thresholds to also write reports for, to threshold_sweep/.
+    sweep_thresholds = [t for t in os.environ.get("SWEEP_THRESHOLDS", "").split(",") if t]
+    # q-values from compute_fdr.py --qvalues: in split analysis the thresholds, sweep thresholds
+    # included, are then FDRs, applied to the PSM q-values instead of as raw SpecEValues.
+    qvalue_file = os.environ.get("FDR_QVALUE_FILE")
+    if is_split_analysis and qvalue_file:
+        qvalues = read_qvalues(qvalue_file)
+        threshold = qvalue_cutoff(qvalues, threshold)
+        print(f"SpecEValue threshold for q-value <= {sys.argv[6]}: {threshold}\n")
+        sweep_fdrs, sweep_thresholds = sweep_thresholds, []
+        for fdr in sweep_fdrs:
+            sweep_thresholds.append(qvalue_cutoff(qvalues, fdr))
+            print(f"SpecEValue sweep threshold for q-value <= {fdr}: {sweep_thresholds[-1]}\n")
+        del qvalues
 
     data_obj = DataOutputtable(
         gff_file,
         resultant_file,
         fasta_txt_file,
-        threshold,
+        max([threshold] + sweep_thresholds, key=float),
         dataset_id,
         faa_id,
         dataset_name,
         is_split_analysis,
-        is_metagenome_free_analysis
+        is_metagenome_free_analysis,
+        drop_intermediates=True,
+        # optional directory of prebuilt annotation indexes, see build_annotation_index.py
+        annotation_cache_dir=os.environ.get("ANNOTATION_INDEX_DIR"),
+        # writes {dataset_id}_{faa_id}_Query_Profile.tsv next to the reports.
+        profile_queries=os.environ.get("PROFILE_QUERIES", "").lower() == "true",
+        # stream the resultant in chunks of this many rows, for resultants larger than memory.
+        resultant_chunksize=int(os.environ["RESULTANT_CHUNKSIZE"]) if os.environ.get("RESULTANT_CHUNKSIZE") else None,
     )
 
     # data_obj.parse_MSGFjobs_MASIC_resultant()
 
-    (
-        peptide_report,
-        protein_report,
-        qc_metrics_report,
-    ) = data_obj.gen_reports()
-
-    # write dfs to file.
-    peptide_report.to_csv(f"{dataset_id}_{faa_id}_Peptide_Report.tsv", sep="\t", index=False)
-    protein_report.to_csv(f"{dataset_id}_{faa_id}_Protein_Report.tsv", sep="\t", index=False)
-    qc_metrics_report.to_csv( f"{dataset_id}_{faa_id}_QC_metrics.tsv", sep="\t", index=False)
+    # also write the reports as zstd compressed parquet next to the tsvs.
+    columnar_reports = os.environ.get("REPORT_PARQUET", "").lower() == "true"
+    if sweep_thresholds:
+        data_obj.set_threshold(threshold)
+        reports = data_obj.gen_reports()
+        write_reports(data_obj, reports=reports, columnar=columnar_reports)
+        write_threshold_sweep(
+            data_obj,
+            sweep_thresholds,
+            "threshold_sweep",
+            main_threshold=threshold,
+            main_reports=reports,
+            columnar=columnar_reports,
+        )
+    else:
+        write_reports(data_obj, columnar=columnar_reports)
     
     # # flush and close excel writer
     # data_obj.writer.close()
\ No newline at end of file
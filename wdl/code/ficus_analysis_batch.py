@@ -0,0 +1,47 @@
+import argparse
+import os
+import sys
+
+from ficus_analysis import read_manifest, run_batch
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Runs ficus_analysis.py for every dataset of a manifest against one shared gff and fasta txt'
+    )
+    parser.add_argument('--manifest', type=str, required=True, help='Tab separated file with columns dataset_id, resultant_file, threshold, dataset_name')
+    parser.add_argument('--gff', type=str, required=True, help='Annotation gff file')
+    parser.add_argument('--fasta-txt', type=str, required=True, help='ProteinDigestionSimulator txt of the faa file')
+    parser.add_argument('--faa-id', type=str, required=True, help='Used in the report file names')
+    parser.add_argument('--did-split', action='store_true', help='Thresholds are SpecEValues of a split analysis')
+    parser.add_argument('--metagenome-free', action='store_true', help='Kaiko gff of a metagenome free analysis')
+    parser.add_argument('--processes', type=int, default=1, help='Number of datasets to run in parallel')
+    parser.add_argument('--cache-dir', type=str, default=os.environ.get('ANNOTATION_INDEX_DIR'), help='Annotation index directory, see build_annotation_index.py')
+    parser.add_argument('--profile', action='store_true', help='Also write a per query performance profile for every dataset')
+    parser.add_argument('--chunksize', type=int, default=None, help='Stream resultants in chunks of this many rows')
+    parser.add_argument('--sweep-thresholds', type=str, default=None, help='Comma separated thresholds to also write reports for')
+    parser.add_argument('--parquet', action='store_true', help='Also write the reports as compressed parquet')
+    parser.add_argument('--out', type=str, default='.', help='Directory to write the reports to')
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+
+    manifest = read_manifest(args.manifest)
+    reports = run_batch(
+        manifest,
+        args.gff,
+        args.fasta_txt,
+        args.faa_id,
+        args.did_split,
+        args.metagenome_free,
+        output_dir=args.out,
+        processes=args.processes,
+        annotation_cache_dir=args.cache_dir,
+        profile_queries=args.profile,
+        resultant_chunksize=args.chunksize,
+        sweep_thresholds=args.sweep_thresholds.split(',') if args.sweep_thresholds else None,
+        columnar_reports=args.parquet,
+    )
+    for entry, output_files in zip(manifest, reports):
+        sys.stdout.write("\t".join([entry['dataset_id']] + [str(f) for f in output_files]) + "\n")
@@ -0,0 +1,80 @@
+import argparse
+import os
+import sys
+
+from compute_fdr import get_psms, get_qvalues
+from ficus_analysis import DataOutputtable, qvalue_cutoff, write_reports
+from results_merge import MergedFileWriter, merge_tables
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Runs results_merge.py, compute_fdr.py --qvalues and ficus_analysis.py in one process, '
+                    'passing the merged file and the q-values in memory'
+    )
+    parser.add_argument('--sicstats', type=str, required=True, help='SICstats file from MASIC')
+    parser.add_argument('--syn', type=str, required=True, help='syn file from MS-GF+')
+    parser.add_argument('--fht', type=str, default=None, help='First hits file, needed with --did-split')
+    parser.add_argument('--fasta-txt', type=str, required=True, help='ProteinDigestionSimulator txt of the faa file')
+    parser.add_argument('--gff', type=str, required=True, help='Annotation gff file')
+    parser.add_argument('--dataset-id', type=str, required=True, help='Used in the report file names')
+    parser.add_argument('--faa-id', type=str, required=True, help='Used in the report file names')
+    parser.add_argument('--dataset-name', type=str, required=True, help='')
+    parser.add_argument('--threshold', type=str, required=True,
+                        help='QValue threshold, or with --did-split the FDR the first hit q-values are cut at')
+    parser.add_argument('--did-split', action='store_true', help='The fasta was split, search the threshold in the first hits')
+    parser.add_argument('--metagenome-free', action='store_true', help='Kaiko gff of a metagenome free analysis')
+    parser.add_argument('--engine', choices=['c', 'pyarrow'], default='c', help='pandas CSV parser to read the SICstats and syn files with')
+    parser.add_argument('--cache-dir', type=str, default=os.environ.get('ANNOTATION_INDEX_DIR'), help='Annotation index directory, see build_annotation_index.py')
+    parser.add_argument('--parquet', action='store_true', help='Also write the reports as compressed parquet')
+    parser.add_argument('--merged-output', type=str, default=None, help='Also write the merged file, as results_merge.py does')
+    parser.add_argument('--qvalues', type=str, default=None, help='Also write the first hit q-values, as compute_fdr.py --qvalues does')
+    parser.add_argument('--out', type=str, default='.', help='Directory to write the reports to')
+
+    args = parser.parse_args()
+    if args.did_split and args.fht is None:
+        parser.error('--did-split needs --fht')
+    return args
+
+def spec_e_value_threshold(fht, fdr, qvalue_output=None) -> str:
+    '''
+    The SpecEValue threshold ficus_analysis.py applies for an FDR with FDR_QVALUE_FILE set.
+    :param qvalue_output: also write the q-values to this file
+    '''
+    qvalues = get_qvalues(get_psms(fht))
+    if qvalue_output is not None:
+        qvalues.to_csv(qvalue_output, sep='\t', index=False)
+    return qvalue_cutoff(qvalues, fdr)
+
+if __name__ == '__main__':
+    args = get_args()
+
+    merged_df = merge_tables(args.sicstats, args.syn, args.engine)
+    if args.merged_output is not None:
+        writer = MergedFileWriter(args.merged_output)
+        writer.write(merged_df)
+        writer.close()
+
+    threshold = args.threshold
+    if args.did_split:
+        threshold = spec_e_value_threshold(args.fht, args.threshold, args.qvalues)
+        print(f'SpecEValue threshold for q-value <= {args.threshold}: {threshold}')
+
+    data_obj = DataOutputtable(
+        args.gff,
+        None,
+        args.fasta_txt,
+        threshold,
+        args.dataset_id,
+        args.faa_id,
+        args.dataset_name,
+        args.did_split,
+        args.metagenome_free,
+        drop_intermediates=True,
+        annotation_cache_dir=args.cache_dir,
+        resultant_df=merged_df,
+    )
+    # DataOutputtable keeps its own copy of the columns it needs
+    del merged_df
+
+    for output_file in write_reports(data_obj, args.out, columnar=args.parquet):
+        sys.stdout.write(f'{output_file}\n')
@@ -1,5 +1,6 @@
 import click
 import math
+import numpy as np
 import pandas as pd
 
 
@@ -17,60 +18,102 @@ def format_sci_conditional(x, exp_threshold=6, precision=6):
     else:
         return x
 
-@click.command()
-@click.option('--sicstats', type=click.Path(exists=True), required=True, help='Path to SICstats file from MASIC.')
-@click.option('--syn', type=click.Path(exists=True), required=True, help='Path to syn file from MS-GF+.')
-@click.option('--output', type=click.Path(writable=True), required=True, help='Filepath to write the combined output CSV.')
-def merge_files(sicstats, syn, output):
+def format_sci_column(values, exp_threshold=6, precision=6):
     """
-    Merges SICstats and syn files side-by-side and writes the combined DataFrame to a TSV output file.
+    format_sci_conditional over a float column, with the same strings. The exponents and the
+    choice of notation are computed with NumPy; only the string formatting is per value.
+    NaN and inf are left as they are.
     """
+    x = values.to_numpy(dtype=float)
+    finite = np.isfinite(x)
+    zero = x == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log10 = np.log10(np.abs(x))
+        # math.log10 decides near powers of ten, where NumPy's log10 may round the other way
+        near = np.flatnonzero(finite & ~zero & (np.abs(log10 - np.round(log10)) < 1e-9))
+    log10[near] = [math.log10(abs(v)) for v in x[near].tolist()]
+    exp = np.floor(log10)
+
+    sci = finite & ~zero & (np.abs(exp) >= exp_threshold)
+    fixed = finite & ~zero & ~sci
+
+    formatted = values.to_numpy(dtype=object, copy=True)
+    formatted[zero] = f'{0:.{precision}f}'
+    # rounding to precision decimals never changes the fixed notation string
+    formatted[fixed] = [f'{v:.{precision}f}' for v in x[fixed].tolist()]
+    formatted[sci] = [f'{round(v, precision):.{precision}e}' for v in x[sci].tolist()]
+    return pd.Series(formatted, index=values.index, name=values.name)
+
+def format_numbers(df, exp_threshold=6, precision=6):
+    """
+    Copy of df with its float columns formatted by format_sci_column.
+    """
+    df = df.copy()
+    for column in df.select_dtypes(include='floating').columns:
+        df[column] = format_sci_column(df[column], exp_threshold, precision)
+    return df
+
+# Syn file columns of interest, and the types they are read as: the syn half of the merged
+# file that ficus_analysis.py reads. Scan, charge, index and score fields are int32 and
+# Protein is categorical. Floats stay float64, as they are written back out and float32 would
+# change their text.
+SYN_DTYPES = {
+    'ResultID': 'int32',
+    'Scan': 'int32',
+    'FragMethod': 'object',
+    'SpecIndex': 'int32',
+    'Charge': 'int32',
+    'PrecursorMZ': 'float64',
+    'DelM': 'float64',
+    'DelM_PPM': 'float64',
+    'MH': 'float64',
+    'Peptide': 'object',
+    'Protein': 'category',
+    'NTT': 'int32',
+    'DeNovoScore': 'int32',
+    'MSGFScore': 'int32',
+    'MSGFDB_SpecEValue': 'float64',
+    'Rank_MSGFDB_SpecEValue': 'int32',
+    'EValue': 'float64',
+    'QValue': 'float64',
+    'PepQValue': 'float64',
+    'IsotopeError': 'int32'
+}
+COLUMNS_SYN = list(SYN_DTYPES)
+
+# SICstats file columns of interest, and the types they are read as
+SIC_DTYPES = {
+    'OptimalPeakApexScanNumber': 'int32',
+    'PeakMaxIntensity': 'float64',
+    'PeakSignalToNoiseRatio': 'float64',
+    'FWHMInScans': 'int32',
+    'PeakArea': 'float64',
+    'ParentIonIntensity': 'float64',
+    'MZ': 'float64',
+    'StatMomentsArea': 'float64',
+    'PeakScanStart': 'int32',
+    'PeakScanEnd': 'int32',
+    'FragScanNumber': 'int32'
+}
+COLUMNS_SIC = list(SIC_DTYPES)
+
+def read_columns(file, dtypes, engine='c', chunksize=None):
+    """
+    Reads only the columns in dtypes from a tab separated file, with those dtypes.
+    :param engine: pandas read_csv engine, 'c' or 'pyarrow'. pyarrow parses floats exactly,
+        where the c engine's default parser can be off in the last digit, and can't read in chunks.
+    :param chunksize: return an iterator over frames of chunksize rows instead
+    """
+    return pd.read_csv(file, sep='\t', usecols=list(dtypes), dtype=dtypes, engine=engine, chunksize=chunksize)
+
+def merge_frames(df_syn, df_sic):
+    """
+    Joins syn rows to the SICstats of their scan, in the column layout of the merged file.
+    Rows are in merge order; merge_files sorts them by ResultID.
+    """
+    df_sic = df_sic[COLUMNS_SIC]
+    df_syn = df_syn[COLUMNS_SYN].copy()
 
-    df_sic = pd.read_csv(sicstats, sep='\t')
-    df_syn = pd.read_csv(syn, sep='\t')
-
-    # Syn file columns of interest
-    columns_syn = [
-        'ResultID', 
-        'Scan',
-        'FragMethod',
-        'SpecIndex',
-        'Charge',
-        'PrecursorMZ',
-        'DelM',
-        'DelM_PPM',
-        'MH',
-        'Peptide',
-        'Protein',
-        'NTT',
-        'DeNovoScore',
-        'MSGFScore',
-        'MSGFDB_SpecEValue',
-        'Rank_MSGFDB_SpecEValue',
-        'EValue',
-        'QValue',
-        'PepQValue',
-        'IsotopeError'
-    ]
-
-    # SICstats file columns of interest
-    columns_sic = [
-        'OptimalPeakApexScanNumber',
-        'PeakMaxIntensity',
-        'PeakSignalToNoiseRatio',
-        'FWHMInScans',
-        'PeakArea',
-        'ParentIonIntensity',
-        'MZ',
-        'StatMomentsArea',
-        'PeakScanStart',
-        'PeakScanEnd',
-        'FragScanNumber'
-    ]
-
-    df_sic = df_sic[columns_sic]
-    df_syn  = df_syn[columns_syn]
-    
     # Add empty columns to df_syn to preserve original column order
     df_syn['ElutionTime'] = ''
     df_syn['ScanType'] = ''
@@ -94,13 +137,99 @@ def merge_files(sicstats, syn, output):
     # Added here to preserve the original column order
     merged_df['PeakWidthMinutes'] = 0
 
-    merged_df = merged_df.sort_values(by='ResultID')
+    return merged_df
+
+def merge_tables(sicstats, syn, engine='c'):
+    """
+    Reads and merges a SICstats and a syn file in memory.
+    :return: the merged frame, sorted by ResultID
+    """
+    df_sic = read_columns(sicstats, SIC_DTYPES, engine)
+    df_syn = read_columns(syn, SYN_DTYPES, engine)
 
-    # format numbers
-    merged_expanded_df = merged_df.applymap(lambda x: format_sci_conditional(x))
+    merged_df = merge_frames(df_syn, df_sic)
 
-    merged_df.to_csv(output, index=False, sep='\t')
+    return merged_df.sort_values(by='ResultID')
+
+class MergedFileWriter:
+    """
+    Writes the merged file a frame at a time, as TSV or as a single zstd compressed Parquet file.
+    """
+    def __init__(self, output, output_format='tsv'):
+        self.output = output
+        self.output_format = output_format
+        self.parquet_writer = None
+        self.frames_written = 0
+
+    def write(self, df):
+        if self.output_format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            # Protein categories differ between chunks, it is stored as plain strings
+            schema = self.parquet_writer.schema if self.parquet_writer is not None else None
+            table = pa.Table.from_pandas(df.astype({'Protein': 'object'}), schema=schema, preserve_index=False)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(self.output, table.schema, compression='zstd')
+            self.parquet_writer.write_table(table)
+        else:
+            first = self.frames_written == 0
+            df.to_csv(self.output, index=False, sep='\t', mode='w' if first else 'a', header=first)
+        self.frames_written += 1
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+def merge_files_streaming(sicstats, syn, output, chunksize, format_output=False, output_format='tsv'):
+    """
+    The merge of merge_files, reading the syn file in chunks of chunksize rows, in any order,
+    with the output written chunk by chunk. Only the SICstats file, one row per fragmented
+    scan, is read whole. Each chunk's rows are sorted by ResultID, so for a syn file in
+    ResultID order, as PHRP writes it, the output is the same as merge_files without chunks.
+    """
+    df_sic = read_columns(sicstats, SIC_DTYPES)
+    writer = MergedFileWriter(output, output_format)
+
+    for syn_chunk in read_columns(syn, SYN_DTYPES, chunksize=chunksize):
+        sic_subset = df_sic[df_sic['FragScanNumber'].isin(syn_chunk['Scan'])]
+        merged_df = merge_frames(syn_chunk, sic_subset).sort_values(by='ResultID', kind='stable')
+        if format_output:
+            merged_df = format_numbers(merged_df)
+        writer.write(merged_df)
+
+    if writer.frames_written == 0:
+        writer.write(merge_frames(pd.DataFrame(columns=COLUMNS_SYN).astype(SYN_DTYPES), df_sic.iloc[:0]))
+    writer.close()
+
+@click.command()
+@click.option('--sicstats', type=click.Path(exists=True), required=True, help='Path to SICstats file from MASIC.')
+@click.option('--syn', type=click.Path(exists=True), required=True, help='Path to syn file from MS-GF+.')
+@click.option('--output', type=click.Path(writable=True), required=True, help='Filepath to write the combined output CSV.')
+@click.option('--format-numbers', 'format_output', is_flag=True, help='Write floats rounded to 6 decimals, in scientific notation from 1e6 and below 1e-5 (see format_sci_conditional).')
+@click.option('--chunksize', type=int, default=None, help='Read the syn file in chunks of this many rows, so memory use does not grow with it. Rows are written sorted by ResultID within each chunk.')
+@click.option('--engine', type=click.Choice(['c', 'pyarrow']), default='c', help='pandas CSV parser to read the files with. pyarrow is faster and parses floats exactly, but not in chunks.')
+@click.option('--output-format', type=click.Choice(['tsv', 'parquet']), default='tsv', help='Write the merged file as TSV or as zstd compressed Parquet, which ficus_analysis.py also reads.')
+def merge_files(sicstats, syn, output, format_output, chunksize, engine, output_format):
+    """
+    Merges SICstats and syn files side-by-side and writes the combined DataFrame to a TSV output file.
+    """
+    if format_output and output_format != 'tsv':
+        raise click.UsageError('--format-numbers needs --output-format tsv')
+    if chunksize:
+        if engine != 'c':
+            raise click.UsageError('--chunksize needs --engine c')
+        merge_files_streaming(sicstats, syn, output, chunksize, format_output, output_format)
+        return
+
+    merged_df = merge_tables(sicstats, syn, engine)
+
+    if format_output:
+        merged_df = format_numbers(merged_df)
+
+    writer = MergedFileWriter(output, output_format)
+    writer.write(merged_df)
+    writer.close()
 
 if __name__ == '__main__':
     merge_files()
-
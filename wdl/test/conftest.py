@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the workflow scripts in wdl/code are run as top-level scripts, not as a package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "code"))
@@ -0,0 +1,164 @@
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import compute_fdr
+from compute_fdr import NO_THRESHOLD, FdrDownIterate, FdrExact, FdrResult, fdr_curve, get_dat, get_qvalues
+
+
+def brute_force_threshold(values, is_decoy, fdr, spec_e_value=None) -> FdrResult:
+    """
+    Largest SpecEValue, at most spec_e_value, whose FDR 2 * decoys / rows over the rows at or
+    below it is at most fdr, trying every distinct value in Decimal.
+    """
+    result = NO_THRESHOLD
+    for value in sorted(set(values)):
+        if spec_e_value is not None and value > spec_e_value:
+            break
+        count = sum(other <= value for other in values)
+        decoy_count = sum(decoy for other, decoy in zip(values, is_decoy) if other <= value)
+        value_fdr = Decimal(2 * decoy_count) / count
+        if value_fdr <= fdr:
+            result = FdrResult(value, value_fdr)
+    return result
+
+
+def write_first_hits(path, values, is_decoy):
+    pd.DataFrame({
+        "Protein": ["XXX_prot" if decoy else "prot" for decoy in is_decoy],
+        "MSGFDB_SpecEValue": values,
+    }).to_csv(path, sep="\t", index=False)
+    return str(path)
+
+
+FDR_EXACT_CASES = [
+    # no decoys: the largest value
+    (["1e-12", "2e-12", "3e-12"], [0, 0, 0], "0.05", None, ("3e-12", "0")),
+    # a decoy at 2e-12 puts every threshold from there on above 0.5
+    (["1e-12", "2e-12", "3e-12", "4e-12"], [0, 1, 0, 0], "0.5", None, ("4e-12", "0.5")),
+    (["1e-12", "2e-12", "3e-12", "4e-12"], [0, 1, 0, 0], "0.4", None, ("1e-12", "0")),
+    # ties pass or fail together
+    (["1e-12", "2e-12", "2e-12", "3e-12"], [0, 0, 1, 0], "0.6", None, ("3e-12", "0.5")),
+    (["1e-12", "2e-12", "2e-12", "3e-12"], [0, 0, 1, 0], "0.5", None, ("3e-12", "0.5")),
+    (["1e-12", "2e-12", "2e-12"], [0, 0, 1], "0.5", None, ("1e-12", "0")),
+    # capped by spec_e_value
+    (["1e-12", "2e-12", "3e-12"], [0, 0, 0], "0.05", "2.5e-12", ("2e-12", "0")),
+    # no threshold reaches the FDR
+    (["1e-12", "2e-12"], [1, 0], "0.05", None, ("0", "0")),
+]
+
+
+@pytest.mark.parametrize("decimal_fallback", [False, True])
+@pytest.mark.parametrize("values, is_decoy, fdr, spec_e_value, expected", FDR_EXACT_CASES)
+def test_fdr_exact(tmp_path, values, is_decoy, fdr, spec_e_value, expected, decimal_fallback):
+    data = get_dat(write_first_hits(tmp_path / "fht.txt", values, is_decoy))
+    spec_e_value = Decimal(spec_e_value) if spec_e_value is not None else None
+    result = FdrExact(data, Decimal(fdr), spec_e_value, decimal_fallback=decimal_fallback).find_values()
+
+    assert result == FdrResult(Decimal(expected[0]), Decimal(expected[1]))
+    assert result == brute_force_threshold([Decimal(v) for v in values], is_decoy, Decimal(fdr), spec_e_value)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_fdr_exact_matches_brute_force(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(1, 300))
+    # three significant digits: few distinct values, so many ties
+    values = [f"{rng.integers(100, 1000)}e-{rng.integers(10, 13)}" for _ in range(n)]
+    is_decoy = (rng.random(n) < rng.random()).astype(int).tolist()
+    fdr = Decimal(str(rng.choice(["0.01", "0.05", "0.1", "0.3"])))
+    spec_e_value = Decimal("5e-11") if seed % 2 else None
+
+    data = get_dat(write_first_hits(tmp_path / "fht.txt", values, is_decoy))
+    expected = brute_force_threshold([Decimal(v) for v in values], is_decoy, fdr, spec_e_value)
+    for decimal_fallback in [False, True]:
+        assert FdrExact(data, fdr, spec_e_value, decimal_fallback=decimal_fallback).find_values() == expected
+
+
+def test_fdr_exact_decimal_fallback(tmp_path):
+    # the first two values parse to the same float, only the Decimals tell them apart
+    values = ["1.0000000000000000000001e-10", "1e-10", "2e-10", "3e-10"]
+    is_decoy = [1, 0, 0, 0]
+    data = get_dat(write_first_hits(tmp_path / "fht.txt", values, is_decoy))
+    assert data.spec_e_values[0] == data.spec_e_values[1]
+
+    result = FdrExact(data, Decimal("0.5"), Decimal("1.00000000000000000000005e-10")).find_values()
+    assert result == FdrResult(Decimal("1e-10"), Decimal(0))
+    result = FdrExact(data, Decimal("0.7")).find_values()
+    assert result == brute_force_threshold([Decimal(v) for v in values], is_decoy, Decimal("0.7"))
+
+
+
+def brute_force_stepped(values, is_decoy, fdr, spec_e_value, spec_e_inc) -> FdrResult:
+    """
+    FdrDownIterate.find_values, counting the rows at or below each step in Decimal.
+    """
+    last = FdrResult(fdr, spec_e_value)
+    while True:
+        spec_e_value -= spec_e_inc
+        count = sum(value <= spec_e_value for value in values)
+        decoy_count = sum(decoy for value, decoy in zip(values, is_decoy) if value <= spec_e_value)
+        step_fdr = Decimal(2 * decoy_count) / count
+        if fdr > step_fdr:
+            return last
+        last = FdrResult(spec_e_value, step_fdr)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_fdr_down_iterate_reads_ties_once(tmp_path, monkeypatch, seed):
+    rng = np.random.default_rng(seed)
+    n = 400
+    # on the grid of the steps, so most steps tie with some rows; the decoys sit at the top
+    ints = np.sort(rng.integers(1, 200, n))
+    values = [f"{value}e-13" for value in ints]
+    is_decoy = (rng.random(n) < np.linspace(0, 0.6, n) ** 2).astype(int).tolist()
+    data = get_dat(write_first_hits(tmp_path / "fht.txt", values, is_decoy))
+
+    reads = []
+    read = compute_fdr.get_decimal_spec_e_values
+    monkeypatch.setattr(compute_fdr, "get_decimal_spec_e_values", lambda *args: reads.append(1) or read(*args))
+    fdr, spec_e_value, spec_e_inc = Decimal("0.05"), Decimal("2e-11"), Decimal("1e-13")
+    result = FdrDownIterate(data, spec_e_value, fdr, spec_e_inc).find_values()
+
+    assert result == brute_force_stepped([Decimal(v) for v in values], is_decoy, fdr, spec_e_value, spec_e_inc)
+    assert len(reads) == 1
+    # the cache is shared with later searches on the same data
+    FdrExact(data, fdr).find_values()
+    assert len(reads) == 1
+
+def test_fdr_curve():
+    # sorted: 1 (target), 2 and 2 (decoy, target), 3 (decoy), 4 (target)
+    spec_e_values = np.array([4.0, 2.0, 1.0, 3.0, 2.0])
+    is_decoy = np.array([False, True, False, True, False])
+    fdr, qvalue = fdr_curve(spec_e_values, is_decoy)
+
+    np.testing.assert_allclose(fdr, [0.8, 2 / 3, 0.0, 1.0, 2 / 3])
+    np.testing.assert_allclose(qvalue, [0.8, 2 / 3, 0.0, 0.8, 2 / 3])
+
+
+def test_fdr_curve_empty():
+    fdr, qvalue = fdr_curve(np.array([]), np.array([], dtype=bool))
+    assert len(fdr) == len(qvalue) == 0
+
+
+def test_get_qvalues():
+    psms = pd.DataFrame({
+        "Scan": np.array([1, 2, 3, 4], dtype=np.int32),
+        "Charge": np.array([2, 2, 3, 2], dtype=np.int8),
+        "Peptide": ["K.AAA.R", "K.AAA.R", "R.BBB.K", "-.CCC.-"],
+        "Protein": ["prot1", "prot1", "XXX_prot2", "prot3"],
+        "MSGFDB_SpecEValue": [1e-10, 1e-8, 1e-9, 1e-7],
+    })
+    qvalues = get_qvalues(psms)
+
+    assert list(qvalues.columns) == [
+        "Scan", "Charge", "Peptide", "MSGFDB_SpecEValue", "FDR", "QValue", "PepFDR", "PepQValue"
+    ]
+    assert qvalues["Scan"].tolist() == [1, 3, 2, 4]
+    np.testing.assert_allclose(qvalues["FDR"], [0.0, 1.0, 2 / 3, 0.5])
+    np.testing.assert_allclose(qvalues["QValue"], [0.0, 0.5, 0.5, 0.5])
+    # peptides by their best PSM, flanks stripped: AAA 1e-10, BBB 1e-9 (decoy), CCC 1e-7
+    np.testing.assert_allclose(qvalues["PepFDR"], [0.0, 1.0, 0.0, 2 / 3])
+    np.testing.assert_allclose(qvalues["PepQValue"], [0.0, 2 / 3, 0.0, 2 / 3])
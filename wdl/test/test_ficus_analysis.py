@@ -0,0 +1,246 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ficus_analysis import RESULTANT_DTYPES, DataOutputtable, PeptideProteinIncidence, write_reports
+
+
+def legacy_razor_proteins(pairs: pd.DataFrame) -> pd.DataFrame:
+    """
+    query_2, query_3, query_4 and get_razor_protein_associated_with_peptide as they were in
+    pandas before PeptideProteinIncidence, on distinct 'PeptideSequence', 'Protein' pairs.
+    """
+    table_2 = pairs.groupby("Protein")["PeptideSequence"].count().reset_index(name="peptides_per_protein")
+    table_3 = pairs.groupby("PeptideSequence")["Protein"].count().reset_index(name="proteins_per_peptide")
+    table_4 = pairs.merge(table_2, how="inner", on="Protein").merge(table_3, how="inner", on="PeptideSequence")
+
+    peps_with_1_protein = table_4[table_4["proteins_per_peptide"] == 1]
+    non_degenerate_razor_protein_df = peps_with_1_protein[["PeptideSequence", "Protein"]]
+    peps_with_many_proteins = table_4[table_4["proteins_per_peptide"] > 1]
+
+    non_degenerate_protein_set = set(non_degenerate_razor_protein_df["Protein"].unique())
+    member_df = peps_with_many_proteins[peps_with_many_proteins["Protein"].isin(non_degenerate_protein_set)]
+    only_unique_protein_df = member_df.drop_duplicates(subset=["PeptideSequence"], keep=False)[["PeptideSequence", "Protein"]]
+    more_than_one_unique_protein_df = member_df[member_df["PeptideSequence"].duplicated(keep=False)]
+
+    resolved = (
+        set(more_than_one_unique_protein_df["PeptideSequence"])
+        | set(only_unique_protein_df["PeptideSequence"])
+        | set(non_degenerate_razor_protein_df["PeptideSequence"])
+    )
+    max_count_df = peps_with_many_proteins[~peps_with_many_proteins["PeptideSequence"].isin(resolved)].copy()
+    max_count_df["max_peptides_per_protein"] = max_count_df.groupby(["PeptideSequence"])["peptides_per_protein"].transform(max)
+    max_count_df = max_count_df[max_count_df["peptides_per_protein"] == max_count_df["max_peptides_per_protein"]]
+
+    return pd.concat([
+        non_degenerate_razor_protein_df.assign(rule=0),
+        only_unique_protein_df.assign(rule=1),
+        max_count_df[["PeptideSequence", "Protein"]].assign(rule=2),
+    ])
+
+
+def razor_rules(pairs: pd.DataFrame) -> dict:
+    """
+    :return: (peptide, protein) -> razor_rule of the razor pairs.
+    """
+    peptides = pairs["PeptideSequence"].astype("category")
+    proteins = pairs["Protein"].astype("category")
+    peptide_codes = peptides.cat.codes.to_numpy().astype(np.int64)
+    protein_codes = proteins.cat.codes.to_numpy().astype(np.int64)
+    incidence = PeptideProteinIncidence(
+        peptide_codes, protein_codes, len(peptides.cat.categories), len(proteins.cat.categories)
+    )
+    rule = incidence.razor_rule(peptide_codes, protein_codes)
+    return {
+        (peptide, protein): int(r)
+        for peptide, protein, r in zip(pairs["PeptideSequence"], pairs["Protein"], rule)
+        if r >= 0
+    }
+
+
+def as_rules(df: pd.DataFrame) -> dict:
+    return {(peptide, protein): int(r) for peptide, protein, r in zip(df["PeptideSequence"], df["Protein"], df["rule"])}
+
+
+def pairs_frame(pairs) -> pd.DataFrame:
+    return pd.DataFrame(pairs, columns=["PeptideSequence", "Protein"])
+
+
+RAZOR_CASES = [
+    # peptide of one protein
+    ([("A", "p1")], {("A", "p1"): 0}),
+    # degenerate peptide, one of its proteins has a peptide of its own
+    ([("A", "p1"), ("A", "p2"), ("B", "p1")], {("A", "p1"): 1, ("B", "p1"): 0}),
+    # degenerate peptide, two of its proteins have one: no razor protein
+    (
+        [("A", "p1"), ("A", "p2"), ("B", "p1"), ("C", "p2")],
+        {("B", "p1"): 0, ("C", "p2"): 0},
+    ),
+    # no protein has a peptide of its own: the proteins with the most peptides, ties included
+    ([("A", "p1"), ("A", "p2")], {("A", "p1"): 2, ("A", "p2"): 2}),
+    (
+        [("A", "p1"), ("A", "p2"), ("B", "p1"), ("B", "p2"), ("C", "p1"), ("C", "p3"), ("D", "p3"), ("D", "p2")],
+        {("A", "p1"): 2, ("A", "p2"): 2, ("B", "p1"): 2, ("B", "p2"): 2, ("C", "p1"): 2, ("D", "p2"): 2},
+    ),
+    # the unique protein rule wins over the peptide count: p3 has the most peptides
+    (
+        [("A", "p1"), ("A", "p3"), ("B", "p3"), ("B", "p2"), ("C", "p3"), ("C", "p2"), ("D", "p1")],
+        {("A", "p1"): 1, ("B", "p3"): 2, ("C", "p3"): 2, ("D", "p1"): 0},
+    ),
+]
+
+
+@pytest.mark.parametrize("pairs, expected", RAZOR_CASES)
+def test_razor_rule(pairs, expected):
+    pairs = pairs_frame(pairs)
+    assert as_rules(legacy_razor_proteins(pairs)) == expected
+    assert razor_rules(pairs) == expected
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_razor_rule_matches_legacy(seed):
+    rng = np.random.default_rng(seed)
+    n_peptides, n_proteins = rng.integers(5, 40), rng.integers(2, 15)
+    pairs = pairs_frame(
+        {
+            (f"PEP{peptide}", f"prot{protein}")
+            for peptide in range(n_peptides)
+            for protein in rng.choice(n_proteins, size=rng.integers(1, 4), replace=False)
+        }
+    )
+    assert razor_rules(pairs) == as_rules(legacy_razor_proteins(pairs))
+
+
+def legacy_join(df: pd.DataFrame, keys, value, sep, sort_values=True) -> pd.DataFrame:
+    """
+    groupby(keys)[value].transform(sep.join) followed by drop_duplicates, as query_11 did
+    before join_grouped.
+    """
+    df = df.copy()
+    ordered = df.sort_values(value) if sort_values else df
+    df[value] = ordered.groupby(keys)[value].transform(lambda x: sep.join(x))
+    return df[keys + [value]].dropna(subset=keys).drop_duplicates()
+
+
+JOIN_CASES = [
+    # one key, values joined sorted
+    (
+        {"PeptideSequence": ["B", "A", "B", "A", "C"], "Protein": ["p2", "p9", "p1", "p3", "p5"]},
+        ["PeptideSequence"], "Protein", ", ", True,
+        {"PeptideSequence": ["A", "B", "C"], "Protein": ["p3, p9", "p1, p2", "p5"]},
+    ),
+    # two keys, values joined in df order
+    (
+        {"RazorProtein": ["r1", "r1", "r2", "r1"], "GeneCount": [1, 2, 1, 1], "annotation": ["z", "y", "x", "a"]},
+        ["RazorProtein", "GeneCount"], "annotation", " | ", False,
+        {"RazorProtein": ["r1", "r1", "r2"], "GeneCount": [1, 2, 1], "annotation": ["z | a", "y", "x"]},
+    ),
+    # rows with a missing key are dropped, duplicate values kept
+    (
+        {"PeptideSequence": ["A", None, "A", "B"], "Protein": ["p1", "p2", "p1", "p4"]},
+        ["PeptideSequence"], "Protein", ", ", True,
+        {"PeptideSequence": ["A", "B"], "Protein": ["p1, p1", "p4"]},
+    ),
+]
+
+
+@pytest.mark.parametrize("categorical", [False, True])
+@pytest.mark.parametrize("data, keys, value, sep, sort_values, expected", JOIN_CASES)
+def test_join_grouped(data, keys, value, sep, sort_values, expected, categorical):
+    df = pd.DataFrame(data)
+    if categorical:
+        df[keys[0]] = df[keys[0]].astype("category")
+    joined = DataOutputtable.join_grouped(df, keys, value, sep, sort_values=sort_values)
+
+    expected = pd.DataFrame(expected)
+    assert joined.astype({keys[0]: object}).to_dict("list") == expected.to_dict("list")
+    legacy = legacy_join(pd.DataFrame(data), keys, value, sep, sort_values)
+    assert legacy.sort_values(keys).to_dict("list") == expected.to_dict("list")
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_join_grouped_matches_legacy(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(1, 200))
+    df = pd.DataFrame({
+        "PeptideSequence": rng.choice([f"PEP{i}" for i in range(20)], n),
+        "GeneCount": rng.integers(1, 4, n),
+        "Protein": rng.choice([f"prot{i}" for i in range(30)], n),
+    })
+    keys = ["PeptideSequence", "GeneCount"]
+    for sort_values in [True, False]:
+        joined = DataOutputtable.join_grouped(df, keys, "Protein", ", ", sort_values=sort_values)
+        legacy = legacy_join(df, keys, "Protein", ", ", sort_values).sort_values(keys)
+        assert joined.to_dict("list") == legacy.to_dict("list")
+
+
+def make_resultant(seed, n=6000, n_peptides=40, n_proteins=30) -> pd.DataFrame:
+    """
+    Resultant rows with few peptides, so every sort by PeptideSequence has many ties, and
+    abundances over six decades, so their sums depend on the order they are added in.
+    Enough rows that numpy sorts them with its unstable large-array quicksort.
+    """
+    rng = np.random.default_rng(seed)
+    peptides = rng.integers(0, n_peptides, n)
+    proteins = rng.integers(0, n_proteins, n)
+    return pd.DataFrame({
+        "Scan": rng.integers(1, n // 2, n),
+        "Charge": rng.integers(1, 5, n),
+        "SpecIndex": np.arange(n),
+        "Peptide": [f"K.PEP{p}.R" for p in peptides],
+        "Protein": np.where(rng.random(n) < 0.1, [f"XXX_prot{p}" for p in proteins], [f"prot{p}" for p in proteins]),
+        "MSGFDB_SpecEValue": 10 ** rng.uniform(-20, -8, n),
+        "QValue": rng.uniform(0, 0.1, n),
+        "StatMomentsArea": 10 ** rng.uniform(3, 9, n),
+    }).astype(RESULTANT_DTYPES)
+
+
+def data_output(resultant_df, gff_file=None, **kwargs) -> DataOutputtable:
+    return DataOutputtable(
+        gff_file, None, None, 0.05, "D", "F", "name", False, False,
+        fasta_txt_df=pd.DataFrame({"ProteinName": [f"prot{p}" for p in range(30)]}),
+        resultant_df=resultant_df, **kwargs,
+    )
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_filtered_rows_keep_resultant_order(seed):
+    resultant_df = make_resultant(seed)
+    data_obj = data_output(resultant_df)
+
+    filtered = resultant_df[(resultant_df["QValue"] <= 0.05) & ~resultant_df["Protein"].str.startswith("XXX")]
+    filtered = filtered.assign(PeptideSequence=filtered["Peptide"].str[2:-2])
+    # rows of a peptide in resultant order, as a stable sort on the strings gives them
+    expected = filtered.sort_values(by=["PeptideSequence"], kind="mergesort")
+    rows = data_obj.get_FiltPeps_gen(["PeptideSequence", "SpecIndex"])
+    assert rows["SpecIndex"].tolist() == expected["SpecIndex"].tolist()
+
+    # so the abundances of a peptide are summed in resultant order
+    distinct = expected.drop_duplicates(subset=["SpecIndex", "PeptideSequence", "StatMomentsArea"])
+    expected_sums = distinct.groupby("PeptideSequence")["StatMomentsArea"].sum()
+    sums = data_obj.query_12().set_index("PeptideSequence")["sum(StatMomentsArea)"]
+    assert sums.index.astype(object).tolist() == expected_sums.index.tolist()
+    assert sums.tolist() == expected_sums.tolist()
+
+
+def test_reports_in_memory_match_streamed(tmp_path):
+    resultant_df = make_resultant(0)
+    resultant_file = tmp_path / "resultant.tsv"
+    resultant_df.to_csv(resultant_file, sep="\t", index=False)
+    gff_file = tmp_path / "ann.gff"
+    gff_file.write_text("##gff-version 3\n" + "".join(
+        f"contig{p}\tIMG\tCDS\t1\t300\t.\t+\t0\tID=prot{p};product=protein {p}\n" for p in range(0, 30, 2)
+    ))
+
+    reports = {}
+    for name, kwargs in [("memory", {}), ("streamed", {"resultant_chunksize": 700})]:
+        if kwargs:
+            data_obj = DataOutputtable(
+                str(gff_file), str(resultant_file), None, 0.05, "D", "F", "name", False, False,
+                fasta_txt_df=pd.DataFrame({"ProteinName": [f"prot{p}" for p in range(30)]}), **kwargs,
+            )
+        else:
+            data_obj = data_output(resultant_df, str(gff_file))
+        write_reports(data_obj, tmp_path / name)
+        reports[name] = [(tmp_path / name / f"D_F_{report}.tsv").read_text() for report in ["Peptide_Report", "Protein_Report"]]
+    assert reports["memory"] == reports["streamed"]
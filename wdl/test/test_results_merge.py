@@ -0,0 +1,131 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from results_merge import (
+    SIC_DTYPES,
+    SYN_DTYPES,
+    MergedFileWriter,
+    format_numbers,
+    format_sci_column,
+    format_sci_conditional,
+    merge_files_streaming,
+    merge_tables,
+)
+
+
+def legacy_format(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    The per cell formatting results_merge.py did before format_numbers.
+    """
+    return df.applymap(lambda x: format_sci_conditional(x))
+
+
+FORMAT_CASES = [
+    # integer valued floats, both notations
+    [0.0, -0.0, 1.0, 3.0, -42.0, 100000.0, 999999.0, 1000000.0, 1e7, -1e12, 2.0 ** 60],
+    # powers of ten and their neighbours, where the exponent changes
+    [10.0 ** k for k in range(-12, 13)]
+    + [np.nextafter(10.0 ** k, 0) for k in range(-12, 13)]
+    + [np.nextafter(10.0 ** k, np.inf) for k in range(-12, 13)],
+    # rounding to 6 decimals carries into the next power of ten
+    [9.9999999e-7, 9.99999949e-7, 999999.9999999, 0.0000005, 0.00000049999, 1e-6 - 1e-13, -9.9999999e-7],
+    # extremes
+    [5e-324, 1.7976931348623157e308, -2.2250738585072014e-308, 1.2345678901234567e-20],
+]
+
+
+@pytest.mark.parametrize("values", FORMAT_CASES)
+def test_format_sci_column(values):
+    column = pd.Series(values, dtype="float64")
+    expected = [format_sci_conditional(v) for v in values]
+    assert format_sci_column(column).tolist() == expected
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_format_numbers_matches_legacy(seed):
+    rng = np.random.default_rng(seed)
+    n = 500
+    df = pd.DataFrame({
+        "Peptide": rng.choice(["K.AAA.R", "R.BBB.K"], n),
+        "Scan": rng.integers(1, 100000, n).astype(np.int32),
+        "MSGFDB_SpecEValue": 10 ** rng.uniform(-40, 2, n),
+        "DelM_PPM": rng.normal(0, 10, n),
+        "PeakMaxIntensity": np.round(10 ** rng.uniform(0, 12, n)),
+        "StatMomentsArea": rng.choice([0.0, 1e6, 123456.0, 1e-6], n),
+    })
+    formatted = format_numbers(df)
+
+    assert formatted.to_dict("list") == legacy_format(df).to_dict("list")
+    # only the float columns change
+    assert formatted["Scan"].dtype == np.int32
+    assert formatted["Peptide"].tolist() == df["Peptide"].tolist()
+
+
+def test_format_numbers_non_finite():
+    # the per cell formatting raised on NaN and inf; format_numbers leaves them as they are
+    df = pd.DataFrame({"Scan": [1, 2, 3, 4, 5, 6], "PeakArea": [1.5, np.nan, 2.5e7, np.inf, -np.inf, 2e-9]})
+    with pytest.raises((ValueError, OverflowError)):
+        legacy_format(df.iloc[[1]])
+    with pytest.raises((ValueError, OverflowError)):
+        legacy_format(df.iloc[[3]])
+
+    formatted = format_numbers(df)
+    finite = np.isfinite(df["PeakArea"])
+    assert formatted[finite].to_dict("list") == legacy_format(df[finite]).to_dict("list")
+    assert formatted["PeakArea"][~finite].tolist()[1:] == [np.inf, -np.inf]
+    assert np.isnan(formatted["PeakArea"][1])
+
+    # written as an unformatted NaN is: an empty field
+    text = io.StringIO()
+    formatted.to_csv(text, sep="\t", index=False)
+    assert text.getvalue().splitlines() == [
+        "Scan\tPeakArea", "1\t1.500000", "2\t", "3\t2.500000e+07", "4\tinf", "5\t-inf",
+        # rounded to 6 decimals before the scientific notation, as the per cell formatting did
+        "6\t0.000000e+00",
+    ]
+
+
+def write_merge_inputs(tmp_path, seed):
+    """
+    SICstats with one row per scan, most of them fragmented, and a syn file in ResultID order,
+    as PHRP writes it, so not in scan order.
+    """
+    rng = np.random.default_rng(seed)
+    scans = np.arange(1, 301)
+    sic = pd.DataFrame({column: rng.random(len(scans)) for column in SIC_DTYPES})
+    sic = sic.astype({column: "float64" for column in SIC_DTYPES})
+    for column, dtype in SIC_DTYPES.items():
+        if dtype == "int32":
+            sic[column] = rng.integers(0, 1000, len(scans))
+    sic["FragScanNumber"] = scans
+    sic = sic[rng.random(len(scans)) < 0.9]
+
+    n = 1000
+    syn = pd.DataFrame({column: rng.integers(0, 50, n) if dtype == "int32" else 10 ** rng.uniform(-20, 3, n)
+                        for column, dtype in SYN_DTYPES.items()})
+    syn["ResultID"] = np.arange(1, n + 1)
+    syn["Scan"] = rng.choice(scans, n)
+    syn["FragMethod"] = "HCD"
+    syn["Peptide"] = rng.choice(["K.AAA.R", "R.BBB.K"], n)
+    syn["Protein"] = rng.choice(["prot1", "XXX_prot2"], n)
+
+    sic_file, syn_file = tmp_path / "sic.txt", tmp_path / "syn.txt"
+    sic.to_csv(sic_file, sep="\t", index=False)
+    syn.to_csv(syn_file, sep="\t", index=False)
+    return str(sic_file), str(syn_file)
+
+
+@pytest.mark.parametrize("chunksize", [7, 64, 5000])
+def test_merge_files_streaming_unsorted(tmp_path, chunksize):
+    sic_file, syn_file = write_merge_inputs(tmp_path, chunksize)
+    expected = tmp_path / "merged.txt"
+    writer = MergedFileWriter(str(expected))
+    writer.write(merge_tables(sic_file, syn_file))
+    writer.close()
+
+    output = tmp_path / "merged_chunks.txt"
+    merge_files_streaming(sic_file, syn_file, str(output), chunksize)
+    assert output.read_text() == expected.read_text()